@@ -0,0 +1,101 @@
+"""
+Benchmark AreaForecastDiscussion parsing on synthetic products of increasing size, built by
+repeating the sections of a bundled test fixture. Parse time per KB of product text should stay
+roughly constant as the product grows, showing the parser scales linearly.
+
+With --memory, also report the memory held by parsed products kept alive in a list, before and
+after their sections are first accessed.
+
+Usage: python benchmarks/bench_parser.py [--fixture okx_afd_response.json] [--max-scale 256]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sendafd.apiclient import AreaForecastDiscussion  # noqa: E402
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests")
+
+
+def scaled_product(raw_afd: dict, scale: int) -> dict:
+    """Return a copy of raw_afd whose text repeats the middle sections `scale` times, so the
+    product also contains many repeated section and subsection headers"""
+    sections = raw_afd['productText'].split("&&")
+    header, middle, footer = sections[0], sections[1:-1], sections[-1]
+    product = dict(raw_afd)
+    product['productText'] = "&&".join([header] + middle * scale + [footer])
+    return product
+
+
+def run(fixture: str, max_scale: int, repeat: int) -> list:
+    with open(os.path.join(FIXTURE_DIR, fixture), 'r', encoding='utf-8') as f:
+        raw_afd = json.load(f)
+    results = []
+    scale = 1
+    while scale <= max_scale:
+        product = scaled_product(raw_afd, scale)
+        size_kb = len(product['productText']) / 1024
+        number = max(1, 64 // scale)
+        # touch every section body so lazily parsed content is included in the timing
+        best = min(timeit.repeat(lambda: [s.body for s in AreaForecastDiscussion(product).sections],
+                                 number=number, repeat=repeat)) / number
+        results.append({'scale': scale,
+                        'size_kb': round(size_kb, 1),
+                        'seconds': best,
+                        'us_per_kb': best / size_kb * 1e6})
+        scale *= 2
+    return results
+
+
+def measure_memory(fixture: str, count: int) -> dict:
+    """Return the bytes per product held by `count` parsed products, before and after their
+    sections and section bodies are materialized"""
+    with open(os.path.join(FIXTURE_DIR, fixture), 'r', encoding='utf-8') as f:
+        raw_afd = json.load(f)
+    # give each product its own text, as products loaded from an archive would have
+    products = [dict(raw_afd, productText=raw_afd['productText'] + " " * n) for n in range(count)]
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    parsed = [AreaForecastDiscussion(p) for p in products]
+    unparsed_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    for afd in parsed:
+        for section in afd.sections:
+            section.body
+    parsed_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return {'products': count,
+            'bytes_per_product_unparsed': unparsed_bytes // count,
+            'bytes_per_product_parsed': parsed_bytes // count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--fixture', default="okx_afd_response.json")
+    parser.add_argument('--max-scale', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--memory', action='store_true',
+                        help="Also measure memory held per parsed product")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args()
+    results = run(args.fixture, args.max_scale, args.repeat)
+    memory = measure_memory(args.fixture, 500) if args.memory else None
+    if args.json:
+        print(json.dumps({'scaling': results, 'memory': memory}, indent=2))
+        return
+    print(f"{'scale':>6} {'size (KB)':>10} {'parse (ms)':>11} {'us/KB':>8}")
+    for r in results:
+        print(f"{r['scale']:>6} {r['size_kb']:>10} {r['seconds'] * 1000:>11.3f} {r['us_per_kb']:>8.1f}")
+    if memory:
+        print(f"\nMemory per product ({memory['products']} products): "
+              f"{memory['bytes_per_product_unparsed']} bytes before sections are accessed, "
+              f"{memory['bytes_per_product_parsed']} bytes after")
+
+
+if __name__ == "__main__":
+    main()
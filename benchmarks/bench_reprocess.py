@@ -0,0 +1,109 @@
+"""
+Benchmark bulk reprocessing of archived AFDs with reprocess.reprocess(), to check that
+throughput scales with the number of worker processes. A temporary archive is filled with
+--products copies of the test fixtures, then reprocessed to a JSON lines file with 1, 2, 4, ...
+worker processes, up to the number of CPUs. For each process count the best of --repeat runs is
+reported, with its throughput and speedup over a single process.
+
+Results are printed as JSON and can be saved with --output and compared with --compare, as in
+bench_suite.py.
+
+Usage: python benchmarks/bench_reprocess.py [--products 2000] [--repeat 3] [--output reprocess.json]
+                                            [--compare baseline.json] [--threshold 1.25]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from bench_suite import REGIONS, compare, load_fixture
+
+from sendafd import archive, reprocess
+
+
+def fill_archive(afd_archive: archive.Archive, products: int):
+    per_region = max(1, products // len(REGIONS))
+    for region in REGIONS:
+        product = load_fixture(f"{region.lower()}_afd_response.json")
+        afd_archive.append(region, [dict(product, id=f"{product['id']}-{n}")
+                                    for n in range(per_region)])
+
+
+def process_counts() -> list:
+    counts = [1]
+    while counts[-1] * 2 <= (os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+    if counts[-1] != (os.cpu_count() or 1):
+        counts.append(os.cpu_count())
+    return counts
+
+
+def run(products: int, repeat: int) -> dict:
+    logging.disable(logging.CRITICAL)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            afd_archive = archive.Archive(os.path.join(work_dir, "archive"))
+            fill_archive(afd_archive, products)
+            output = os.path.join(work_dir, "out.jsonl")
+            single = None
+            for processes in process_counts():
+                best = None
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    counts = reprocess.reprocess(afd_archive,
+                                                 template="default_email_template.html",
+                                                 jsonl_path=output, processes=processes)
+                    seconds = time.perf_counter() - start
+                    best = seconds if best is None else min(best, seconds)
+                single = single or best
+                results[f"reprocess[{processes}]"] = {
+                    'seconds': best,
+                    'products': counts['processed'],
+                    'products_per_second': counts['processed'] / best,
+                    'speedup': single / best,
+                }
+    finally:
+        logging.disable(logging.NOTSET)
+    return {'python': sys.version.split()[0], 'cpus': os.cpu_count(), 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--products', type=int, default=2000,
+                        help="Number of products in the archive. Defaults to 2000.")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="Also write the results to this JSON file")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="Compare against results previously saved with --output")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="Slowdown ratio against the baseline counted as a regression. "
+                             "Defaults to 1.25.")
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    results = run(args.products, args.repeat)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if baseline is None:
+        print(json.dumps(results, indent=2))
+        return
+    rows = compare(results, baseline, args.threshold)
+    print(json.dumps({'threshold': args.threshold,
+                      'comparison': [{'name': name, 'baseline_seconds': base, 'seconds': seconds,
+                                      'ratio': round(ratio, 3), 'regressed': regressed}
+                                     for name, base, seconds, ratio, regressed in rows]},
+                     indent=2))
+    if any(row[4] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
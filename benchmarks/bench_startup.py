@@ -0,0 +1,126 @@
+"""
+Benchmark sendAFD's startup cost on its lightweight code paths, using `python -X importtime`:
+--version, --locations with a fresh region code cache, and a monitor mode run where the AFD has
+not changed, against the stand-in NWS API server from bench_suite.py. None of these paths should
+import jinja2, smtplib or sqlite3. (email.message is still loaded on the paths that use requests,
+because http.client imports it.)
+
+Each path is run in a new interpreter --repeat times; the fastest run is reported. Results are
+printed as JSON and can be saved with --output and compared with --compare, as in bench_suite.py.
+
+Usage: python benchmarks/bench_startup.py [--repeat 5] [--output startup.json]
+                                          [--compare baseline.json] [--threshold 1.25]
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_suite import ROOT_DIR, compare, load_fixture, stand_in_servers
+
+# modules reported when a path imports them; only --version should avoid requests
+HEAVY_MODULES = ["jinja2", "smtplib", "sqlite3", "requests"]
+
+importtime_regex = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$", re.MULTILINE)
+
+# runs main() with the API pointed at the stand-in server; apiclient is imported on this path
+#  anyway, so setting its base URL first does not change which modules are loaded
+MONITOR_SCRIPT = ("import sys; from sendafd import apiclient; apiclient.API_BASE_URL = sys.argv.pop(1); "
+                  "from sendafd.__main__ import main; main()")
+
+
+def parse_importtime(stderr: str) -> dict:
+    """Return the total import time in microseconds and the set of modules imported, from the
+    output of python -X importtime"""
+    total = 0
+    modules = set()
+    for self_us, cumulative_us, indent, module in importtime_regex.findall(stderr):
+        modules.add(module)
+        # top-level imports have a single space of indentation; their cumulative times cover
+        #  every nested import
+        if len(indent) == 1:
+            total += int(cumulative_us)
+    return {'import_us': total, 'modules': modules}
+
+
+def run_once(args: list, cwd: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=cwd, env=env,
+                               capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} exited with {completed.returncode}:\n"
+                           f"{completed.stderr[-2000:]}")
+    result = parse_importtime(completed.stderr)
+    result['seconds'] = wall
+    return result
+
+
+def run(repeat: int) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir, stand_in_servers():
+        from sendafd import apiclient
+        base_url = apiclient.API_BASE_URL
+        # a fresh region code cache, so --locations needs no request
+        with open(os.path.join(work_dir, "cache_region_codes.json"), 'w', encoding='utf-8') as f:
+            json.dump({'fetched': time.time(),
+                       'locations': {"PSR": "Phoenix, AZ", "OKX": "New York, NY"}}, f)
+        # seed the monitor cache with the newest PSR product, so the run finds nothing new
+        with open(os.path.join(work_dir, "cache_psr.json"), 'w', encoding='utf-8') as f:
+            json.dump(load_fixture("psr_afd_response.json"), f)
+        paths = {
+            'version': ["-m", "sendafd", "--version"],
+            'locations': ["-m", "sendafd", "--locations"],
+            'monitor_unchanged': ["-c", MONITOR_SCRIPT, base_url, "-m", "foo@bar.com",
+                                  "localhost", "user@example.com", "password", "PSR"],
+        }
+        for name, args in paths.items():
+            runs = [run_once(args, work_dir) for _ in range(repeat)]
+            best = min(runs, key=lambda r: r['seconds'])
+            results[name] = {
+                'seconds': best['seconds'],
+                'import_us': min(r['import_us'] for r in runs),
+                'heavy_modules': sorted(m for m in HEAVY_MODULES if m in best['modules']),
+            }
+    return {'python': sys.version.split()[0], 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="Also write the results to this JSON file")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="Compare against results previously saved with --output")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="Slowdown ratio against the baseline counted as a regression. "
+                             "Defaults to 1.25.")
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    results = run(args.repeat)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if baseline is None:
+        print(json.dumps(results, indent=2))
+        return
+    rows = compare(results, baseline, args.threshold)
+    print(json.dumps({'threshold': args.threshold,
+                      'comparison': [{'name': name, 'baseline_seconds': base, 'seconds': seconds,
+                                      'ratio': round(ratio, 3), 'regressed': regressed}
+                                     for name, base, seconds, ratio, regressed in rows]},
+                     indent=2))
+    if any(row[4] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
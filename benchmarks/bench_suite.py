@@ -0,0 +1,244 @@
+"""
+Benchmark the main code paths of sendAFD using the product fixtures from the test suite: parsing,
+rendering, email building, and a full main() run against local stand-in HTTP and SMTP servers.
+
+Results are printed as JSON. Save them with --output, then pass that file to --compare on a later
+run to report the change for each benchmark and exit with status 1 if any benchmark is slower
+than the baseline by more than --threshold.
+
+Usage: python benchmarks/bench_suite.py [--output results.json] [--compare baseline.json]
+                                        [--threshold 1.25] [--filter render]
+"""
+
+import argparse
+import functools
+import http.server
+import json
+import logging
+import os
+import platform
+import smtplib
+import socketserver
+import sys
+import threading
+import timeit
+from contextlib import contextmanager
+from unittest import mock
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from sendafd import apiclient, emailclient, renderer  # noqa: E402
+from sendafd import __main__ as cli  # noqa: E402
+
+FIXTURE_DIR = os.path.join(ROOT_DIR, "tests")
+REGIONS = ["PSR", "TOP", "LOX", "OKX"]
+TEMPLATES = ["default_email_template.html", "sample_web_template.html"]
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(FIXTURE_DIR, name), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class StandInAPIHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the AFD list and product fixtures at the same paths as the NWS API"""
+    responses = {}
+
+    def do_GET(self):
+        body = self.responses.get(self.path.lower())
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/geo+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server that accepts any login and discards every message"""
+    def reply(self, line: str):
+        self.wfile.write(line.encode('ascii') + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost stand-in ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250-localhost")
+                self.reply("250 AUTH PLAIN")
+            elif command.startswith("AUTH"):
+                self.reply("235 Authentication successful")
+            elif command.startswith("DATA"):
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.reply("250 OK")
+            elif command.startswith("QUIT"):
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+@contextmanager
+def stand_in_servers():
+    """Start local HTTP and SMTP stand-ins and point apiclient at the HTTP one. Yields the SMTP
+    server's (host, port)."""
+    responses = {}
+    for region in REGIONS:
+        afd_list = load_fixture(f"{region.lower()}_afd_list_response.json")
+        product = load_fixture(f"{region.lower()}_afd_response.json")
+        responses[f"/products/types/afd/locations/{region.lower()}"] = json.dumps(afd_list).encode()
+        responses[f"/products/{product['id']}".lower()] = json.dumps(product).encode()
+    StandInAPIHandler.responses = responses
+    http_server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInAPIHandler)
+    smtp_server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), StandInSMTPHandler)
+    smtp_server.daemon_threads = True
+    for server in (http_server, smtp_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    original_base_url = apiclient.API_BASE_URL
+    apiclient.API_BASE_URL = f"http://127.0.0.1:{http_server.server_address[1]}"
+    try:
+        # the stand-in does not speak TLS, so skip the STARTTLS handshake
+        with mock.patch.object(smtplib.SMTP, 'starttls', lambda self, *a, **kw: (220, b"")):
+            yield smtp_server.server_address
+    finally:
+        apiclient.API_BASE_URL = original_base_url
+        apiclient.close_session()
+        for server in (http_server, smtp_server):
+            server.shutdown()
+            server.server_close()
+
+
+def run_main(smtp_address: tuple):
+    """Run sendafd's main() for every fixture region, emailing each AFD to the SMTP stand-in"""
+    argv = ["sendafd", "-i", "recipient@example.com", smtp_address[0], "user@example.com",
+            "password"] + REGIONS
+    sender = functools.partial(emailclient.SMTPSender, smtp_port=smtp_address[1])
+    with mock.patch.object(sys, 'argv', argv), \
+            mock.patch.object(emailclient, 'SMTPSender', sender):
+        cli.main()
+
+
+def collect_benchmarks(smtp_address: tuple) -> dict:
+    """Return a dict mapping benchmark name to a zero-argument callable"""
+    benchmarks = {}
+    for region in REGIONS:
+        raw_afd = load_fixture(f"{region.lower()}_afd_response.json")
+        parsed_afd = apiclient.AreaForecastDiscussion(raw_afd)
+        benchmarks[f"construct[{region}]"] = lambda raw_afd=raw_afd: \
+            apiclient.AreaForecastDiscussion(raw_afd)
+        benchmarks[f"parse_sections[{region}]"] = lambda raw_afd=raw_afd: \
+            [s.body for s in apiclient.AreaForecastDiscussion(raw_afd).sections]
+        benchmarks[f"clean_newlines[{region}]"] = lambda text=raw_afd['productText']: \
+            apiclient.AreaForecastDiscussion.clean_newlines(text)
+        for template in TEMPLATES:
+            # the sample web template reads afd_json, which is only passed to it by render_web
+            if template != "sample_web_template.html":
+                benchmarks[f"render_email_body[{region},{template}]"] = \
+                    lambda afd=parsed_afd, template=template: \
+                    renderer.render_email_body(afd, template)
+            benchmarks[f"render_web[{region},{template}]"] = \
+                lambda afd=parsed_afd, raw_afd=raw_afd, template=template: \
+                renderer.render_web(afd, raw_afd, template)
+        benchmarks[f"build_email_as_string[{region}]"] = lambda afd=parsed_afd: \
+            renderer.build_email(afd, "user@example.com", "recipient@example.com",
+                                 "default_email_template.html").as_string()
+    benchmarks["main_end_to_end"] = lambda: run_main(smtp_address)
+    return benchmarks
+
+
+def time_benchmark(func, repeat: int, min_time: float) -> dict:
+    """Time func, calling it enough times per repeat to take at least min_time seconds, and
+    return the best seconds per call"""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    return {'seconds': best, 'number': number, 'repeat': repeat}
+
+
+def run(name_filter: str = None, repeat: int = 5, min_time: float = 0.05) -> dict:
+    # keep the region code cache written by the full run in the repository directory
+    os.chdir(ROOT_DIR)
+    # measure rendering itself rather than lookups in the render cache
+    renderer.configure_render_cache(max_entries=0)
+    # and the client itself rather than the NWS API request budget
+    apiclient.configure_rate_limit(rate=0)
+    logging.disable(logging.CRITICAL)
+    results = {}
+    try:
+        with stand_in_servers() as smtp_address:
+            for name, func in collect_benchmarks(smtp_address).items():
+                if name_filter and name_filter not in name:
+                    continue
+                results[name] = time_benchmark(func, repeat, min_time)
+    finally:
+        logging.disable(logging.NOTSET)
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return a list of (name, baseline seconds, seconds, ratio, regressed) for each benchmark
+    present in both results"""
+    rows = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        base_seconds = baseline['results'][name]['seconds']
+        ratio = result['seconds'] / base_seconds if base_seconds else float('inf')
+        rows.append((name, base_seconds, result['seconds'], ratio, ratio > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help="Also write the results to this JSON file")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="Compare against results previously saved with --output")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="Slowdown ratio against the baseline counted as a regression. "
+                             "Defaults to 1.25.")
+    parser.add_argument('--filter', help="Only run benchmarks whose name contains this text")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help="Minimum seconds per timing repeat. Defaults to 0.05.")
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        # read the baseline before running, so a bad path fails fast
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    results = run(args.filter, args.repeat, args.min_time)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if baseline is None:
+        print(json.dumps(results, indent=2))
+        return
+    rows = compare(results, baseline, args.threshold)
+    print(json.dumps({'threshold': args.threshold,
+                      'comparison': [{'name': name, 'baseline_seconds': base, 'seconds': seconds,
+                                      'ratio': round(ratio, 3), 'regressed': regressed}
+                                     for name, base, seconds, ratio, regressed in rows]},
+                     indent=2))
+    if any(row[4] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
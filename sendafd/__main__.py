@@ -1,10 +1,14 @@
 import argparse
+import contextlib
 import logging
+import os
 import sys
+import time
 
-from requests import HTTPError
-
-from . import apiclient, emailclient, renderer
+# only lightweight modules are imported here. apiclient (requests), renderer (jinja2),
+#  emailclient (smtplib) and the other subsystems are imported on the code paths that use them,
+#  so --version, --locations and unchanged monitor runs start quickly
+from . import metrics
 
 
 VERSION = "0.1.0"
@@ -19,25 +23,162 @@ logger.addHandler(handler)
 def main():
     """Main program functionality, called if the sendafd package is executed directly"""
     # initialize command line argument parser
-    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser = argparse.ArgumentParser(prog="sendafd", add_help=False)
     pre_parser.add_argument('-l', '--locations',
                         required=False,
                         action='store_true',
                         help="Print a list of valid region codes with descriptions and exit.")
+    # the defaults of these options are added to their help once apiclient is imported
+    region_cache_ttl_option = pre_parser.add_argument('--region-cache-ttl',
+                        type=float,
+                        help="Seconds to keep the cached list of valid region codes before fetching "
+                             "it again from the NWS API. Use 0 to always fetch.")
+    rate_limit_option = pre_parser.add_argument('--rate-limit',
+                        type=float,
+                        metavar='REQUESTS_PER_SECOND',
+                        help="Average number of requests per second sent to the NWS API, shared "
+                             "by every concurrent fetch. Use 0 for no limit.")
+    rate_burst_option = pre_parser.add_argument('--rate-burst',
+                        type=int,
+                        help="Number of requests that may be sent to the NWS API at once after a "
+                             "quiet period.")
+    pre_parser.add_argument('--template-dir',
+                        action='append',
+                        metavar='TEMPLATE_DIR',
+                        help="Search the specified directory for templates before the templates "
+                             "directory bundled with sendAFD. May be given more than once.")
+    pre_parser.add_argument('--template-cache-dir',
+                        help="Keep compiled templates in the specified directory, so later runs "
+                             "load them without compiling them again. A template is compiled "
+                             "again when its source changes.")
+    pre_parser.add_argument('--precompile-templates',
+                        action='store_true',
+                        help="Compile every template into --template-cache-dir and exit.")
+    pre_parser.add_argument('--daemon',
+                        metavar='CONFIG_FILE',
+                        help="Run as a long-running daemon that polls the regions listed in the "
+                             "JSON configuration file and emails each new AFD. See README.md for "
+                             "the configuration format.")
+    pre_parser.add_argument('--subscriptions',
+                        metavar='SUBSCRIPTIONS_FILE',
+                        help="Email the AFDs for every region in the JSON subscription file to "
+                             "their subscribers. Takes email_server, email_username and "
+                             "email_password arguments instead of recipient and region. See "
+                             "README.md for the file format.")
+    pre_parser.add_argument('--backfill',
+                        metavar='ARCHIVE_DIR',
+                        help="Fetch every AFD currently listed by the NWS API for the supplied "
+                             "regions and add any not yet archived to the archive in ARCHIVE_DIR. "
+                             "Takes region arguments only. See README.md for details.")
+    pre_parser.add_argument('--reprocess',
+                        metavar='ARCHIVE_DIR',
+                        help="Parse and render every AFD in the archive in ARCHIVE_DIR again, using "
+                             "a pool of worker processes, writing the results to a JSON lines "
+                             "file or a directory of HTML files. Takes region arguments only. See "
+                             "README.md for details.")
+    pre_parser.add_argument('--serve',
+                        metavar='PORT',
+                        type=int,
+                        help="Serve the rendered AFD for any region at http://HOST:PORT/afd/{region}, "
+                             "fetching a region's AFD at most once per poll interval however many "
+                             "clients request it. See README.md for details.")
+    pre_parser.add_argument('--site-build',
+                        metavar='OUTPUT_DIR',
+                        help="Write a static site with a rendered page for each supplied region and "
+                             "an index page to OUTPUT_DIR, re-rendering only pages whose AFD or "
+                             "template changed. Takes region arguments only. See README.md for "
+                             "details.")
+    pre_parser.add_argument('--metrics-file',
+                        help="Write timing and count metrics for each stage of the run to the "
+                             "specified file when the run finishes, or after every poll in daemon "
+                             "mode.")
+    pre_parser.add_argument('--metrics-format',
+                        choices=metrics.EXPORT_FORMATS,
+                        default=metrics.export_settings['format'],
+                        help="Format of --metrics-file: 'prometheus' replaces the file with a "
+                             "Prometheus textfile, 'jsonl' appends one JSON object per metric. "
+                             f"Defaults to {metrics.export_settings['format']}.")
+    pre_parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        help="Print debug messages.")
+    pre_parser.add_argument('--version', action='version', version=f'%(prog)s {VERSION}')
     pre_args, _ = pre_parser.parse_known_args()
 
+    from . import apiclient
+    region_cache_ttl = apiclient.region_cache_settings['ttl']
+    region_cache_ttl_option.help += (f" Defaults to {region_cache_ttl} "
+                                     f"({region_cache_ttl / 86400:g} days).")
+    rate_limit_option.help += f" Defaults to {apiclient.rate_limit_settings['rate']}."
+    rate_burst_option.help += f" Defaults to {apiclient.rate_limit_settings['burst']}."
+    if pre_args.region_cache_ttl is not None:
+        apiclient.region_cache_settings['ttl'] = pre_args.region_cache_ttl
+    rate_limit = {name: value for name, value in (('rate', pre_args.rate_limit),
+                                                  ('burst', pre_args.rate_burst))
+                  if value is not None}
+    if rate_limit:
+        apiclient.configure_rate_limit(**rate_limit)
+    if pre_args.template_dir or pre_args.template_cache_dir:
+        from . import renderer
+        renderer.configure_templates(pre_args.template_dir, pre_args.template_cache_dir)
+    metrics.export_settings['path'] = pre_args.metrics_file
+    metrics.export_settings['format'] = pre_args.metrics_format
+
+    # set the logging level according to command line flags(s)
+    if pre_args.verbose:
+        logger.setLevel("DEBUG")
+        logger.info("Log level set to debug")
+    else:
+        logger.setLevel("INFO")
+
     if pre_args.locations:
         try:
-            apiclient.print_region_codes(apiclient.get_region_codes())
-        except HTTPError:
-            logger.critical("Error connecting to the NWS API", exc_info=True)
-            sys.exit(1)
-        except (ValueError, KeyError):
-            logger.critical("Error parsing received location codes", exc_info=True)
+            index = apiclient.load_region_index()
+            if index.source == "bundled":
+                logger.warning("Could not reach the NWS API, printing bundled list of region codes")
+            apiclient.print_region_codes(index)
+        except (OSError, ValueError, KeyError):
+            logger.critical("Error parsing location codes", exc_info=True)
             sys.exit(1)
         else:
             sys.exit()
 
+    if pre_args.precompile_templates:
+        if not pre_args.template_cache_dir:
+            pre_parser.error("--precompile-templates requires --template-cache-dir")
+        from . import renderer
+        count = renderer.precompile_templates()
+        logger.info(f"Compiled {count} templates into {pre_args.template_cache_dir}")
+        sys.exit()
+
+    if pre_args.daemon:
+        from . import daemon
+        try:
+            daemon.run_daemon(pre_args.daemon)
+        except (OSError, ValueError):
+            logger.critical(f"Could not load daemon configuration from {pre_args.daemon}", exc_info=True)
+            sys.exit(1)
+        sys.exit()
+
+    if pre_args.subscriptions:
+        run_subscriptions(pre_parser, pre_args.subscriptions)
+        sys.exit()
+
+    if pre_args.backfill:
+        run_backfill(pre_parser, pre_args.backfill)
+        sys.exit()
+
+    if pre_args.reprocess:
+        run_reprocess(pre_parser, pre_args.reprocess)
+        sys.exit()
+
+    if pre_args.site_build:
+        run_site_build(pre_parser, pre_args.site_build)
+        sys.exit()
+
+    if pre_args.serve is not None:
+        run_serve(pre_parser, pre_args.serve)
+        sys.exit()
+
     parser = argparse.ArgumentParser(description="sendAFD emails the NWS Area Forecast Discussion for "
                                                  "a chosen area. For more details, see README.md",
                                      prog="sendafd", parents=[pre_parser])
@@ -58,7 +199,9 @@ def main():
                         help="Password used when connecting to the SMTP server."
                         )
     parser.add_argument('region',
-                        help="Three-letter region code for the Area Forecast Discussion."
+                        nargs='*',
+                        help="One or more three-letter region codes for the Area Forecast "
+                             "Discussion. Several codes are fetched concurrently."
                         )
     parser.add_argument('-d', '--dry-run',
                         action='store_true',
@@ -71,6 +214,30 @@ def main():
                         action='store',
                         nargs=1,
                         help="Do not connect to SMTP server, output rendered template to the specified path, without adding email header or doing any email-specific formatting. Default output path: output.html")
+    export = parser.add_mutually_exclusive_group()
+    export.add_argument('--mbox',
+                        metavar='MBOX_FILE',
+                        help="Do not connect to SMTP server, append the rendered emails to the "
+                             "specified mbox file instead.")
+    export.add_argument('--maildir',
+                        metavar='MAILDIR',
+                        help="Do not connect to SMTP server, deliver the rendered emails to the "
+                             "specified Maildir instead.")
+    export.add_argument('--outbox',
+                        metavar='OUTBOX_DIR',
+                        help="Commit the rendered emails to an outbox in the specified directory, "
+                             "and send them from there in the background. Emails that fail to "
+                             "send are retried by later runs.")
+    parser.add_argument('--export-batch-size',
+                        type=int,
+                        default=100,
+                        help="With --mbox or --maildir, number of emails written between syncs "
+                             "to disk. Defaults to 100.")
+    parser.add_argument('--delivery-workers',
+                        type=int,
+                        default=4,
+                        help="With --outbox, number of emails sent at the same time, each over "
+                             "its own SMTP connection. Defaults to 4.")
     parser.add_argument('-i', '--ignore-region-validation',
                         action='store_true',
                         help="Do not validate supplied region code and attempt to fetch AFD from "
@@ -83,6 +250,11 @@ def main():
     parser.add_argument('-p', '--plaintext',
                         action='store_true',
                         help="Send the email in plaintext as formatted by the NWS, without any template.")
+    parser.add_argument('-r', '--regions-file',
+                        action='store',
+                        nargs=1,
+                        help="Read additional region codes from the specified file, one per line. "
+                             "Blank lines and text following '#' are ignored.")
     parser.add_argument('-s', '--sender-address',
                         nargs='?',
                         default="",
@@ -90,76 +262,630 @@ def main():
     parser.add_argument('-t', '--template',
                         nargs='?',
                         default='default_email_template.html',
-                        help="Filename of template to use when rendering email. Searches in \'templates\' subdirectory. Defaults to 'default_email_template.html'")
-    parser.add_argument('-v', '--verbose',
-                        action='store_true',
-                        help="Print debug messages.")
-    parser.add_argument('--version', action='version', version=f'%(prog)s {VERSION}')
+                        help="Filename of template to use when rendering email. Searches in --template-dir directories, then the \'templates\' directory bundled with sendAFD. Defaults to 'default_email_template.html'")
+    parser.add_argument('--workers',
+                        type=int,
+                        default=8,
+                        help="Maximum number of regions fetched from the NWS API at the same time "
+                             "when several regions are supplied. Defaults to 8.")
+    parser.add_argument('--render-cache-dir',
+                        help="Keep rendered templates in the specified directory, so a product "
+                             "rendered again with an unchanged template is not re-rendered. Only "
+                             "the most recently used renders are kept.")
+    parser.add_argument('--cache-db',
+                        help="In monitor mode, keep fetched AFDs in the specified SQLite database "
+                             "instead of a cache_{region}.json file for each region. The database "
+                             "can be shared by several sendAFD processes.")
+    parser.add_argument('--send-if-changed',
+                        action='append',
+                        metavar='SECTION',
+                        help="In monitor mode, only send a new AFD if the named section changed "
+                             "since the last AFD sent for the region, e.g. 'Short Term'. Names "
+                             "match any section starting with them, ignoring case; 'any' matches "
+                             "every section except the header. May be given more than once.")
+    parser.add_argument('--http-timeout',
+                        type=float,
+                        default=apiclient.session_settings['timeout'],
+                        help="Timeout in seconds for each request to the NWS API. Defaults to "
+                             f"{apiclient.session_settings['timeout']}.")
+    parser.add_argument('--http-retries',
+                        type=int,
+                        default=apiclient.session_settings['max_retries'],
+                        help="Number of times a request to the NWS API is retried, with exponential "
+                             "backoff, after a server error or connection failure. Defaults to "
+                             f"{apiclient.session_settings['max_retries']}.")
+    parser.add_argument('--profile',
+                        metavar='PROFILE_DIR',
+                        help="Profile the fetch, parse, render and send stages of the run with "
+                             "cProfile and tracemalloc, writing a .pstats file and the top "
+                             "allocations for each stage to PROFILE_DIR, and print a summary "
+                             "table at the end. Slows the run down.")
 
     args = parser.parse_args()
 
-    # set the logging level according to command line flags(s)
-    if args.verbose:
-        logger.setLevel("DEBUG")
-        logger.info("Log level set to debug")
-    else:
-        logger.setLevel("INFO")
+    # size the connection pool so that every fetch worker can hold a warm connection
+    apiclient.configure_session(
+        timeout=args.http_timeout,
+        max_retries=args.http_retries,
+        pool_maxsize=max(args.workers, apiclient.session_settings['pool_maxsize']))
+
+    regions = list(args.region)
+    if args.regions_file:
+        try:
+            regions.extend(apiclient.read_regions_file(args.regions_file[0]))
+        except OSError:
+            logger.critical(f"Could not read regions file at {args.regions_file[0]}", exc_info=True)
+            sys.exit(1)
+    if not regions:
+        parser.error("at least one region code is required, either as an argument or using "
+                     "-r/--regions-file")
+    if args.send_if_changed and not args.monitor:
+        parser.error("--send-if-changed requires -m/--monitor")
 
+    cache = open_cache_db(args.cache_db)
+    profiler = None
+    if args.profile:
+        from . import profiling
+        profiler = profiling.Profiler(args.profile)
+        profiler.start()
+    run_start = time.perf_counter()
     try:
         if args.monitor:
             logger.info("Starting sendAFD in monitor mode")
         else:
             logger.info("Starting sendAFD")
-        raw_api_response = apiclient.fetch_afd(region=args.region,
-                                               monitor=args.monitor,
-                                               ignore_region_validation=args.ignore_region_validation)
-        if raw_api_response['error'] is not None:
-            logger.critical(f"Error fetching data from NWS API: {raw_api_response['error']}")
-        elif raw_api_response['response'] is None and raw_api_response['error'] is None:
-            logger.info("AFD has not changed, email will not be sent.")
+        if len(regions) == 1:
+            results = {regions[0]: apiclient.fetch_afd(region=regions[0],
+                                                       monitor=args.monitor,
+                                                       ignore_region_validation=args.ignore_region_validation,
+                                                       cache=cache)}
         else:
-            # parse afd into AreaForecastDiscussion object
-            parsed_afd = apiclient.AreaForecastDiscussion(raw_api_response['response'])
-            if args.plaintext:
-                template = None
-            else:
-                template = args.template
-            if args.sender_address:
-                sender_email = args.sender_address
+            results = apiclient.fetch_afds(regions=regions,
+                                           monitor=args.monitor,
+                                           ignore_region_validation=args.ignore_region_validation,
+                                           max_workers=args.workers,
+                                           cache=cache)
+        if args.monitor and any(result['response'] is not None for result in results.values()):
+            from . import changes
+            cache = cache or apiclient.MonitorCache()
+            results = changes.detect_changes(results, cache, args.send_if_changed)
+        if any(result['response'] is not None for result in results.values()) \
+                or (args.outbox and outbox_has_due(args.outbox)):
+            from . import emailclient, renderer
+            if args.render_cache_dir:
+                renderer.configure_render_cache(cache_dir=args.render_cache_dir)
+            if args.mbox or args.maildir:
+                sender_context = open_export_writer(args)
+            elif args.outbox:
+                sender_context = open_delivery_pool(args)
             else:
-                sender_email = args.email_username
-            # TODO: gracefully handle jinja2.exceptions.TemplateNotFound
-            if args.web:
-                rendered_html = renderer.render_web(parsed_afd=parsed_afd,
-                                                    afd_json=raw_api_response['response'],
-                                                    template_path=template)
-                logger.info(f"File output for web enabled, printing html to {args.file}")
-                with open(args.web[0], 'w', encoding='utf-8') as f:
-                    f.write(rendered_html)
-            else:
-                rendered_email = renderer.build_email(afd=parsed_afd,
+                # share one SMTP connection between all regions; it is only opened if an email
+                #  is sent
+                sender_context = emailclient.SMTPSender(smtp_server=args.email_server,
+                                                        smtp_username=args.email_username,
+                                                        smtp_pw=args.email_password)
+        else:
+            # nothing to render or send, so skip loading the template and email modules
+            sender_context = contextlib.nullcontext()
+        with sender_context as sender:
+            for region, raw_api_response in results.items():
+                try:
+                    if process_afd(args, region, raw_api_response, multi_region=len(results) > 1,
+                                   sender=sender) and args.monitor:
+                        from . import changes
+                        changes.record_sent(cache, region, raw_api_response)
+                except Exception:
+                    # one AFD that fails to parse or render does not stop the other regions
+                    logger.exception(f"Unexpected error processing AFD for {region}")
+        logger.info("sendAFD finished")
+    except KeyboardInterrupt:
+        logger.critical("Received keyboard interrupt, exiting!")
+    finally:
+        apiclient.close_session()
+        metrics.registry.observe('run', time.perf_counter() - run_start)
+        metrics.export()
+        if profiler is not None:
+            write_profile(profiler)
+
+
+def write_profile(profiler):
+    """Stop a profiling.Profiler, write its reports and print the summary table"""
+    from . import profiling
+    profiler.stop()
+    try:
+        profiler.write_reports()
+    except OSError:
+        logger.critical(f"Could not write profiling reports to {profiler.output_dir}",
+                        exc_info=True)
+    print(profiling.format_summary(profiler.summary()), end="")
+
+
+def open_export_writer(args: argparse.Namespace):
+    """Return an mbox or Maildir writer for the --mbox or --maildir option, used in place of an
+    SMTP sender"""
+    from . import mailexport
+    if args.maildir:
+        logger.info(f"Export enabled, delivering emails to Maildir at {args.maildir}")
+        return mailexport.open_writer(args.maildir, "maildir", args.export_batch_size)
+    logger.info(f"Export enabled, appending emails to mbox at {args.mbox}")
+    return mailexport.open_writer(args.mbox, "mbox", args.export_batch_size)
+
+
+def outbox_has_due(outbox_dir: str) -> bool:
+    """Return True if the outbox has messages waiting to be sent, so a run with nothing new to
+    send still delivers them"""
+    from . import outbox
+    return bool(outbox.Outbox(outbox_dir).due())
+
+
+def open_delivery_pool(args: argparse.Namespace):
+    """Return a delivery pool for the --outbox option, used in place of an SMTP sender"""
+    from . import emailclient, outbox
+    logger.info(f"Outbox enabled, queueing emails in {args.outbox}")
+
+    def smtp_sender():
+        return emailclient.SMTPSender(smtp_server=args.email_server,
+                                      smtp_username=args.email_username,
+                                      smtp_pw=args.email_password)
+
+    return outbox.DeliveryPool(outbox.Outbox(args.outbox), smtp_sender,
+                               workers=args.delivery_workers)
+
+
+def open_cache_db(cache_db: str):
+    """Return a SQLite monitor cache for the --cache-db path, or None to use JSON cache files"""
+    if not cache_db:
+        return None
+    from . import store
+    return store.SQLiteCache(cache_db)
+
+
+def run_subscriptions(pre_parser: argparse.ArgumentParser, subscriptions_path: str):
+    """Fetch each subscribed region once and email the AFDs to every subscriber"""
+    from . import apiclient, emailclient, subscriptions
+    parser = argparse.ArgumentParser(description="Email AFDs to every recipient in a subscription "
+                                                 "file. For more details, see README.md",
+                                     prog="sendafd",
+                                     parents=[pre_parser])
+    parser.add_argument('email_server',
+                        help="Domain or IP of SMTP server used to send outgoing emails.")
+    parser.add_argument('email_username',
+                        help="Username used when connecting to the SMTP server.")
+    parser.add_argument('email_password',
+                        help="Password used when connecting to the SMTP server.")
+    parser.add_argument('-d', '--dry-run',
+                        action='store_true',
+                        help="Do not connect to SMTP server, just print emails to stdout")
+    export = parser.add_mutually_exclusive_group()
+    export.add_argument('--mbox',
+                        metavar='MBOX_FILE',
+                        help="Do not connect to SMTP server, append the emails to the specified "
+                             "mbox file instead.")
+    export.add_argument('--maildir',
+                        metavar='MAILDIR',
+                        help="Do not connect to SMTP server, deliver the emails to the specified "
+                             "Maildir instead.")
+    export.add_argument('--outbox',
+                        metavar='OUTBOX_DIR',
+                        help="Commit the emails to an outbox in the specified directory, and send "
+                             "them from there in the background.")
+    parser.add_argument('--export-batch-size',
+                        type=int,
+                        default=100,
+                        help="With --mbox or --maildir, number of emails written between syncs "
+                             "to disk. Defaults to 100.")
+    parser.add_argument('--delivery-workers',
+                        type=int,
+                        default=4,
+                        help="With --outbox, number of emails sent at the same time. Defaults to 4.")
+    parser.add_argument('-i', '--ignore-region-validation',
+                        action='store_true',
+                        help="Do not validate region codes and attempt to fetch AFDs from NWS anyway.")
+    parser.add_argument('-m', '--monitor',
+                        action='store_true',
+                        help="Only send emails for regions whose newest fetched AFD has changed.")
+    parser.add_argument('-s', '--sender-address',
+                        nargs='?',
+                        default="",
+                        help="Sender's email address, if different from email_username.")
+    parser.add_argument('--workers',
+                        type=int,
+                        default=8,
+                        help="Maximum number of regions fetched from the NWS API at the same time. "
+                             "Defaults to 8.")
+    parser.add_argument('--cache-db',
+                        help="In monitor mode, keep fetched AFDs in the specified SQLite database "
+                             "instead of a cache_{region}.json file for each region.")
+    parser.add_argument('--send-if-changed',
+                        action='append',
+                        metavar='SECTION',
+                        help="In monitor mode, only send a new AFD if the named section changed "
+                             "since the last AFD sent for the region. May be given more than once.")
+    args = parser.parse_args()
+    if args.send_if_changed and not args.monitor:
+        parser.error("--send-if-changed requires -m/--monitor")
+    try:
+        subscriptions_to_send = subscriptions.load_subscriptions(subscriptions_path)
+    except (OSError, ValueError):
+        logger.critical(f"Could not load subscriptions from {subscriptions_path}", exc_info=True)
+        sys.exit(1)
+    sender_email = args.sender_address or args.email_username
+    apiclient.configure_session(
+        pool_maxsize=max(args.workers, apiclient.session_settings['pool_maxsize']))
+    cache = open_cache_db(args.cache_db)
+    run_start = time.perf_counter()
+    try:
+        results = apiclient.fetch_afds(regions=subscriptions.subscribed_regions(subscriptions_to_send),
+                                       monitor=args.monitor,
+                                       ignore_region_validation=args.ignore_region_validation,
+                                       max_workers=args.workers,
+                                       cache=cache)
+        if args.monitor:
+            from . import changes
+            cache = cache or apiclient.MonitorCache()
+            results = changes.detect_changes(results, cache, args.send_if_changed)
+        # fingerprints of the products sent are only recorded in monitor mode
+        fingerprints_cache = cache if args.monitor else None
+        if args.dry_run:
+            logger.info("Dry run enabled, printing emails to stdout")
+            printed_regions = set()
+            for _, region, email in subscriptions.build_messages(results, subscriptions_to_send,
+                                                                 sender_email):
+                print(email.as_string())
+                printed_regions.add(region)
+            if fingerprints_cache is not None:
+                for region in printed_regions:
+                    changes.record_sent(fingerprints_cache, region, results[region])
+        elif args.mbox or args.maildir:
+            with open_export_writer(args) as writer:
+                subscriptions.deliver(results, subscriptions_to_send, sender_email, writer,
+                                      cache=fingerprints_cache)
+        elif args.outbox:
+            with open_delivery_pool(args) as pool:
+                subscriptions.deliver(results, subscriptions_to_send, sender_email, pool,
+                                      cache=fingerprints_cache)
+        else:
+            with emailclient.SMTPSender(smtp_server=args.email_server,
+                                        smtp_username=args.email_username,
+                                        smtp_pw=args.email_password) as sender:
+                subscriptions.deliver(results, subscriptions_to_send, sender_email, sender,
+                                      cache=fingerprints_cache)
+        logger.info("sendAFD finished")
+    except KeyboardInterrupt:
+        logger.critical("Received keyboard interrupt, exiting!")
+    finally:
+        apiclient.close_session()
+        metrics.registry.observe('run', time.perf_counter() - run_start)
+        metrics.export()
+
+
+def run_backfill(pre_parser: argparse.ArgumentParser, archive_dir: str):
+    """Add every AFD listed for the supplied regions to the archive"""
+    from . import apiclient, archive
+    parser = argparse.ArgumentParser(description="Archive every AFD listed by the NWS API for the "
+                                                 "supplied regions. For more details, see README.md",
+                                     prog="sendafd",
+                                     parents=[pre_parser])
+    parser.add_argument('region',
+                        nargs='*',
+                        help="Region codes to archive.")
+    parser.add_argument('-i', '--ignore-region-validation',
+                        action='store_true',
+                        help="Do not validate region codes and attempt to fetch AFDs from NWS anyway.")
+    parser.add_argument('-r', '--regions-file',
+                        help="Read additional region codes from the specified file, one per line.")
+    parser.add_argument('--workers',
+                        type=int,
+                        default=8,
+                        help="Maximum number of requests made to the NWS API at the same time. "
+                             "Defaults to 8.")
+    args = parser.parse_args()
+    regions = list(args.region)
+    if args.regions_file:
+        try:
+            regions.extend(apiclient.read_regions_file(args.regions_file))
+        except OSError:
+            logger.critical(f"Could not read regions file at {args.regions_file}", exc_info=True)
+            sys.exit(1)
+    if not regions:
+        parser.error("at least one region code is required, either as an argument or using "
+                     "-r/--regions-file")
+    apiclient.configure_session(
+        pool_maxsize=max(args.workers, apiclient.session_settings['pool_maxsize']))
+    run_start = time.perf_counter()
+    try:
+        logger.info(f"Backfilling archive at {archive_dir}")
+        results = archive.backfill(archive.Archive(archive_dir), regions,
+                                   max_workers=args.workers,
+                                   ignore_region_validation=args.ignore_region_validation)
+        for region, result in results.items():
+            if result['error']:
+                logger.error(f"Region {region}: {result['error']}")
+            if result['response'] is not None:
+                logger.info(f"Region {region}: archived {result['response']} new products")
+        logger.info("sendAFD finished")
+    except KeyboardInterrupt:
+        logger.critical("Received keyboard interrupt, exiting!")
+    finally:
+        apiclient.close_session()
+        metrics.registry.observe('run', time.perf_counter() - run_start)
+        metrics.export()
+
+
+def iso_time(value: str):
+    """Argument type for ISO 8601 times, returning a timezone-aware datetime"""
+    from . import archive
+    try:
+        return archive.parse_time(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid ISO 8601 time: '{value}'")
+
+
+def run_reprocess(pre_parser: argparse.ArgumentParser, archive_dir: str):
+    """Parse and render archived AFDs again using a pool of worker processes"""
+    from . import archive, reprocess
+    parser = argparse.ArgumentParser(description="Parse and render every archived AFD again. For "
+                                                 "more details, see README.md",
+                                     prog="sendafd",
+                                     parents=[pre_parser])
+    parser.add_argument('region',
+                        nargs='*',
+                        help="Region codes to reprocess. Defaults to every region in the archive.")
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--jsonl',
+                        metavar='OUTPUT_FILE',
+                        help="Write one JSON object per AFD to the specified file, with its "
+                             "parsed sections and rendered template.")
+    output.add_argument('--html-dir',
+                        metavar='OUTPUT_DIR',
+                        help="Write each rendered AFD to OUTPUT_DIR/{region}/{product_id}.html.")
+    parser.add_argument('-t', '--template',
+                        default='default_email_template.html',
+                        help="Filename of template to render each AFD with. Searches in "
+                             "--template-dir directories, then the bundled 'templates' directory. Defaults to 'default_email_template.html'")
+    parser.add_argument('-w', '--web',
+                        action='store_true',
+                        help="Render as with -w in the default mode, passing afd_json to the "
+                             "template.")
+    parser.add_argument('--parse-only',
+                        action='store_true',
+                        help="Only parse each AFD, without rendering it. Requires --jsonl.")
+    parser.add_argument('--start',
+                        type=iso_time,
+                        help="Only reprocess AFDs issued at or after this ISO 8601 time.")
+    parser.add_argument('--end',
+                        type=iso_time,
+                        help="Only reprocess AFDs issued before this ISO 8601 time.")
+    parser.add_argument('--processes',
+                        type=int,
+                        help="Number of worker processes. Defaults to the number of CPUs.")
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=reprocess.DEFAULT_CHUNK_SIZE,
+                        help="Number of AFDs sent to a worker process at a time. Defaults to "
+                             f"{reprocess.DEFAULT_CHUNK_SIZE}.")
+    args = parser.parse_args()
+    if args.parse_only and args.html_dir:
+        parser.error("--parse-only requires --jsonl")
+    run_start = time.perf_counter()
+    try:
+        logger.info(f"Reprocessing archive at {archive_dir}")
+        reprocess.reprocess(archive.Archive(archive_dir), args.region,
+                            template=None if args.parse_only else args.template,
+                            web=args.web,
+                            jsonl_path=args.jsonl,
+                            output_dir=args.html_dir,
+                            start=args.start,
+                            end=args.end,
+                            processes=args.processes,
+                            chunk_size=max(1, args.chunk_size))
+        logger.info("sendAFD finished")
+    except KeyboardInterrupt:
+        logger.critical("Received keyboard interrupt, exiting!")
+    finally:
+        metrics.registry.observe('run', time.perf_counter() - run_start)
+        metrics.export()
+
+
+def run_serve(pre_parser: argparse.ArgumentParser, port: int):
+    """Serve rendered AFD pages over HTTP until interrupted"""
+    from . import server
+    parser = argparse.ArgumentParser(description="Serve rendered AFDs over HTTP. For more details, "
+                                                 "see README.md",
+                                     prog="sendafd",
+                                     parents=[pre_parser])
+    parser.add_argument('--bind',
+                        default="127.0.0.1",
+                        help="Address to listen on. Defaults to 127.0.0.1.")
+    parser.add_argument('-t', '--template',
+                        default=server.DEFAULT_TEMPLATE,
+                        help="Filename of template used to render each page. Searches in "
+                             f"--template-dir directories, then the bundled 'templates' directory. Defaults to '{server.DEFAULT_TEMPLATE}'")
+    parser.add_argument('--poll-interval',
+                        type=float,
+                        default=server.DEFAULT_POLL_INTERVAL,
+                        help="Seconds to serve a region's page before checking the NWS API for a "
+                             f"newer AFD. Defaults to {server.DEFAULT_POLL_INTERVAL}.")
+    parser.add_argument('-i', '--ignore-region-validation',
+                        action='store_true',
+                        help="Do not validate region codes and attempt to fetch AFDs from NWS anyway.")
+    parser.add_argument('--cache-dir',
+                        default=server.DEFAULT_CACHE_DIR,
+                        help="Directory to keep the cache_{region}.json file of each fetched AFD "
+                             "in. Kept apart from the monitor mode cache, so serving pages never "
+                             "stops an AFD from being emailed. Defaults to "
+                             f"'{server.DEFAULT_CACHE_DIR}'.")
+    parser.add_argument('--cache-db',
+                        help="Keep fetched AFDs in the specified SQLite database instead of "
+                             "--cache-dir. Use a different database from monitor mode.")
+    args = parser.parse_args()
+    pages = server.PageCache(template=args.template,
+                             poll_interval=args.poll_interval,
+                             cache=open_cache_db(args.cache_db),
+                             ignore_region_validation=args.ignore_region_validation,
+                             cache_dir=args.cache_dir)
+    try:
+        server.serve(args.bind, port, pages)
+    except OSError:
+        logger.critical(f"Could not serve on {args.bind}:{port}", exc_info=True)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        logger.info("Received keyboard interrupt, exiting")
+    finally:
+        from . import apiclient
+        apiclient.close_session()
+
+
+def run_site_build(pre_parser: argparse.ArgumentParser, output_dir: str):
+    """Build or update a static site of rendered AFD pages"""
+    from . import apiclient, sitebuild
+    parser = argparse.ArgumentParser(description="Build a static site of rendered AFDs. For more "
+                                                 "details, see README.md",
+                                     prog="sendafd",
+                                     parents=[pre_parser])
+    parser.add_argument('region',
+                        nargs='*',
+                        help="Region codes to build pages for.")
+    parser.add_argument('-r', '--regions-file',
+                        help="Read additional region codes from the specified file, one per line.")
+    parser.add_argument('-t', '--template',
+                        default=sitebuild.DEFAULT_TEMPLATE,
+                        help="Filename of template used to render each region's page. Searches in "
+                             f"--template-dir directories, then the bundled 'templates' directory. Defaults to '{sitebuild.DEFAULT_TEMPLATE}'")
+    parser.add_argument('--index-template',
+                        default=sitebuild.DEFAULT_INDEX_TEMPLATE,
+                        help="Filename of template used to render index.html. Defaults to "
+                             f"'{sitebuild.DEFAULT_INDEX_TEMPLATE}'")
+    parser.add_argument('-i', '--ignore-region-validation',
+                        action='store_true',
+                        help="Do not validate region codes and attempt to fetch AFDs from NWS anyway.")
+    parser.add_argument('--no-fetch',
+                        action='store_true',
+                        help="Do not contact the NWS API; rebuild from cached AFDs only, for "
+                             "example after editing a template.")
+    parser.add_argument('--workers',
+                        type=int,
+                        default=8,
+                        help="Maximum number of regions fetched from the NWS API at the same time. "
+                             "Defaults to 8.")
+    parser.add_argument('--cache-dir',
+                        help="Directory to keep the cache_{region}.json file of each fetched AFD "
+                             "in. Kept apart from the monitor mode cache, so building the site "
+                             "never stops an AFD from being emailed. Defaults to "
+                             f"OUTPUT_DIR/{sitebuild.CACHE_DIRNAME}.")
+    parser.add_argument('--cache-db',
+                        help="Keep fetched AFDs in the specified SQLite database instead of "
+                             "--cache-dir. Use a different database from monitor mode.")
+    args = parser.parse_args()
+    regions = list(args.region)
+    if args.regions_file:
+        try:
+            regions.extend(apiclient.read_regions_file(args.regions_file))
+        except OSError:
+            logger.critical(f"Could not read regions file at {args.regions_file}", exc_info=True)
+            sys.exit(1)
+    if not regions:
+        parser.error("at least one region code is required, either as an argument or using "
+                     "-r/--regions-file")
+    apiclient.configure_session(
+        pool_maxsize=max(args.workers, apiclient.session_settings['pool_maxsize']))
+    cache = open_cache_db(args.cache_db)
+    if cache is None:
+        cache_dir = args.cache_dir or os.path.join(output_dir, sitebuild.CACHE_DIRNAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        cache = apiclient.MonitorCache(cache_dir=cache_dir)
+    run_start = time.perf_counter()
+    try:
+        products = sitebuild.fetch_products(regions, cache, fetch=not args.no_fetch,
+                                            max_workers=args.workers,
+                                            ignore_region_validation=args.ignore_region_validation)
+        result = sitebuild.build_site(output_dir, products, template=args.template,
+                                      index_template=args.index_template)
+        logger.info(f"Site built in {output_dir}: {len(result['written'])} files written, "
+                    f"{len(result['unchanged'])} unchanged")
+    except KeyboardInterrupt:
+        logger.critical("Received keyboard interrupt, exiting!")
+    finally:
+        apiclient.close_session()
+        metrics.registry.observe('run', time.perf_counter() - run_start)
+        metrics.export()
+
+
+def region_output_path(path: str, region: str, multi_region: bool) -> str:
+    """Add the region code to an output file name when output is written for several regions, so
+    that each region gets its own file"""
+    if not multi_region:
+        return path
+    stem, dot, suffix = path.rpartition('.')
+    if not dot or '/' in suffix:
+        return f"{path}_{region.lower()}"
+    return f"{stem}_{region.lower()}.{suffix}"
+
+
+def process_afd(args: argparse.Namespace, region: str, raw_api_response: dict,
+                multi_region: bool = False, sender: "emailclient.SMTPSender" = None) -> bool:
+    """Render and deliver the fetched AFD for a single region according to command line options.
+    Emails are sent using sender if supplied, otherwise over a new SMTP connection. Returns True
+    if the AFD was delivered or written out."""
+    if raw_api_response['error'] is not None:
+        logger.critical(f"Error fetching data from NWS API for {region}: {raw_api_response['error']}")
+    elif raw_api_response['response'] is None and raw_api_response['error'] is None:
+        logger.info(f"AFD for {region} has not changed, email will not be sent.")
+    else:
+        from . import apiclient, emailclient, renderer
+        # parse afd into AreaForecastDiscussion object, unless detecting changes already did
+        parsed_afd = raw_api_response.get('afd')
+        if parsed_afd is None:
+            parsed_afd = apiclient.AreaForecastDiscussion(raw_api_response['response'])
+        if args.plaintext:
+            template = None
+        else:
+            template = args.template
+        if args.sender_address:
+            sender_email = args.sender_address
+        else:
+            sender_email = args.email_username
+        # TODO: gracefully handle jinja2.exceptions.TemplateNotFound
+        if args.web:
+            rendered_html = renderer.render_web(parsed_afd=parsed_afd,
+                                                afd_json=raw_api_response['response'],
+                                                template_path=template,
+                                                changes=raw_api_response.get('changes'))
+            web_path = region_output_path(args.web[0], region, multi_region)
+            logger.info(f"File output for web enabled, printing html to {web_path}")
+            with open(web_path, 'w', encoding='utf-8') as f:
+                f.write(rendered_html)
+            return True
+        else:
+            rendered_email = renderer.build_email(afd=parsed_afd,
                                                   sender_email=sender_email,
                                                   recipient_email=args.recipient,
-                                                  template_path=template
+                                                  template_path=template,
+                                                  changes=raw_api_response.get('changes')
                                                   )
-                if args.dry_run:
-                    logger.info("Dry run enabled, printing email to stdout")
-                    print(rendered_email.as_string())
-                elif args.file:
-                    logger.info(f"File output enabled, printing email to {args.file}")
-                    with open(args.file[0], 'w', encoding='utf-8') as f:
-                            f.write(rendered_email.as_string())
+            if args.dry_run:
+                logger.info("Dry run enabled, printing email to stdout")
+                print(rendered_email.as_string())
+                return True
+            elif args.file:
+                file_path = region_output_path(args.file[0], region, multi_region)
+                logger.info(f"File output enabled, printing email to {file_path}")
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(rendered_email.as_string())
+                return True
+            else:
+                if sender is not None:
+                    email_result = sender.send(rendered_email)
                 else:
                     email_result = emailclient.send_email(smtp_server=args.email_server,
-                                               smtp_username=args.email_username,
-                                               smtp_pw=args.email_password,
-                                               email=rendered_email,
-                                               )
-                    if not email_result:
-                        logger.critical("Failed to send email")
-        logger.info("sendAFD finished")
-    except KeyboardInterrupt:
-        logger.critical("Received keyboard interrupt, exiting!")
+                                                          smtp_username=args.email_username,
+                                                          smtp_pw=args.email_password,
+                                                          email=rendered_email,
+                                                          )
+                if not email_result:
+                    logger.critical(f"Failed to send email for {region}")
+                return bool(email_result)
+    return False
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,94 +3,598 @@ Fetch area forecast discussion text from the National Weather Service API and pa
 https://www.weather.gov/documentation/services-web-api for API docs.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import json
+import os
+import random
 import re
+import threading
+import time
+from typing import NamedTuple
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+from . import metrics, ratelimit
+from .fileutil import write_text_atomic
 
 logger = logging.getLogger(__name__)
 
+API_BASE_URL = "https://api.weather.gov"
+
+# settings used when creating the shared HTTP session, see configure_session()
+session_settings = {
+    'pool_connections': 4,
+    'pool_maxsize': 10,
+    'timeout': 10,
+    'max_retries': 3,
+    'backoff_factor': 0.5,
+    'backoff_max': 30,
+    'user_agent': "sendafd (https://github.com/rouyng/sendafd)",
+}
+_session = None
+_session_lock = threading.Lock()
+
+# request budget shared by every API call, see configure_rate_limit()
+rate_limit_settings = {
+    'rate': 10,
+    'burst': 20,
+    'failure_threshold': 5,
+    'reset_timeout': 300,
+    'max_retry_after': 120,
+}
+_rate_limiter = ratelimit.TokenBucket(rate_limit_settings['rate'], rate_limit_settings['burst'])
+_circuit_breaker = ratelimit.CircuitBreaker(rate_limit_settings['failure_threshold'],
+                                            rate_limit_settings['reset_timeout'])
+
+def configure_session(**settings):
+    """
+    Update the settings used by the shared HTTP session and discard any existing session, so the
+    next API call creates a new one with the updated settings.
+
+    :param pool_connections: Number of per-host connection pools to keep
+    :param pool_maxsize: Maximum number of connections kept open to each host
+    :param timeout: Connect and read timeout in seconds for each request
+    :param max_retries: Number of times a request is retried after a 5xx response or connection error
+    :param backoff_factor: Base delay in seconds for exponential backoff between retries
+    :param backoff_max: Maximum delay in seconds between retries
+    :param user_agent: User-Agent header sent with every request, as requested by the NWS API docs
+    """
+    unknown = set(settings) - set(session_settings)
+    if unknown:
+        raise ValueError(f"Unknown session settings: {', '.join(sorted(unknown))}")
+    session_settings.update(settings)
+    close_session()
+
+def configure_rate_limit(**settings):
+    """
+    Update the request budget shared by every API call, replacing the rate limiter and circuit
+    breaker. Circuits opened under the previous settings are closed.
+
+    :param rate: Average requests per second allowed to the NWS API, or 0 for no limit
+    :param burst: Number of requests that may be sent at once after a quiet period
+    :param failure_threshold: Consecutive failed requests to an endpoint that open its circuit,
+    after which it is not requested again for reset_timeout seconds. 0 disables the breaker.
+    :param reset_timeout: Seconds an open circuit refuses requests before a trial request
+    :param max_retry_after: Longest Retry-After delay, in seconds, that is waited out before
+    retrying a 429 or 503 response. Longer delays fail the request instead.
+    """
+    global _rate_limiter, _circuit_breaker
+    unknown = set(settings) - set(rate_limit_settings)
+    if unknown:
+        raise ValueError(f"Unknown rate limit settings: {', '.join(sorted(unknown))}")
+    rate_limit_settings.update(settings)
+    _rate_limiter = ratelimit.TokenBucket(rate_limit_settings['rate'], rate_limit_settings['burst'])
+    _circuit_breaker = ratelimit.CircuitBreaker(rate_limit_settings['failure_threshold'],
+                                                rate_limit_settings['reset_timeout'])
+
+def get_session() -> requests.Session:
+    """Return the shared HTTP session, creating it on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            logger.debug("Creating HTTP session with pool size %s", session_settings['pool_maxsize'])
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=session_settings['pool_connections'],
+                                  pool_maxsize=session_settings['pool_maxsize'])
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.headers.update({'User-Agent': session_settings['user_agent'],
+                                     'Accept': "application/ld+json"})
+        return _session
+
+def close_session():
+    """Close the shared HTTP session and its pooled connections, if one is open"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+def backoff_delay(attempt: int) -> float:
+    """Return the delay in seconds before retry number `attempt` (starting at 0), using
+    exponential backoff with jitter so that concurrent clients do not retry in lockstep"""
+    ceiling = min(session_settings['backoff_max'],
+                  session_settings['backoff_factor'] * 2 ** attempt)
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+def api_get(url: str, headers: dict = None, endpoint: str = None) -> requests.Response:
+    """
+    Send a GET request through the shared HTTP session, retrying with exponential backoff on 5xx
+    and 429 responses and connection errors. Every attempt waits for the shared rate limiter. A
+    429 or 503 response with a Retry-After header pauses all requests for the requested time
+    before retrying. The response to the last attempt is returned, so callers should still call
+    raise_for_status() on it.
+
+    Requests that still fail after every retry count towards opening the circuit breaker for
+    the endpoint; while it is open, requests to it are refused without contacting the API.
+
+    :param url: URL to request
+    :param headers: Extra request headers
+    :param endpoint: Name the circuit breaker tracks failures under, defaults to url
+    :return: requests.Response from the last attempt
+    :raises ratelimit.CircuitOpenError: if the endpoint's circuit is open
+    :raises requests.ConnectionError, requests.Timeout: if every attempt failed to connect
+    """
+    endpoint = endpoint or url
+    limiter = _rate_limiter
+    breaker = _circuit_breaker
+    if not breaker.allow(endpoint):
+        metrics.increment('http_circuit_open_total')
+        raise ratelimit.CircuitOpenError(f"Not requesting {url}: too many recent failures")
+    session = get_session()
+    max_retries = session_settings['max_retries']
+    # the request's outcome is always recorded, even when it raises an unexpected exception, so a
+    #  trial request through an open circuit never leaves it waiting for an outcome
+    succeeded = False
+    try:
+        for attempt in range(max_retries + 1):
+            if attempt:
+                metrics.increment('http_retries_total')
+            waited = limiter.acquire()
+            if waited:
+                metrics.increment('http_rate_limit_wait_seconds_total', waited)
+            delay = backoff_delay(attempt)
+            try:
+                response = session.get(url, headers=headers, timeout=session_settings['timeout'])
+            except (requests.ConnectionError, requests.Timeout):
+                metrics.increment('http_requests_total', status="error")
+                if attempt == max_retries:
+                    raise
+                logger.warning(f"Connection error requesting {url}, retrying", exc_info=True)
+            else:
+                metrics.increment('http_requests_total', status=response.status_code)
+                metrics.increment('http_bytes_total', len(response.content))
+                if response.status_code < 500 and response.status_code != 429:
+                    succeeded = True
+                    return response
+                if attempt == max_retries:
+                    return response
+                if response.status_code in (429, 503):
+                    retry_after = ratelimit.retry_after_delay(response)
+                    if retry_after is not None:
+                        if retry_after > rate_limit_settings['max_retry_after']:
+                            logger.warning(f"Received HTTP {response.status_code} from {url} "
+                                           f"asking to retry after {retry_after:.0f} seconds, "
+                                           f"giving up")
+                            return response
+                        # the API is asking this client to slow down, so hold back every request
+                        limiter.pause(retry_after)
+                        delay = 0
+                logger.warning(f"Received HTTP {response.status_code} from {url}, retrying")
+            if delay:
+                time.sleep(delay)
+    finally:
+        if succeeded:
+            breaker.record_success(endpoint)
+        else:
+            breaker.record_failure(endpoint)
+
+class ListedProduct(NamedTuple):
+    """An entry in the list of recently issued AFDs for a region"""
+    product_id: str
+    issuance_time: str
+
+
+_json_decoder = json.JSONDecoder()
+_whitespace_regex = re.compile(r"\s*")
+
+
+def decode_json(response: requests.Response):
+    """Decode the JSON body of an API response"""
+    return json.loads(response.content)
+
+def decode_latest_listing(body) -> ListedProduct:
+    """
+    Return the newest product from the body of an AFD product list response. Only the top-level
+    keys up to "@graph" and the first "@graph" entry are decoded, the rest of the list is never
+    parsed.
+
+    :param body: Response body as bytes or str
+    :raises KeyError: if the body has no "@graph" entries or the first entry has no id
+    :raises ValueError: if the body is not valid JSON
+    """
+    text = body.decode('utf-8') if isinstance(body, bytes) else body
+
+    def skip_to(pos: int, token: str) -> int:
+        pos = _whitespace_regex.match(text, pos).end()
+        if not text.startswith(token, pos):
+            raise ValueError(f"Expected {token!r} at offset {pos} of product list")
+        return pos + len(token)
+
+    pos = skip_to(0, "{")
+    while True:
+        pos = _whitespace_regex.match(text, pos).end()
+        if text.startswith("}", pos):
+            raise KeyError('@graph')
+        key, pos = _json_decoder.raw_decode(text, pos)
+        pos = skip_to(pos, ":")
+        pos = _whitespace_regex.match(text, pos).end()
+        if key == "@graph":
+            pos = skip_to(pos, "[")
+            pos = _whitespace_regex.match(text, pos).end()
+            if text.startswith("]", pos):
+                raise KeyError(0)
+            entry, _ = _json_decoder.raw_decode(text, pos)
+            return ListedProduct(entry['id'], entry.get('issuanceTime'))
+        # decode and discard any other top-level value, such as "@context"
+        _, pos = _json_decoder.raw_decode(text, pos)
+        pos = _whitespace_regex.match(text, pos).end()
+        if text.startswith(",", pos):
+            pos += 1
+
 def get_region_codes() -> dict:
     """
     Query the NWS API for a list of valid region codes for area forecast discussion and return as a
     dictionary.
     """
-    endpoint_url = "https://api.weather.gov/products/types/AFD/locations"
-    logger.debug(f"Checking for region codes using NWS API endpoint at {endpoint_url}")
-    api_response = requests.get(endpoint_url)
+    endpoint_url = f"{API_BASE_URL}/products/types/AFD/locations"
+    logger.debug("Checking for region codes using NWS API endpoint at %s", endpoint_url)
+    api_response = api_get(endpoint_url)
     api_response.raise_for_status()
-    codes_with_description = api_response.json()['locations']
+    codes_with_description = decode_json(api_response)['locations']
     if len(codes_with_description) == 0:
         logger.error(f"Request was successful, but zero location codes were received."
                         f"\n Response headers: {api_response.headers}")
         raise ValueError
     else:
         logger.debug("NWS API request appears successful")
-        return api_response.json()['locations']
+        return codes_with_description
+
+class RegionIndex:
+    """
+    Case-insensitive index of AFD region codes and their descriptions, used to validate region
+    codes without a linear scan of the code list.
+    """
+    def __init__(self, codes: dict, source: str = "api"):
+        """
+        :param codes: Dict mapping region code to description, as returned by get_region_codes()
+        :param source: Where the codes were loaded from: "api", "cache" or "bundled"
+        """
+        self.codes = dict(codes)
+        self.source = source
+        self._index = {code.lower(): code for code in self.codes}
+
+    def __contains__(self, code: str) -> bool:
+        return code.lower() in self._index
 
-def print_region_codes(codes: dict):
-    """Print region codes"""
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def items(self):
+        return self.codes.items()
+
+    def canonical(self, code: str) -> str:
+        """Return the region code as spelled by the NWS API, e.g. 'psr' -> 'PSR'"""
+        return self._index[code.lower()]
+
+
+# settings for the region code cache, see load_region_index()
+region_cache_settings = {
+    'cache_path': "cache_region_codes.json",
+    'ttl': 7 * 24 * 60 * 60,
+}
+BUNDLED_REGION_CODES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         "region_codes.json")
+_region_index = None
+_region_index_loaded = 0.0
+_region_index_lock = threading.Lock()
+
+def load_region_index(refresh: bool = False) -> RegionIndex:
+    """
+    Return the index of valid region codes. Codes are kept in memory and in an on-disk cache for
+    region_cache_settings['ttl'] seconds, so in steady state validation needs no request to the
+    NWS API. When the cache has expired the codes are fetched from the API. If the API can not be
+    reached, a stale cache or the list bundled with sendafd is used instead.
+
+    :param refresh: Ignore cached codes and query the NWS API
+    :return: RegionIndex of valid region codes
+    """
+    global _region_index, _region_index_loaded
+    ttl = region_cache_settings['ttl']
+    cache_path = region_cache_settings['cache_path']
+    with _region_index_lock:
+        now = time.time()
+        if not refresh and _region_index is not None and now - _region_index_loaded < ttl:
+            metrics.increment('cache_hits_total', cache="region_codes")
+            return _region_index
+        disk_cache = {}
+        if os.path.exists(cache_path):
+            try:
+                disk_cache = read_afd_cache(cache_path=cache_path)
+            except ValueError:
+                logger.warning(f"Could not parse region code cache at {cache_path}, ignoring")
+        # time from which the in-memory index counts as fresh for the ttl
+        loaded_at = disk_cache.get('fetched', 0)
+        if not refresh and disk_cache.get('locations') and now - loaded_at < ttl:
+            logger.debug("Using region codes cached at %s", cache_path)
+            metrics.increment('cache_hits_total', cache="region_codes")
+            index = RegionIndex(disk_cache['locations'], source="cache")
+        else:
+            metrics.increment('cache_misses_total', cache="region_codes")
+            # fallback lists are also kept for the full ttl, so an unreachable API is not
+            #  queried again on every validation
+            loaded_at = now
+            try:
+                index = RegionIndex(get_region_codes(), source="api")
+            except (requests.RequestException, ValueError, KeyError):
+                logger.warning("Could not fetch region codes from the NWS API, using fallback list",
+                               exc_info=True)
+                if disk_cache.get('locations'):
+                    index = RegionIndex(disk_cache['locations'], source="cache")
+                else:
+                    with open(BUNDLED_REGION_CODES_PATH, 'r', encoding='utf-8') as f:
+                        index = RegionIndex(json.load(f), source="bundled")
+            else:
+                try:
+                    create_afd_cache({'fetched': now, 'locations': index.codes},
+                                     cache_path=cache_path)
+                except OSError:
+                    logger.warning(f"Could not write region code cache at {cache_path}",
+                                   exc_info=True)
+        _region_index = index
+        _region_index_loaded = loaded_at
+        return index
+
+def clear_region_index():
+    """Discard the in-memory region code index, so the next lookup reloads it"""
+    global _region_index, _region_index_loaded
+    with _region_index_lock:
+        _region_index = None
+        _region_index_loaded = 0.0
+
+def print_region_codes(codes: dict = None):
+    """Print region codes, defaulting to the cached region code index"""
+    if codes is None:
+        codes = load_region_index()
     for c, d in codes.items():
         print(c, d)
 
-def fetch_afd(region: str, monitor: bool=False, ignore_region_validation: bool=True) -> dict:
+def fetch_afd(region: str, monitor: bool=False, ignore_region_validation: bool=True,
+              cache=None) -> dict:
     """
     Query the NWS API for the area forecast discussions for the supplied region code, then return
     the API response with the latest AFD.
+
+    :param region: Region code
+    :param monitor: Only fetch the product if it differs from the cached product for the region
+    :param ignore_region_validation: Do not validate the region code
+    :param cache: Cache backend used in monitor mode, such as MonitorCache or
+    store.SQLiteCache. Defaults to a MonitorCache using JSON files in the working directory.
     """
     # check supplied region code is valid by checking against valid codes provided by the NWS API
     region_lc = region.lower()
     if not ignore_region_validation:
         try:
-            valid_codes = get_region_codes()
-            if region_lc not in [code.lower() for code in valid_codes.keys()]:
-                logger.critical(
-                    f"'{region}' is not a valid region code. Please use one of the following:")
-                print_region_codes(valid_codes)
-                return {'response': None, 'error': "Invalid region code"}
-        except requests.HTTPError:
-            logger.exception("HTTP error fetching list of region codes")
-            return {'response': None, 'error': "HTTP error fetching list of region codes"}
-        except ValueError:
+            with metrics.timer('validate_region'):
+                valid_codes = load_region_index()
+        except (OSError, ValueError):
+            logger.exception("Could not load list of region codes")
             return {'response': None, 'error': "Could not validate region code"}
-    logger.debug(f"Getting list of published AFDs for region {region}")
+        if region_lc not in valid_codes:
+            logger.critical(
+                f"'{region}' is not a valid region code. Please use one of the following:")
+            print_region_codes(valid_codes)
+            return {'response': None, 'error': "Invalid region code"}
+    list_url = f"{API_BASE_URL}/products/types/afd/locations/{region_lc}"
+    cached_id = None
+    validators = {}
+    if monitor:
+        if cache is None:
+            cache = MonitorCache()
+        cached_id = cache.last_seen_id(region_lc)
+        # only send conditional requests when there is a cached product to fall back on
+        if cached_id is not None:
+            validators = cache.get_validators(region_lc)
+    logger.debug("Getting list of published AFDs for region %s", region)
     # get the list of recently issued AFDs for the supplied region code
-    afd_list_response = requests.get(f"https://api.weather.gov/products/types/afd/locations/{region_lc}")
     try:
+        with metrics.timer('fetch_product_list'):
+            afd_list_response = api_get(list_url,
+                                        headers=conditional_headers(validators.get(list_url)),
+                                        endpoint=list_url)
         afd_list_response.raise_for_status()
-    except requests.HTTPError:
+    except ratelimit.CircuitOpenError as e:
+        logger.warning(f"Skipping region {region}: {e}")
+        return {'response': None, 'error': "Too many recent errors fetching AFDs for region"}
+    except requests.RequestException:
         logger.exception("HTTP error fetching list of AFD products")
         return {'response': None, 'error': "HTTP error fetching list of AFD products"}
+    if afd_list_response.status_code == 304:
+        logger.debug("List of AFDs for region %s not modified since last poll, ignoring.", region)
+        metrics.increment('cache_hits_total', cache="monitor")
+        return {'response': None, 'error': None}
     try:
         # from the list, grab the product ID of the latest issued AFD
-        logger.debug(f"Returned {len(afd_list_response.json()['@graph'])} AFDs")
-        latest_product_id = afd_list_response.json()['@graph'][0]['id']
-        logger.debug(f"Latest AFD product ID: {latest_product_id}, issued {afd_list_response.json()['@graph'][0]['issuanceTime']}")
-    except KeyError:
+        latest = decode_latest_listing(afd_list_response.content)
+    except (KeyError, ValueError):
         logger.exception("Unexpected API response structure")
         return {'response': None, 'error': "Unexpected API response structure"}
+    latest_product_id = latest.product_id
+    logger.debug("Latest AFD product ID: %s, issued %s", latest_product_id, latest.issuance_time)
+    product_url = f"{API_BASE_URL}/products/{latest_product_id}"
     if monitor:
-        cached_afd = read_afd_cache(cache_path=f"cache_{region_lc}.json")
-        try:
-            cached_id = cached_afd['id']
-        except KeyError:
-            cached_id = None
+        # products never change once issued, so only the list's validators are worth keeping;
+        #  validators stored for older products are dropped here
+        validators = {list_url: response_validators(afd_list_response)}
         if latest_product_id == cached_id:
-            logger.debug(f"Latest product had same id ({latest_product_id}) as cached product ({cached_id}), ignoring.")
+            logger.debug("Latest product had same id (%s) as cached product (%s), ignoring.",
+                         latest_product_id, cached_id)
+            metrics.increment('cache_hits_total', cache="monitor")
+            cache.set_validators(region_lc, validators)
             return {'response': None, 'error': None}
         else:
-            logger.debug(
-                f"Latest product had different id ({latest_product_id}) than cached product ({cached_id}), fetching latest product...")
-    afd_product_response = requests.get(f"https://api.weather.gov/products/{latest_product_id}")
+            metrics.increment('cache_misses_total', cache="monitor")
+            logger.debug("Latest product had different id (%s) than cached product (%s), fetching "
+                         "latest product...", latest_product_id, cached_id)
     try:
+        with metrics.timer('fetch_product'):
+            # product requests count towards the region's circuit breaker
+            # not a conditional request: a product that differs from the cached one is always new
+            afd_product_response = api_get(product_url, endpoint=list_url)
         afd_product_response.raise_for_status()
-        if monitor:
-            create_afd_cache(afd_product_response.json(), cache_path=f"cache_{region_lc}.json")
-        return {'response': afd_product_response.json(), 'error': None}
-    except requests.HTTPError:
+    except ratelimit.CircuitOpenError as e:
+        logger.warning(f"Skipping region {region}: {e}")
+        return {'response': None, 'error': "Too many recent errors fetching AFDs for region"}
+    except requests.RequestException:
         logger.exception("HTTP error fetching AFD product")
         return {'response': None, 'error': "HTTP error fetching AFD product"}
+    try:
+        afd_product = decode_json(afd_product_response)
+    except ValueError:
+        logger.exception("Unexpected API response structure")
+        return {'response': None, 'error': "Unexpected API response structure"}
+    if monitor:
+        cache.set_product(region_lc, afd_product)
+        cache.set_validators(region_lc, validators)
+    return {'response': afd_product, 'error': None}
+
+def conditional_headers(validators: dict = None) -> dict:
+    """
+    Build the If-None-Match and If-Modified-Since headers for a conditional GET from validators
+    previously saved with response_validators().
+
+    :param validators: Dict with optional 'etag' and 'last_modified' keys, or None
+    :return: Dict of request headers, empty if there are no validators
+    """
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+def response_validators(response: requests.Response) -> dict:
+    """Return the ETag and Last-Modified validators sent with an API response"""
+    return {'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')}
+
+def fetch_afds(regions: list,
+               monitor: bool = False,
+               ignore_region_validation: bool = True,
+               max_workers: int = 8,
+               cache=None) -> dict:
+    """
+    Fetch the latest AFD for each of the supplied region codes concurrently, using a bounded pool
+    of worker threads. Region codes are validated once up front rather than once per region.
+    Returns a dictionary mapping each region code to the same result dictionary returned by
+    fetch_afd.
+
+    :param regions: List of region codes to fetch
+    :param monitor: Only fetch products that differ from the cached product for each region
+    :param ignore_region_validation: Do not validate region codes against the NWS API
+    :param max_workers: Maximum number of regions fetched at the same time
+    :param cache: Cache backend used in monitor mode, see fetch_afd
+    :return: Dict mapping region code to {'response': ..., 'error': ...}
+    """
+    # drop duplicate region codes while preserving the order they were supplied in
+    unique_regions = list(dict.fromkeys(r.upper() for r in regions))
+    results = {}
+    if not ignore_region_validation:
+        try:
+            with metrics.timer('validate_region'):
+                valid_codes = load_region_index()
+        except (OSError, ValueError):
+            logger.exception("Could not load list of region codes")
+            return {r: {'response': None, 'error': "Could not validate region code"}
+                    for r in unique_regions}
+        for r in unique_regions:
+            if r not in valid_codes:
+                logger.critical(f"'{r}' is not a valid region code, skipping")
+                results[r] = {'response': None, 'error': "Invalid region code"}
+    to_fetch = [r for r in unique_regions if r not in results]
+    if to_fetch:
+        logger.debug("Fetching AFDs for %s regions using up to %s workers", len(to_fetch), max_workers)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(to_fetch)))) as pool:
+            futures = {r: pool.submit(fetch_afd, region=r, monitor=monitor,
+                                      ignore_region_validation=True, cache=cache)
+                       for r in to_fetch}
+            for r, future in futures.items():
+                try:
+                    results[r] = future.result()
+                except Exception:
+                    # keep one misbehaving region from taking down the rest of the batch
+                    logger.exception(f"Unexpected error fetching AFD for region {r}")
+                    results[r] = {'response': None, 'error': "Unexpected error fetching AFD"}
+    # return results in the same order the regions were supplied
+    return {r: results[r] for r in unique_regions}
+
+def fetch_afd_list(region: str) -> dict:
+    """
+    Query the NWS API for the list of recently issued AFDs for the supplied region code. Each
+    entry in the list has at least the product's 'id' and 'issuanceTime', but not its text.
+
+    :param region: Region code
+    :return: {'response': list of product entries, newest first, 'error': ...}
+    """
+    list_url = f"{API_BASE_URL}/products/types/afd/locations/{region.lower()}"
+    try:
+        with metrics.timer('fetch_product_list'):
+            afd_list_response = api_get(list_url)
+        afd_list_response.raise_for_status()
+        return {'response': decode_json(afd_list_response)['@graph'], 'error': None}
+    except requests.RequestException:
+        logger.exception("HTTP error fetching list of AFD products")
+        return {'response': None, 'error': "HTTP error fetching list of AFD products"}
+    except (KeyError, ValueError):
+        logger.exception("Unexpected API response structure")
+        return {'response': None, 'error': "Unexpected API response structure"}
+
+def fetch_product(product_id: str) -> dict:
+    """
+    Query the NWS API for a single product by its product id.
+
+    :param product_id: Product id, as listed by fetch_afd_list
+    :return: {'response': product, 'error': ...}
+    """
+    try:
+        with metrics.timer('fetch_product'):
+            afd_product_response = api_get(f"{API_BASE_URL}/products/{product_id}")
+        afd_product_response.raise_for_status()
+        return {'response': decode_json(afd_product_response), 'error': None}
+    except requests.RequestException:
+        logger.exception(f"HTTP error fetching AFD product {product_id}")
+        return {'response': None, 'error': "HTTP error fetching AFD product"}
+    except ValueError:
+        logger.exception("Unexpected API response structure")
+        return {'response': None, 'error': "Unexpected API response structure"}
+
+def read_regions_file(path: str) -> list:
+    """
+    Read a list of region codes from a text file, one code per line. Blank lines and anything
+    following a '#' are ignored.
+
+    :param path: Path to the regions file
+    :return: List of region codes
+    """
+    regions = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            code = line.split('#', 1)[0].strip()
+            if code:
+                regions.append(code)
+    return regions
 
 def create_afd_cache(afd_raw: dict, cache_path: str = "cache.json"):
     """
@@ -100,9 +604,8 @@ def create_afd_cache(afd_raw: dict, cache_path: str = "cache.json"):
     :param cache_path:
     :return:
     """
-    logger.debug(f"Writing cache file at {cache_path}")
-    with open(cache_path, 'w', encoding='utf-8') as f:
-        json.dump(afd_raw, f, ensure_ascii=False, indent=4)
+    logger.debug("Writing cache file at %s", cache_path)
+    write_json_atomic(afd_raw, cache_path)
 
 def read_afd_cache(cache_path: str = "cache.json") -> dict:
     """
@@ -111,21 +614,182 @@ def read_afd_cache(cache_path: str = "cache.json") -> dict:
     :param cache_path: Path to cache file, defaults to "cache.json"
     :return: Dict containing AFD product
     """
-    logger.debug(f"Reading cache file at {cache_path}")
+    logger.debug("Reading cache file at %s", cache_path)
     try:
         with open(cache_path, 'r', encoding='utf-8') as f:
             cache_dict = json.load(f)
     except FileNotFoundError:
         logger.warning(f"Cache file not found at {cache_path}")
         cache_dict = {}
+    except ValueError:
+        logger.warning(f"Could not parse cache file at {cache_path}, ignoring")
+        cache_dict = {}
     return cache_dict
 
+def write_json_atomic(data, path: str):
+    """Serialize data as JSON and write it to path atomically, see fileutil.write_text_atomic"""
+    write_text_atomic(json.dumps(data, ensure_ascii=False, indent=4), path)
+
+
+def write_validators(validators: dict, cache_path: str = "cache_validators.json"):
+    """
+    Write the HTTP cache validators (ETag/Last-Modified) for each API endpoint URL to a JSON file
+    stored next to the AFD cache.
+
+    :param validators: Dict mapping endpoint URL to validators from response_validators()
+    :param cache_path: Path to validators file
+    """
+    logger.debug("Writing validators file at %s", cache_path)
+    write_json_atomic(validators, cache_path)
+
+def read_validators(cache_path: str = "cache_validators.json") -> dict:
+    """
+    Read the HTTP cache validators written by write_validators().
+
+    :param cache_path: Path to validators file
+    :return: Dict mapping endpoint URL to validators, empty if the file does not exist or is invalid
+    """
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.debug("Validators file not found at %s", cache_path)
+    except ValueError:
+        logger.warning(f"Could not parse validators file at {cache_path}, ignoring")
+    return {}
+
+
+class MonitorCache:
+    """
+    Cache of the last fetched AFD product and HTTP validators for each region, used by monitor
+    mode. Entries are stored as cache_{region}.json and cache_{region}_validators.json files in
+    cache_dir. With in_memory=True, entries are also kept in memory after they are first read and
+    written through to disk on every update, so a long-running process only reads each file once.
+
+    Section fingerprints of the last product sent for each region, used by changes.py, are stored
+    as cache_{region}_sections.json.
+
+    Other cache backends, such as store.SQLiteCache, provide the same last_seen_id, get_product,
+    set_product, get_validators, set_validators, get_fingerprints and set_fingerprints methods.
+    """
+    def __init__(self, cache_dir: str = ".", in_memory: bool = False):
+        self.cache_dir = cache_dir
+        self.in_memory = in_memory
+        self._products = {}
+        self._validators = {}
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def product_path(self, region: str) -> str:
+        return os.path.join(self.cache_dir, f"cache_{region.lower()}.json")
+
+    def validators_path(self, region: str) -> str:
+        return os.path.join(self.cache_dir, f"cache_{region.lower()}_validators.json")
+
+    def fingerprints_path(self, region: str) -> str:
+        return os.path.join(self.cache_dir, f"cache_{region.lower()}_sections.json")
+
+    def last_seen_id(self, region: str):
+        """Return the product id of the cached AFD for the region, or None"""
+        return self.get_product(region).get('id')
+
+    def get_product(self, region: str) -> dict:
+        """Return the cached AFD product for the region, or an empty dict"""
+        region = region.lower()
+        with self._lock:
+            if region in self._products:
+                return self._products[region]
+        product = read_afd_cache(cache_path=self.product_path(region))
+        if self.in_memory:
+            with self._lock:
+                self._products.setdefault(region, product)
+        return product
+
+    def set_product(self, region: str, product: dict):
+        region = region.lower()
+        create_afd_cache(product, cache_path=self.product_path(region))
+        if self.in_memory:
+            with self._lock:
+                self._products[region] = product
+
+    def get_validators(self, region: str) -> dict:
+        """Return a copy of the cached validators for the region, keyed by endpoint URL"""
+        region = region.lower()
+        with self._lock:
+            if region in self._validators:
+                return dict(self._validators[region])
+        validators = read_validators(cache_path=self.validators_path(region))
+        if self.in_memory:
+            with self._lock:
+                self._validators.setdefault(region, validators)
+        return dict(validators)
+
+    def set_validators(self, region: str, validators: dict):
+        region = region.lower()
+        write_validators(validators, cache_path=self.validators_path(region))
+        if self.in_memory:
+            with self._lock:
+                self._validators[region] = dict(validators)
+
+    def get_fingerprints(self, region: str) -> dict:
+        """Return the stored section fingerprints for the region, as {'product_id', 'sections'},
+        or an empty dict"""
+        region = region.lower()
+        with self._lock:
+            if region in self._fingerprints:
+                return self._fingerprints[region]
+        path = self.fingerprints_path(region)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                fingerprints = json.load(f)
+        except FileNotFoundError:
+            fingerprints = {}
+        except ValueError:
+            logger.warning(f"Could not parse section fingerprints file at {path}, ignoring")
+            fingerprints = {}
+        if self.in_memory:
+            with self._lock:
+                self._fingerprints.setdefault(region, fingerprints)
+        return fingerprints
+
+    def set_fingerprints(self, region: str, product_id: str, sections: dict):
+        """Store the section fingerprints of the product last sent for the region"""
+        region = region.lower()
+        fingerprints = {'product_id': product_id, 'sections': sections}
+        write_json_atomic(fingerprints, self.fingerprints_path(region))
+        if self.in_memory:
+            with self._lock:
+                self._fingerprints[region] = fingerprints
+
+
+def strip_span(text: str, start: int, end: int) -> tuple:
+    """Return the (start, end) offsets of text[start:end] with surrounding whitespace removed,
+    without copying the text"""
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
 
 class AreaForecastDiscussion:
     """
     Take the raw AFD product returned by the NWS API and parse the metadata and product body text
     into an object ready to be consumed by the renderer.
+
+    To keep many parsed products in memory cheaply, cleaned_text and the sections list are only
+    built when first accessed, and sections and subsections store offsets into cleaned_text
+    rather than copies of their text.
     """
+    __slots__ = ('product_id', 'issuing_office', 'issuance_time', 'raw_text', '_cleaned_text',
+                 '_sections')
+    # a single scan with this regex finds every "&&" section boundary and every header like
+    #  ".SYNOPSIS..." that starts a paragraph (or directly follows a "&&")
+    token_regex = re.compile(r"(?P<boundary>&&)|(?:^|(?<=&&))[ \t]*\.(?P<header>\S[^\n]*?)\.\.\.",
+                             re.MULTILINE)
+    # runs of layout whitespace inside a paragraph that are collapsed by clean_newlines
+    layout_whitespace_regex = re.compile(r"[ \n]{2}|\n")
+
     def __init__(self, raw_afd: dict):
         """
 
@@ -136,80 +800,175 @@ class AreaForecastDiscussion:
         self.issuing_office = raw_afd['issuingOffice']
         self.issuance_time = datetime.strptime(raw_afd['issuanceTime'], "%Y-%m-%dT%H:%M:%S%z")
         self.raw_text = raw_afd['productText']
-        self._unnamed_counter = 1
-        # remove extra newlines
-        self.cleaned_text = self.clean_newlines(self.raw_text)
-        # separate out sections using '&&' to demarcate
-        raw_sections = [s.strip() for s in self.cleaned_text.split("&&")]
-        # parse header and footer sections first to preserve ordering
-        self.sections = [self.Section(raw_sections.pop(0), "header"),
-                         self.Section(raw_sections.pop(), "footer")]
-        # parse the rest of the sections, putting them in order between header and footer
-        for s in raw_sections:
-            self.sections.insert(len(self.sections) - 1, self.Section(s))
-        # initialize named sections from section list
-        self.header = self.sections[0].body
-        self.footer = self.sections[-1].body
+        self._cleaned_text = None
+        self._sections = None
+
+    @property
+    def cleaned_text(self) -> str:
+        """Product text with layout newlines removed, see clean_newlines"""
+        if self._cleaned_text is None:
+            self._cleaned_text = self.clean_newlines(self.raw_text)
+        return self._cleaned_text
+
+    @property
+    def sections(self) -> list:
+        """List of Section objects, the first named "header" and the last "footer"."""
+        if self._sections is None:
+            with metrics.timer('parse'):
+                self._sections = self.parse_sections(self.cleaned_text)
+        return self._sections
+
+    @property
+    def header(self) -> str:
+        return self.sections[0].body
+
+    @property
+    def footer(self) -> str:
+        return self.sections[-1].body
+
+    @classmethod
+    def tokenize(cls, text: str, start: int = 0, end: int = None) -> list:
+        """
+        Scan text[start:end] once and return a list of sections, each a tuple of
+        (start, end, headers) where start and end are the offsets of the section between "&&"
+        boundaries and headers is a list of (start, end, name) tuples for each header found in
+        that section. All offsets are into text.
+        """
+        if end is None:
+            end = len(text)
+        sections = []
+        section_start = start
+        headers = []
+        for match in cls.token_regex.finditer(text, start, end):
+            if match.group('boundary'):
+                sections.append((section_start, match.start(), headers))
+                section_start = match.end()
+                headers = []
+            else:
+                # the header starts at its leading "." rather than at any indentation before it
+                headers.append((match.start('header') - 1, match.end(), match.group('header')))
+        sections.append((section_start, end, headers))
+        return sections
+
+    @classmethod
+    def parse_sections(cls, text: str) -> list:
+        """Split cleaned AFD text into Section objects, using offsets from a single scan of the
+        text. The first section is named "header" and the last "footer"."""
+        spans = cls.tokenize(text)
+        sections = []
+        for n, (start, end, headers) in enumerate(spans):
+            if n == 0:
+                name = "header"
+            elif n == len(spans) - 1:
+                name = "footer"
+            else:
+                name = None
+            sections.append(cls.Section(text, name, headers, start, end))
+        if len(sections) == 1:
+            # products without any "&&" have no footer section
+            sections.append(cls.Section("", "footer", []))
+        return sections
+
+    @staticmethod
+    def header_name(raw_name: str) -> str:
+        """Format a header like '.SHORT TERM (TDY-WED)...' as 'Short Term (Tdy-Wed)'"""
+        return raw_name.strip(". ").title()
 
 
     class Section:
-        section_header_regex = re.compile("\.(\S[^\\n]*?)\.\.\.")
-        def __init__(self, raw_section: str, name: str=None):
-            # keep the raw section text for debugging purposes, even though it probably won't be
-            #  used to generate emails
-            self.raw_section = raw_section
+        __slots__ = ('name', 'subsections', '_text', '_start', '_end', '_body_start',
+                     '_body_end', '_body')
+
+        def __init__(self, text: str, name: str=None, headers: list=None, start: int=0,
+                     end: int=None):
+            """
+            :param text: Text containing the section, usually the whole cleaned AFD text
+            :param name: Name used for sections without a header, such as "header" and "footer"
+            :param headers: List of (start, end, name) tuples for each header in the section, as
+            found by AreaForecastDiscussion.tokenize. The section is scanned if not supplied.
+            :param start: Offset in text where the section starts
+            :param end: Offset in text where the section ends, defaults to the end of text
+            """
+            if end is None:
+                end = len(text)
+            if headers is None:
+                headers = [header for _, _, section_headers in
+                           AreaForecastDiscussion.tokenize(text, start, end)
+                           for header in section_headers]
+            self._text = text
+            self._start, self._end = strip_span(text, start, end)
+            self._body = None
+            self._body_start = self._start
             if name is not None:
                 # this case is used for headers and footers, where there is no section header
                 #  containing a name.
-                self.name =  name
-                self.body = self.raw_section.strip()
+                self.name = name
+            elif headers and headers[0][0] == self._start:
+                self.name = AreaForecastDiscussion.header_name(headers[0][2])
+                self._body_start = headers[0][1]
+                headers = headers[1:]
             else:
-                section_header_match = re.match(self.section_header_regex, self.raw_section)
-                if section_header_match:
-                    self.name = section_header_match[1].title().strip()
-                    headerless_body = self.raw_section.removeprefix(section_header_match[0])
-                    self.body = headerless_body.strip()
-                else:
-                    self.name = 'unnamed'
-                    self.body = self.raw_section.strip()
+                self.name = 'unnamed'
+            self._body_end = headers[0][0] if headers else self._end
             self.subsections: list = []
-            subsection_match = re.search(self.section_header_regex, self.body)
-            if subsection_match:
-                subsections_raw = self.body[subsection_match.start():]
-                self.body = self.body[:subsection_match.start()]
-                ungrouped_header_regex = re.compile("\..*?\.\.\.")
-                subsection_match = re.findall(ungrouped_header_regex, subsections_raw)
-                for n, match in enumerate(subsection_match):
-                    subsection_start = subsections_raw.find(match)
-                    try:
-                        subsection_end = subsections_raw.find(subsection_match[n+1])
-                        self.subsections.append(
-                            self.Subsection(subsections_raw[subsection_start:subsection_end]))
-                    except IndexError:
-                        self.subsections.append(self.Subsection(subsections_raw[subsection_start:]))
+            for n, (h_start, h_end, h_name) in enumerate(headers):
+                h_next = headers[n + 1][0] if n + 1 < len(headers) else self._end
+                self.subsections.append(self.Subsection(text, h_name, h_start, h_next, h_end))
+
+        @property
+        def raw_section(self) -> str:
+            """Section text, including any header and subsections"""
+            return self._text[self._start:self._end]
+
+        @property
+        def body(self) -> str:
+            """Section text, with section header and any subsections removed"""
+            if self._body is None:
+                self._body = self._text[self._body_start:self._body_end].strip()
+            return self._body
 
         class Subsection:
-            # (?!(\.)\1{1,2})\.(\S[^\\n]*?)\.\.\.
-            subsection_header_regex = re.compile("\.(\S[^\\n]*?)\.\.\.")
-            def __init__(self, raw_subsection: str):
-                self.raw_subsection = raw_subsection
-                subsection_header_match = re.match(self.subsection_header_regex, self.raw_subsection)
-                self.name = subsection_header_match[1].title().strip()
-                headerless_body = self.raw_subsection.removeprefix(subsection_header_match[0])
-                self.body = headerless_body.strip()
+            __slots__ = ('name', '_text', '_start', '_end', '_body_start', '_body')
+            subsection_header_regex = re.compile(r"\.(\S[^\n]*?)\.\.\.")
 
-    @staticmethod
-    def clean_newlines(raw_text: str) -> str:
-        """Parse raw NWS AFD product text, removing newline characters used for layout
-        purposes in the original text and replacing double newlines used for paragraph
-        breaks with single newlines"""
-        paragraphs = raw_text.split("\n\n")
-        cleaned_paragraphs = []
-        for p in paragraphs:
-            removed_newlines = p.replace("\n", " ")
-            removed_doublespace = removed_newlines.replace("  ", " ")
-            cleaned_paragraphs.append(removed_doublespace.strip())
-        return "\n".join(cleaned_paragraphs)
+            def __init__(self, text: str, name: str=None, start: int=0, end: int=None,
+                         body_start: int=None):
+                """
+                :param text: Text containing the subsection, usually the whole cleaned AFD text
+                :param name: Unformatted header name, found by matching the text if not supplied
+                :param start: Offset in text where the subsection header starts
+                :param end: Offset in text where the subsection ends, defaults to the end of text
+                :param body_start: Offset in text of the end of the header
+                """
+                if end is None:
+                    end = len(text)
+                self._text = text
+                self._start, self._end = strip_span(text, start, end)
+                if name is None:
+                    subsection_header_match = self.subsection_header_regex.match(text, self._start,
+                                                                                 self._end)
+                    name = subsection_header_match[1]
+                    body_start = subsection_header_match.end()
+                self.name = AreaForecastDiscussion.header_name(name)
+                self._body_start = body_start
+                self._body = None
 
+            @property
+            def raw_subsection(self) -> str:
+                """Subsection text, including the header"""
+                return self._text[self._start:self._end]
 
+            @property
+            def body(self) -> str:
+                """Subsection text, with the header removed"""
+                if self._body is None:
+                    self._body = self._text[self._body_start:self._end].strip()
+                return self._body
 
+    @classmethod
+    def clean_newlines(cls, raw_text: str) -> str:
+        """Parse raw NWS AFD product text, removing newline characters used for layout
+        purposes in the original text and replacing double newlines used for paragraph
+        breaks with single newlines"""
+        return "\n".join(cls.layout_whitespace_regex.sub(" ", p).strip()
+                         for p in raw_text.split("\n\n"))
@@ -0,0 +1,221 @@
+"""
+Historical archive of AFD products. The NWS API lists dozens of recent products for each region,
+of which fetch_afd only ever looks at the newest; backfill() fetches all of them so they can be
+kept for later analysis.
+
+Products are stored under the archive directory as one gzip compressed JSON lines file per
+region per month of issuance, e.g. archive/psr/2023-02.jsonl.gz. New products are appended to
+the end of a file as a new gzip member, so existing data is never rewritten. Each region
+directory also holds an uncompressed index.tsv listing the id and issuance time of every stored
+product, which is used to skip products that are already archived. Appends to a region hold an
+exclusive lock on the region's lock file, so several processes can archive the same region.
+"""
+
+import gzip
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from . import apiclient
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = "index.tsv"
+LOCK_FILENAME = "lock"
+
+
+def parse_time(value) -> datetime:
+    """
+    Convert an ISO 8601 string or datetime to a timezone-aware datetime, treating naive values
+    as UTC.
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def month_key(issuance_time) -> str:
+    """Return the 'YYYY-MM' partition holding a product issued at the supplied time"""
+    return parse_time(issuance_time).astimezone(timezone.utc).strftime("%Y-%m")
+
+
+class Archive:
+    """
+    Compressed, append-only store of AFD products partitioned by region and month. Products are
+    read back one at a time with query(), so the archive never needs to fit in memory.
+    """
+    def __init__(self, archive_dir: str = "archive"):
+        """
+        :param archive_dir: Directory holding the archive, created on first write
+        """
+        self.archive_dir = archive_dir
+
+    def region_dir(self, region: str) -> str:
+        return os.path.join(self.archive_dir, region.lower())
+
+    def partition_path(self, region: str, month: str) -> str:
+        return os.path.join(self.region_dir(region), f"{month}.jsonl.gz")
+
+    def regions(self) -> list:
+        """Return the codes of every region with archived products"""
+        try:
+            return sorted(entry.upper() for entry in os.listdir(self.archive_dir)
+                          if os.path.isdir(os.path.join(self.archive_dir, entry)))
+        except FileNotFoundError:
+            return []
+
+    def stored_ids(self, region: str) -> set:
+        """Return the product ids already archived for the region"""
+        try:
+            with open(os.path.join(self.region_dir(region), INDEX_FILENAME), 'r',
+                      encoding='utf-8') as f:
+                return {line.split("\t", 1)[0] for line in f if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    @contextmanager
+    def locked(self, region: str):
+        """Context manager holding an exclusive lock on the region's archive, where file locking
+        is supported"""
+        os.makedirs(self.region_dir(region), exist_ok=True)
+        with open(os.path.join(self.region_dir(region), LOCK_FILENAME), 'a') as lock_file:
+            try:
+                import fcntl
+            except ImportError:
+                yield
+                return
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def append(self, region: str, products: list) -> int:
+        """
+        Append products to the region's archive, skipping any whose id is already stored.
+
+        :param region: Region code
+        :param products: List of AFD products, as returned by apiclient.fetch_product
+        :return: Number of products written
+        """
+        with self.locked(region):
+            # read inside the lock, so products archived by another process are skipped
+            stored = self.stored_ids(region)
+            by_month = {}
+            for product in products:
+                if product['id'] in stored:
+                    continue
+                stored.add(product['id'])
+                by_month.setdefault(month_key(product['issuanceTime']), []).append(product)
+            if not by_month:
+                return 0
+            for month, month_products in sorted(by_month.items()):
+                # each append adds a complete gzip member, which gzip readers treat as one stream
+                with gzip.open(self.partition_path(region, month), 'at', encoding='utf-8') as f:
+                    for product in month_products:
+                        f.write(json.dumps(product, ensure_ascii=False) + "\n")
+            # the index is written last, so a product is only ever skipped once its data is on
+            #  disk
+            with open(os.path.join(self.region_dir(region), INDEX_FILENAME), 'a',
+                      encoding='utf-8') as f:
+                for month_products in by_month.values():
+                    for product in month_products:
+                        f.write(f"{product['id']}\t{product['issuanceTime']}\n")
+        written = sum(len(month_products) for month_products in by_month.values())
+        logger.debug("Archived %s products for region %s", written, region)
+        return written
+
+    def query(self, region: str, start=None, end=None):
+        """
+        Yield archived products for a region issued at or after start and before end, oldest
+        partition first. Only the monthly files overlapping the range are opened, and products
+        are decoded one line at a time.
+
+        :param region: Region code
+        :param start: Earliest issuance time, as a datetime or ISO 8601 string, or None
+        :param end: Issuance time to stop before, as a datetime or ISO 8601 string, or None
+        """
+        start = parse_time(start) if start is not None else None
+        end = parse_time(end) if end is not None else None
+        try:
+            filenames = sorted(name for name in os.listdir(self.region_dir(region))
+                               if name.endswith(".jsonl.gz"))
+        except FileNotFoundError:
+            return
+        first_month = month_key(start) if start is not None else None
+        last_month = month_key(end) if end is not None else None
+        for filename in filenames:
+            month = filename[:-len(".jsonl.gz")]
+            if (first_month and month < first_month) or (last_month and month > last_month):
+                continue
+            with gzip.open(os.path.join(self.region_dir(region), filename), 'rt',
+                           encoding='utf-8') as f:
+                for line in f:
+                    product = json.loads(line)
+                    issued = parse_time(product['issuanceTime'])
+                    if (start is None or issued >= start) and (end is None or issued < end):
+                        yield product
+
+
+def backfill(archive: Archive, regions: list, max_workers: int = 8,
+             ignore_region_validation: bool = True) -> dict:
+    """
+    Fetch every product listed by the NWS API for each region that is not already in the
+    archive, and append them to it. Product lists and products are fetched concurrently using a
+    bounded pool of worker threads; products are written by the calling thread only.
+
+    :param archive: Archive to add products to
+    :param regions: List of region codes
+    :param max_workers: Maximum number of requests made at the same time
+    :param ignore_region_validation: Do not validate region codes against the NWS API
+    :return: Dict mapping region code to {'response': number of products added, 'error': ...}
+    """
+    unique_regions = list(dict.fromkeys(r.upper() for r in regions))
+    results = {}
+    if not ignore_region_validation:
+        try:
+            valid_codes = apiclient.load_region_index()
+        except (OSError, ValueError):
+            logger.exception("Could not load list of region codes")
+            return {r: {'response': None, 'error': "Could not validate region code"}
+                    for r in unique_regions}
+        for r in unique_regions:
+            if r not in valid_codes:
+                logger.critical(f"'{r}' is not a valid region code, skipping")
+                results[r] = {'response': None, 'error': "Invalid region code"}
+    to_fetch = [r for r in unique_regions if r not in results]
+    if not to_fetch:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        list_futures = {r: pool.submit(apiclient.fetch_afd_list, r) for r in to_fetch}
+        product_futures = {}
+        pending = {}
+        for r, future in list_futures.items():
+            listed = future.result()
+            if listed['error']:
+                results[r] = listed
+                continue
+            stored = archive.stored_ids(r)
+            missing = [entry['id'] for entry in listed['response'] if entry['id'] not in stored]
+            logger.info(f"Region {r}: {len(listed['response'])} products listed, "
+                        f"{len(missing)} not yet archived")
+            for product_id in missing:
+                product_futures[pool.submit(apiclient.fetch_product, product_id)] = r
+            results[r] = {'response': 0, 'error': None}
+            pending[r] = len(missing)
+        # write each region as soon as all of its products have arrived, so only the products
+        # of regions still being fetched are held in memory
+        fetched = {r: [] for r in pending}
+        for future in as_completed(product_futures):
+            r = product_futures.pop(future)
+            result = future.result()
+            if result['error']:
+                results[r]['error'] = result['error']
+            else:
+                fetched[r].append(result['response'])
+            pending[r] -= 1
+            if pending[r] == 0:
+                results[r]['response'] = archive.append(r, fetched.pop(r))
+    return {r: results[r] for r in unique_regions}
@@ -0,0 +1,143 @@
+"""
+Section-level change detection for monitor mode. NWS offices often reissue an AFD where only the
+header timestamp or a single section, such as the aviation forecast, has changed. Every section
+and subsection of a product is fingerprinted with a hash of its name and body, and the
+fingerprints of the last product sent for each region are kept in the monitor cache. Comparing
+a new product against them gives a summary of what changed, which is passed to templates as
+`changes`, and lets products be skipped before rendering when none of a chosen set of sections
+changed.
+"""
+
+import hashlib
+import logging
+
+from . import apiclient, metrics
+
+logger = logging.getLogger(__name__)
+
+# selects every section except the header, whose issuance timestamp changes with every product
+ANY_SECTION = "any"
+
+
+def section_fingerprints(afd) -> dict:
+    """
+    Return a dict mapping the name of each section and subsection of a parsed AFD to a hash of
+    its name and body, in the order they appear. Repeated names are numbered, e.g. "Unnamed (2)".
+
+    :param afd: apiclient.AreaForecastDiscussion
+    """
+    fingerprints = {}
+    for section in afd.sections:
+        parts = [(section.name, section.body)]
+        parts.extend((subsection.name, subsection.body) for subsection in section.subsections)
+        for name, body in parts:
+            key = name
+            n = 2
+            while key in fingerprints:
+                key = f"{name} ({n})"
+                n += 1
+            fingerprints[key] = hashlib.sha256(f"{name}\n{body}".encode('utf-8')).hexdigest()
+    return fingerprints
+
+
+def summarize(previous: dict, current: dict) -> dict:
+    """
+    Compare the fingerprints of two products.
+
+    :param previous: Stored fingerprints of the last product sent, as {'product_id', 'sections'},
+    or an empty dict if there is none
+    :param current: Fingerprints of the new product, from section_fingerprints
+    :return: Dict with the 'previous_product_id' and lists of the 'changed', 'added', 'removed'
+    and 'unchanged' section names, in the order the sections appear
+    """
+    previous_sections = previous.get('sections', {})
+    summary = {'previous_product_id': previous.get('product_id'),
+               'changed': [], 'added': [], 'unchanged': [],
+               'removed': [name for name in previous_sections if name not in current]}
+    for name, digest in current.items():
+        if name not in previous_sections:
+            summary['added'].append(name)
+        elif previous_sections[name] != digest:
+            summary['changed'].append(name)
+        else:
+            summary['unchanged'].append(name)
+    return summary
+
+
+def selected_changed(summary: dict, sections: list) -> bool:
+    """
+    Return True if any of the selected sections was changed, added or removed. A section is
+    selected if its name starts with one of the supplied names, ignoring case, so "aviation"
+    selects "Aviation /03Z Monday Through Friday/". The name "any" selects every section except
+    the header.
+    """
+    differing = summary['changed'] + summary['added'] + summary['removed']
+    for selected in sections:
+        selected = selected.lower()
+        for name in differing:
+            if selected == ANY_SECTION:
+                if name != "header":
+                    return True
+            elif name.lower().startswith(selected):
+                return True
+    return False
+
+
+def detect_changes(results: dict, cache, sections: list = None) -> dict:
+    """
+    Summarize what changed in each new product in a set of monitor mode fetch results, relative
+    to the last product sent for its region, and add the summary to the result as 'changes'. The
+    parsed product is added as 'afd', so it is not parsed again when it is rendered.
+    With sections, products where none of those sections changed are treated as unchanged: their
+    response is replaced with None, so they are neither rendered nor sent. The fingerprints of
+    each product that is kept are added to its result as 'fingerprints', and stored with
+    record_sent once the product has been delivered, so a product that fails to send is still
+    compared against the last one actually sent. A product that fails to parse is kept without
+    a summary.
+
+    :param results: Dict mapping region code to fetch result, as returned by apiclient.fetch_afds
+    :param cache: Monitor cache backend providing get_fingerprints and set_fingerprints
+    :param sections: Section names to require a change in, see selected_changed, or None to keep
+    every new product
+    :return: Dict mapping region code to fetch result
+    """
+    checked = {}
+    for region, result in results.items():
+        if result['response'] is None:
+            checked[region] = result
+            continue
+        try:
+            afd = apiclient.AreaForecastDiscussion(result['response'])
+            fingerprints = section_fingerprints(afd)
+        except Exception:
+            # the product is kept without a summary; it fails again, per region, when rendered
+            logger.exception(f"Unexpected error parsing AFD for {region}, changes will not be "
+                             f"summarized")
+            checked[region] = result
+            continue
+        summary = summarize(cache.get_fingerprints(region), fingerprints)
+        if sections and summary['previous_product_id'] is not None \
+                and not selected_changed(summary, sections):
+            logger.info(f"None of the selected sections changed in AFD {afd.product_id} for "
+                        f"{region}, email will not be sent.")
+            metrics.increment('cache_hits_total', cache="sections")
+            checked[region] = {'response': None, 'error': None}
+            continue
+        metrics.increment('cache_misses_total', cache="sections")
+        logger.debug("Sections changed in %s for region %s: %s", afd.product_id, region,
+                     summary['changed'] + summary['added'])
+        checked[region] = dict(result, changes=summary, afd=afd, fingerprints=fingerprints)
+    return checked
+
+
+def record_sent(cache, region: str, result: dict):
+    """
+    Store the section fingerprints of a product once it has been delivered, so later products
+    are compared against it. Does nothing for results without fingerprints.
+
+    :param cache: Monitor cache backend providing set_fingerprints
+    :param region: Region code
+    :param result: Fetch result returned by detect_changes
+    """
+    if result.get('fingerprints') is not None:
+        cache.set_fingerprints(region, result['afd'].product_id, result['fingerprints'])
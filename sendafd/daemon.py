@@ -0,0 +1,193 @@
+"""
+Long-running scheduler that polls a configured set of regions in monitor mode and emails each new
+AFD, keeping HTTP and SMTP connections and the monitor cache open between polls.
+"""
+
+import heapq
+import json
+import logging
+import random
+import signal
+import threading
+import time
+
+from . import apiclient, changes, emailclient, metrics, outbox, renderer, store, subscriptions
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 600
+DEFAULT_JITTER = 30
+# seconds between checks of the outbox for failed emails due to be retried
+OUTBOX_SCAN_INTERVAL = 60
+
+
+def load_config(config_path: str) -> dict:
+    """
+    Read and validate the daemon configuration file. The file is JSON, for example:
+
+        {
+            "smtp": {"server": "email.emailserver.com", "port": 587,
+                     "username": "someuser@emailserver.com", "password": "somepassword"},
+            "recipient": "foo@bar.com",
+            "interval": 600,
+            "jitter": 30,
+            "regions": {"PSR": {}, "TOP": {"interval": 1800}}
+        }
+
+    Optional top-level keys are "sender", "template", "plaintext", "cache_dir", "cache_db",
+    "render_cache_dir", "workers", "send_if_changed", "outbox" and "delivery_workers". When
+    "cache_db" is set, fetched AFDs are kept in that SQLite database instead of JSON files in
+    "cache_dir". "send_if_changed" is a list of section names; a new AFD is only sent if one of them
+    changed (see changes.selected_changed). When "outbox" is set, emails are committed to an outbox
+    in that directory and sent by "delivery_workers" background threads (see outbox.DeliveryPool).
+    "regions" may also be a list of region codes that all use the default interval.
+
+    To email several recipients, replace "recipient" with "subscriptions", either the path to a
+    subscription file or the same mapping inline (see subscriptions.load_subscriptions). "regions"
+    then defaults to every subscribed region.
+
+    :param config_path: Path to the JSON configuration file
+    :return: Configuration dict with defaults filled in
+    :raises ValueError: if the configuration is invalid
+    """
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    if 'smtp' not in config:
+        raise ValueError("Daemon configuration is missing 'smtp'")
+    for key in ('server', 'username', 'password'):
+        if key not in config['smtp']:
+            raise ValueError(f"Daemon configuration is missing 'smtp.{key}'")
+    config.setdefault('template', 'default_email_template.html')
+    config.setdefault('plaintext', False)
+    if 'subscriptions' in config:
+        if isinstance(config['subscriptions'], str):
+            config['subscriptions'] = subscriptions.load_subscriptions(config['subscriptions'])
+        else:
+            config['subscriptions'] = subscriptions.parse_subscriptions(config['subscriptions'])
+        config.setdefault('regions', subscriptions.subscribed_regions(config['subscriptions']))
+    elif 'recipient' in config:
+        if 'regions' not in config:
+            raise ValueError("Daemon configuration is missing 'regions'")
+        config['subscriptions'] = subscriptions.parse_subscriptions({config['recipient']: {
+            'regions': list(config['regions']),
+            'template': config['template'],
+            'plaintext': config['plaintext'],
+        }})
+    else:
+        raise ValueError("Daemon configuration needs either 'recipient' or 'subscriptions'")
+    if isinstance(config['regions'], list):
+        config['regions'] = {region: {} for region in config['regions']}
+    if not config['regions']:
+        raise ValueError("Daemon configuration must include at least one region")
+    config.setdefault('interval', DEFAULT_INTERVAL)
+    config.setdefault('jitter', DEFAULT_JITTER)
+    config.setdefault('sender', config['smtp']['username'])
+    config.setdefault('cache_dir', ".")
+    config.setdefault('workers', 8)
+    config.setdefault('delivery_workers', outbox.DEFAULT_WORKERS)
+    return config
+
+
+class Daemon:
+    """
+    Poll each configured region on its own interval, with random jitter so that regions sharing
+    an interval do not all hit the NWS API at the same moment. New AFDs are emailed over a single
+    persistent SMTP connection, or committed to an outbox and sent by a pool of background
+    threads, so a slow SMTP server never delays a poll. The monitor cache is either a SQLite database or held in memory
+    and written through to JSON files on disk.
+    """
+    def __init__(self, config: dict):
+        self.config = config
+        if config.get('cache_db'):
+            self.cache = store.SQLiteCache(config['cache_db'])
+        else:
+            self.cache = apiclient.MonitorCache(cache_dir=config['cache_dir'], in_memory=True)
+        if config.get('outbox'):
+            self.sender = outbox.DeliveryPool(outbox.Outbox(config['outbox']), self.smtp_sender,
+                                              workers=config['delivery_workers'],
+                                              scan_interval=OUTBOX_SCAN_INTERVAL)
+        else:
+            self.sender = self.smtp_sender()
+        self._stop = threading.Event()
+        # heap of (next poll time, region code)
+        self._schedule = []
+
+    def smtp_sender(self) -> emailclient.SMTPSender:
+        smtp = self.config['smtp']
+        return emailclient.SMTPSender(smtp_server=smtp['server'],
+                                      smtp_username=smtp['username'],
+                                      smtp_pw=smtp['password'],
+                                      smtp_port=smtp.get('port', 587))
+
+    def region_interval(self, region: str) -> float:
+        return self.config['regions'][region].get('interval', self.config['interval'])
+
+    def next_poll_time(self, region: str, now: float) -> float:
+        jitter = self.config['regions'][region].get('jitter', self.config['jitter'])
+        return now + max(0.0, self.region_interval(region) + random.uniform(-jitter, jitter))
+
+    def stop(self, signum=None, frame=None):
+        """Ask the daemon to exit after finishing any fetch or send already in progress"""
+        if signum is not None:
+            logger.info(f"Received signal {signum}, stopping after in-flight sends complete")
+        self._stop.set()
+
+    def run(self):
+        """Run until stop() is called or a SIGTERM/SIGINT is received"""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        now = time.monotonic()
+        # spread the first polls over the jitter window
+        for region in self.config['regions']:
+            heapq.heappush(self._schedule,
+                           (now + random.uniform(0, self.config['jitter']), region))
+        if isinstance(self.sender, outbox.DeliveryPool):
+            self.sender.start()
+        logger.info(f"Daemon started, monitoring {len(self._schedule)} regions")
+        try:
+            while not self._stop.is_set():
+                due_time = self._schedule[0][0]
+                if self._stop.wait(timeout=max(0.0, due_time - time.monotonic())):
+                    break
+                self.poll_due_regions()
+        finally:
+            self.sender.close()
+            apiclient.close_session()
+            logger.info("Daemon stopped")
+
+    def poll_due_regions(self):
+        """Fetch every region that is due, concurrently, then email any new AFDs"""
+        now = time.monotonic()
+        due = []
+        while self._schedule and self._schedule[0][0] <= now:
+            due.append(heapq.heappop(self._schedule)[1])
+        try:
+            with metrics.timer('poll'):
+                results = apiclient.fetch_afds(regions=due,
+                                               monitor=True,
+                                               max_workers=self.config['workers'],
+                                               cache=self.cache)
+                results = changes.detect_changes(results, self.cache,
+                                                 self.config.get('send_if_changed'))
+                subscriptions.deliver(results, self.config['subscriptions'],
+                                      self.config['sender'], self.sender, cache=self.cache)
+        except Exception:
+            # keep the daemon running if an AFD fails to parse or render
+            logger.exception(f"Unexpected error processing AFDs for {', '.join(due)}")
+        finally:
+            now = time.monotonic()
+            for region in due:
+                heapq.heappush(self._schedule, (self.next_poll_time(region, now), region))
+            # metrics accumulate over the daemon's lifetime and are exported after every cycle
+            metrics.export()
+
+
+def run_daemon(config_path: str):
+    """Load the daemon configuration and run until stopped"""
+    config = load_config(config_path)
+    if config.get('render_cache_dir'):
+        renderer.configure_render_cache(cache_dir=config['render_cache_dir'])
+    apiclient.configure_session(
+        pool_maxsize=max(config['workers'], apiclient.session_settings['pool_maxsize']))
+    Daemon(config).run()
@@ -5,46 +5,176 @@ Send an email via a SMTP server. Takes html or plain text from renderer.py as in
 from email.message import EmailMessage
 import smtplib
 import logging
+from . import metrics
 
 logger = logging.getLogger(__name__)
 
+def permanent_failure(error) -> bool:
+    """Return True if an SMTP error means that sending the same message again will not help,
+    such as a 5xx reply rejecting the sender, recipients or message"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
 def send_email(smtp_server: str,
                smtp_username: str,
                smtp_pw: str,
                email: EmailMessage,
                smtp_port: int = 587):
     """Connect to SMTP server and send email to the destination address"""
+    with SMTPSender(smtp_server, smtp_username, smtp_pw, smtp_port=smtp_port) as sender:
+        return sender.send(email)
 
-    try:
-        logger.debug(f"Connecting to SMTP server at {smtp_server}:{smtp_port}")
-        smtp_connection  = smtplib.SMTP(smtp_server, smtp_port, timeout=10)
-        logger.debug("Server connection appears successful")
-    except smtplib.SMTPException:
-        logger.exception("Connection to SMTP server failed", exc_info=True)
-        return False
-    try:
-        logger.debug(f"Logging in to SMTP server as {smtp_username}")
-        masked_pw = smtp_pw[0] + "*"*(len(smtp_pw)-2) + smtp_pw[-1]
-        logger.debug(f"Password: {masked_pw}")
-        smtp_connection.starttls()
-        smtp_connection.ehlo()
-        smtp_connection.login(user=smtp_username,
-                              password=smtp_pw)
-        logger.debug("Login appears successful")
-    except smtplib.SMTPAuthenticationError:
-        logger.critical("Error logging in to SMTP server, check username and password", exc_info=True)
-        return False
-    except (smtplib.SMTPHeloError, smtplib.SMTPNotSupportedError):
-        logger.critical("Error connecting using STARTTLS, email server may not support STARTTLS.", exc_info=True)
-        return False
-    except RuntimeError:
-        logger.critical("SSL/TLS support not available to your Python interpreter, could not send email.")
-        return False
-    logger.debug(f"Sending email to {email['To']}")
-    sent_status = smtp_connection.send_message(email)
-    if len(sent_status) > 0:
-        logger.critical(f"Email could not be delivered: {sent_status}")
-        return False
-    else:
-        logger.debug(f"Email sent to {email['To']}")
+
+class SMTPSender:
+    """
+    Keep a single authenticated connection to an SMTP server open so that several emails can be
+    sent without repeating the connection, STARTTLS and login handshake for each one. The
+    connection is opened on the first send and reopened transparently if the server drops it.
+    Use as a context manager, or call close(), so the connection is shut down with QUIT.
+    """
+    def __init__(self,
+                 smtp_server: str,
+                 smtp_username: str,
+                 smtp_pw: str,
+                 smtp_port: int = 587,
+                 timeout: float = 10,
+                 max_messages_per_connection: int = 0):
+        """
+        :param max_messages_per_connection: Reconnect after sending this many messages, for
+        servers that limit messages per session. 0 means no limit.
+        """
+        self.smtp_server = smtp_server
+        self.smtp_username = smtp_username
+        self.smtp_pw = smtp_pw
+        self.smtp_port = smtp_port
+        self.timeout = timeout
+        self.max_messages_per_connection = max_messages_per_connection
+        self.connection = None
+        self._sent_on_connection = 0
+        # why the last send failed, and whether retrying it could succeed
+        self.last_error = None
+        self.last_error_permanent = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self) -> bool:
+        """Connect and log in to the SMTP server, returning True if successful"""
+        self.close()
+        with metrics.timer('smtp_connect'):
+            return self._connect()
+
+    def _connect(self) -> bool:
+        try:
+            logger.debug("Connecting to SMTP server at %s:%s", self.smtp_server, self.smtp_port)
+            connection = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+            logger.debug("Server connection appears successful")
+        except (smtplib.SMTPException, OSError):
+            logger.exception("Connection to SMTP server failed")
+            return False
+        try:
+            logger.debug("Logging in to SMTP server as %s", self.smtp_username)
+            if logger.isEnabledFor(logging.DEBUG):
+                masked_pw = self.smtp_pw[0] + "*"*(len(self.smtp_pw)-2) + self.smtp_pw[-1]
+                logger.debug("Password: %s", masked_pw)
+            connection.starttls()
+            connection.ehlo()
+            connection.login(user=self.smtp_username, password=self.smtp_pw)
+            logger.debug("Login appears successful")
+        except smtplib.SMTPAuthenticationError:
+            logger.critical("Error logging in to SMTP server, check username and password", exc_info=True)
+            connection.close()
+            return False
+        except (smtplib.SMTPHeloError, smtplib.SMTPNotSupportedError):
+            logger.critical("Error connecting using STARTTLS, email server may not support STARTTLS.", exc_info=True)
+            connection.close()
+            return False
+        except RuntimeError:
+            logger.critical("SSL/TLS support not available to your Python interpreter, could not send email.")
+            connection.close()
+            return False
+        self.connection = connection
+        self._sent_on_connection = 0
         return True
+
+    def send(self, email: EmailMessage) -> bool:
+        """
+        Send an email over the open connection, connecting first if needed. If the server has
+        dropped an idle connection, or the connection fails while sending, reconnect once and try
+        again.
+        """
+        with metrics.timer('smtp_send'):
+            sent = self._send(email)
+        metrics.increment('emails_sent_total' if sent else 'emails_failed_total')
+        return sent
+
+    def _send(self, email: EmailMessage) -> bool:
+        if (self.max_messages_per_connection
+                and self._sent_on_connection >= self.max_messages_per_connection):
+            logger.debug("Reached message limit for this SMTP connection, reconnecting")
+            self.close()
+        self.last_error = None
+        self.last_error_permanent = False
+        for attempt in range(2):
+            if self.connection is None and not self.connect():
+                self.last_error = "Could not connect or log in to SMTP server"
+                return False
+            try:
+                logger.debug("Sending email to %s", email['To'])
+                sent_status = self.connection.send_message(email)
+            except smtplib.SMTPServerDisconnected:
+                logger.debug("SMTP server closed the connection, reconnecting")
+                self.connection.close()
+                self.connection = None
+                self.last_error = "SMTP server closed the connection"
+                continue
+            except smtplib.SMTPException as e:
+                logger.critical(f"Email to {email['To']} could not be delivered", exc_info=True)
+                self.last_error = f"{type(e).__name__}: {e}"
+                self.last_error_permanent = permanent_failure(e)
+                return False
+            except OSError as e:
+                # e.g. the connection was reset partway through; it can not be used again
+                logger.warning(f"Connection to SMTP server lost while sending to {email['To']}: "
+                               f"{e}, reconnecting")
+                self.connection.close()
+                self.connection = None
+                self.last_error = f"{type(e).__name__}: {e}"
+                continue
+            if len(sent_status) > 0:
+                logger.critical(f"Email could not be delivered: {sent_status}")
+                self.last_error = f"Recipients refused: {sent_status}"
+                self.last_error_permanent = all(code >= 500 for code, _ in sent_status.values())
+                return False
+            self._sent_on_connection += 1
+            logger.debug("Email sent to %s", email['To'])
+            return True
+        return False
+
+    def send_many(self, emails) -> list:
+        """
+        Send several emails over the same connection.
+
+        :param emails: Iterable of EmailMessage objects
+        :return: List of booleans, True for each email that was sent successfully
+        """
+        results = []
+        for email in emails:
+            results.append(self.send(email))
+        logger.debug("Sent %s of %s emails", sum(results), len(results))
+        return results
+
+    def close(self):
+        """Close the connection to the SMTP server, if one is open"""
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                self.connection.close()
+            self.connection = None
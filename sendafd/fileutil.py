@@ -0,0 +1,24 @@
+"""
+File helpers shared by apiclient, metrics and renderer. Kept free of third party imports, so
+lightweight modules such as metrics can use them without loading the HTTP client.
+"""
+
+import os
+import threading
+
+
+def write_text_atomic(text: str, path: str):
+    """
+    Write text to a temporary file next to path, then move it into place, so readers never see a
+    partially written file even if the process is interrupted. The temporary file is removed if
+    the write fails.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,207 @@
+"""
+Bulk export of rendered emails to an mbox file or a Maildir, for archiving or for handing a
+whole batch of messages to another MTA at once. Writers have the same send, send_many and close
+methods as emailclient.SMTPSender, so they can be used anywhere an SMTP sender is.
+
+Messages are serialized with BytesGenerator straight into the output file, without building the
+message as a string first. Instead of syncing every message to disk, each writer calls fsync
+once per batch of messages, and when closed.
+"""
+
+import email.policy
+import logging
+import os
+import socket
+import threading
+import time
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100
+
+# mbox and Maildir files use Unix line endings; the MTA converts them when delivering
+FILE_POLICY = email.policy.default.clone(linesep="\n")
+
+
+class LastByteWriter:
+    """File wrapper remembering the last byte written, so the mbox writer knows whether a
+    message ended with a newline"""
+    def __init__(self, file):
+        self.file = file
+        self.last_byte = b"\n"
+
+    def write(self, data: bytes):
+        if data:
+            self.last_byte = data[-1:]
+        return self.file.write(data)
+
+
+class MboxWriter:
+    """
+    Append emails to an mbox file. Each message starts with a "From " line, and lines in the
+    body starting with "From " are escaped as ">From ". The file is locked while the writer is
+    open, where the platform supports it.
+    """
+    def __init__(self, path: str, batch_size: int = DEFAULT_BATCH_SIZE):
+        """
+        :param path: Path of the mbox file, created if it does not exist
+        :param batch_size: Number of messages written between calls to fsync
+        """
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self._file = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        logger.debug("Opening mbox at %s", self.path)
+        self._file = open(self.path, 'ab')
+        try:
+            import fcntl
+        except ImportError:
+            return
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+
+    def send(self, email: EmailMessage) -> bool:
+        """Append an email to the mbox, returning True once it is written"""
+        with self._lock:
+            if self._file is None:
+                self.open()
+            self._file.write(f"From MAILER-DAEMON {time.asctime(time.gmtime())}\n".encode('ascii'))
+            out = LastByteWriter(self._file)
+            BytesGenerator(out, mangle_from_=True, policy=FILE_POLICY).flatten(email)
+            # messages are separated by a blank line
+            self._file.write(b"\n" if out.last_byte == b"\n" else b"\n\n")
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._sync()
+        metrics.increment('emails_exported_total', format="mbox")
+        return True
+
+    def send_many(self, emails) -> list:
+        """Append several emails, returning a list with True for each one written"""
+        return [self.send(email) for email in emails]
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        logger.debug("Synced %s messages to %s", self._pending, self.path)
+        self._pending = 0
+
+    def close(self):
+        """Sync any messages not yet synced and close the mbox"""
+        with self._lock:
+            if self._file is not None:
+                if self._pending:
+                    self._sync()
+                self._file.close()
+                self._file = None
+
+
+class MaildirWriter:
+    """
+    Deliver emails to a Maildir. Each message is written to a file in tmp/, and once a batch is
+    complete its files are synced and moved into new/ together, so the whole batch appears to
+    readers of the Maildir at once and no reader ever sees a partly written message.
+    """
+    def __init__(self, path: str, batch_size: int = DEFAULT_BATCH_SIZE):
+        """
+        :param path: Maildir directory, created with its tmp, new and cur subdirectories if needed
+        :param batch_size: Number of messages written before they are synced and moved to new/
+        """
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self._pending = []
+        self._counter = 0
+        self._lock = threading.Lock()
+        # '/' and ':' have special meanings in Maildir file names
+        self._hostname = socket.gethostname().replace("/", r"\057").replace(":", r"\072")
+        self._created = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def unique_name(self) -> str:
+        """Return a file name unique to this message, in the usual Maildir format"""
+        self._counter += 1
+        now = time.time()
+        return (f"{int(now)}.M{int(now % 1 * 1e6)}P{os.getpid()}Q{self._counter}."
+                f"{self._hostname}")
+
+    def send(self, email: EmailMessage) -> bool:
+        """Write an email to the Maildir's tmp directory, returning True once it is written"""
+        with self._lock:
+            if not self._created:
+                for subdir in ("tmp", "new", "cur"):
+                    os.makedirs(os.path.join(self.path, subdir), exist_ok=True)
+                self._created = True
+            name = self.unique_name()
+            with open(os.path.join(self.path, "tmp", name), 'xb') as f:
+                BytesGenerator(f, mangle_from_=False, policy=FILE_POLICY).flatten(email)
+            self._pending.append(name)
+            if len(self._pending) >= self.batch_size:
+                self._deliver()
+        metrics.increment('emails_exported_total', format="maildir")
+        return True
+
+    def send_many(self, emails) -> list:
+        """Write several emails, returning a list with True for each one written"""
+        return [self.send(email) for email in emails]
+
+    def _deliver(self):
+        """Sync the pending messages and move them from tmp/ into new/"""
+        tmp_dir = os.path.join(self.path, "tmp")
+        new_dir = os.path.join(self.path, "new")
+        for name in self._pending:
+            fd = os.open(os.path.join(tmp_dir, name), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for name in self._pending:
+            os.rename(os.path.join(tmp_dir, name), os.path.join(new_dir, name))
+        sync_directory(new_dir)
+        logger.debug("Delivered %s messages to %s", len(self._pending), new_dir)
+        self._pending = []
+
+    def close(self):
+        """Deliver any messages still in tmp/"""
+        with self._lock:
+            if self._pending:
+                self._deliver()
+
+
+def sync_directory(path: str):
+    """Sync a directory, so renames into it are on disk. Not supported on every platform."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def open_writer(path: str, export_format: str = "mbox", batch_size: int = DEFAULT_BATCH_SIZE):
+    """Return an MboxWriter or MaildirWriter for path, according to export_format"""
+    if export_format == "maildir":
+        return MaildirWriter(path, batch_size=batch_size)
+    if export_format == "mbox":
+        return MboxWriter(path, batch_size=batch_size)
+    raise ValueError(f"Unknown export format: {export_format}")
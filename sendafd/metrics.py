@@ -0,0 +1,209 @@
+"""
+Lightweight instrumentation shared by apiclient, renderer and emailclient. Records how long each
+stage of a run takes and how often it runs, along with counters such as bytes fetched, cache hits
+and misses and HTTP retries. Recorded metrics can be exported as a Prometheus textfile, for the
+node exporter's textfile collector, or appended to a JSON lines file.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from . import fileutil
+
+logger = logging.getLogger(__name__)
+
+# where and how export() writes metrics; path None disables exporting
+export_settings = {
+    'path': None,
+    'format': "prometheus",
+}
+
+EXPORT_FORMATS = ("prometheus", "jsonl")
+
+# optional callable(stage, **labels) returning a context manager entered around every timed
+#  stage, set by profiling.Profiler while --profile is active
+stage_hook = None
+
+METRIC_PREFIX = "sendafd"
+
+# Prometheus type of each metric family that is not a counter
+METRIC_TYPES = {
+    'stage_duration_seconds': "summary",
+    'stage_max_duration_seconds': "gauge",
+}
+
+# help text for each metric family
+DESCRIPTIONS = {
+    'stage_duration_seconds': "Time spent in each stage of fetching, parsing, rendering and sending AFDs",
+    'stage_max_duration_seconds': "Longest single run of each stage",
+    'http_requests_total': "Requests made to the NWS API, by response status",
+    'http_bytes_total': "Bytes of response body received from the NWS API",
+    'http_retries_total': "Requests to the NWS API retried after a server or connection error",
+    'http_rate_limit_wait_seconds_total': "Seconds spent waiting for the NWS API request rate limiter",
+    'http_circuit_open_total': "Requests to the NWS API refused because the endpoint's circuit breaker was open",
+    'cache_hits_total': "Lookups answered from a cache, by cache",
+    'cache_misses_total': "Lookups not answered from a cache, by cache",
+    'emails_sent_total': "Emails accepted by the SMTP server",
+    'emails_failed_total': "Emails that could not be sent",
+    'emails_exported_total': "Emails written to an mbox file or Maildir, by format",
+    'outbox_queued_total': "Emails committed to the outbox",
+    'outbox_retries_total': "Failed outbox deliveries scheduled to be retried",
+    'outbox_dead_letters_total': "Outbox emails given up on after a permanent failure or too many attempts",
+    'products_reprocessed_total': "Archived products parsed and rendered again by --reprocess",
+}
+
+
+class Metrics:
+    """
+    Thread-safe collection of stage timings and counters, each identified by a name and a set
+    of labels. Stage timings keep a count, total and maximum duration.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counters = {}
+
+    @staticmethod
+    def key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, stage: str, seconds: float, **labels):
+        """Record one run of a stage that took the supplied number of seconds"""
+        key = self.key(stage, labels)
+        with self._lock:
+            count, total, longest = self._timings.get(key, (0, 0.0, 0.0))
+            self._timings[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        """Context manager recording the time taken by the block as a run of stage"""
+        start = time.perf_counter()
+        try:
+            if stage_hook is None:
+                yield
+            else:
+                with stage_hook(stage, **labels):
+                    yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """Add value to a counter"""
+        key = self.key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def stage(self, stage: str, **labels) -> dict:
+        """Return {'count', 'seconds', 'max_seconds'} for a stage, zero if it never ran"""
+        with self._lock:
+            count, total, longest = self._timings.get(self.key(stage, labels), (0, 0.0, 0.0))
+        return {'count': count, 'seconds': total, 'max_seconds': longest}
+
+    def counter(self, name: str, **labels) -> float:
+        """Return the current value of a counter"""
+        with self._lock:
+            return self._counters.get(self.key(name, labels), 0)
+
+    def samples(self) -> list:
+        """Return every recorded value as a list of (metric name, labels dict, value)"""
+        with self._lock:
+            timings = sorted(self._timings.items())
+            counters = sorted(self._counters.items())
+        samples = []
+        for (stage, labels), (count, total, longest) in timings:
+            labels = dict(labels, stage=stage)
+            samples.append(("stage_duration_seconds_count", labels, count))
+            samples.append(("stage_duration_seconds_sum", labels, total))
+            samples.append(("stage_max_duration_seconds", labels, longest))
+        for (name, labels), value in counters:
+            samples.append((name, dict(labels), value))
+        return samples
+
+    def reset(self):
+        """Discard all recorded metrics"""
+        with self._lock:
+            self._timings.clear()
+            self._counters.clear()
+
+
+registry = Metrics()
+
+# module-level shortcuts to the shared registry, used by the instrumented modules
+timer = registry.timer
+increment = registry.increment
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"'
+                          for name, value in sorted(labels.items())) + "}"
+
+
+def to_prometheus(metrics: Metrics = None, timestamp: float = None) -> str:
+    """Return metrics in the Prometheus text exposition format"""
+    metrics = registry if metrics is None else metrics
+    # every sample of a family must follow its HELP and TYPE lines without another family's
+    #  samples in between, so samples are grouped by family, keeping their order within it
+    families = {}
+    for name, labels, value in metrics.samples():
+        family = name.rsplit("_", 1)[0] if name.startswith("stage_duration_seconds") else name
+        families.setdefault(family, []).append((name, labels, value))
+    lines = []
+    for family, samples in families.items():
+        metric_type = METRIC_TYPES.get(family, "counter")
+        lines.append(f"# HELP {METRIC_PREFIX}_{family} {DESCRIPTIONS.get(family, family)}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{family} {metric_type}")
+        for name, labels, value in samples:
+            lines.append(f"{METRIC_PREFIX}_{name}{format_labels(labels)} {value}")
+    timestamp = time.time() if timestamp is None else timestamp
+    lines.append(f"# HELP {METRIC_PREFIX}_last_export_timestamp_seconds Time metrics were last exported")
+    lines.append(f"# TYPE {METRIC_PREFIX}_last_export_timestamp_seconds gauge")
+    lines.append(f"{METRIC_PREFIX}_last_export_timestamp_seconds {timestamp}")
+    return "\n".join(lines) + "\n"
+
+
+def to_json_lines(metrics: Metrics = None, timestamp: float = None) -> str:
+    """Return metrics as JSON lines, one object per recorded value"""
+    metrics = registry if metrics is None else metrics
+    timestamp = time.time() if timestamp is None else timestamp
+    return "".join(json.dumps({'timestamp': timestamp, 'name': f"{METRIC_PREFIX}_{name}",
+                               'labels': labels, 'value': value}) + "\n"
+                   for name, labels, value in metrics.samples())
+
+
+def write_prometheus(path: str, metrics: Metrics = None):
+    """
+    Write metrics to a Prometheus textfile. The file is replaced atomically, so the node
+    exporter never reads a partly written file.
+    """
+    fileutil.write_text_atomic(to_prometheus(metrics), path)
+
+
+def write_json_lines(path: str, metrics: Metrics = None):
+    """Append metrics to a JSON lines file"""
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(to_json_lines(metrics))
+
+
+def export():
+    """Write the shared registry to export_settings['path'] in export_settings['format'], if a
+    path is configured. Errors are logged rather than raised, so a metrics problem never fails
+    a run."""
+    path = export_settings['path']
+    if not path:
+        return
+    try:
+        if export_settings['format'] == "jsonl":
+            write_json_lines(path)
+        else:
+            write_prometheus(path)
+        logger.debug("Wrote metrics to %s", path)
+    except OSError:
+        logger.warning(f"Could not write metrics to {path}", exc_info=True)
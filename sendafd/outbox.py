@@ -0,0 +1,352 @@
+"""
+Durable outbox for rendered emails. Sending inline means a run waits on the SMTP server, and a
+message that fails to send is lost, because the monitor cache already records its product as
+seen. With an outbox, each rendered message is committed to a spool directory before the run
+moves on, and a pool of delivery threads sends queued messages in the background, each thread
+over its own SMTP connection.
+
+The spool directory contains:
+    tmp/    messages being written
+    queue/  committed messages waiting to be sent, as {id}.eml, with an {id}.json file holding
+            the number of attempts and the time of the next one once a send has failed
+    dead/   messages that failed permanently or too many times, with the last error
+
+Messages are moved from tmp/ into queue/ only once they are synced to disk, so a crash never
+leaves a partly written message in the queue. A failed send is retried with exponential backoff,
+by this run or a later one, until it succeeds or reaches the attempt limit. Only one process at a
+time delivers from a spool, but any number of processes may add messages to it.
+"""
+
+import email
+import email.policy
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+
+from . import metrics
+from .mailexport import FILE_POLICY, sync_directory
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 8
+# seconds before the first retry, doubling with each failure up to BACKOFF_MAX
+BACKOFF_BASE = 60
+BACKOFF_MAX = 3600
+
+
+class Outbox:
+    """A spool directory of emails waiting to be delivered"""
+    def __init__(self, path: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 backoff_base: float = BACKOFF_BASE, backoff_max: float = BACKOFF_MAX):
+        """
+        :param path: Spool directory, created with its subdirectories if needed
+        :param max_attempts: Number of failed sends after which a message is dead-lettered
+        :param backoff_base: Seconds to wait before retrying a message after its first failure
+        :param backoff_max: Longest wait between retries, in seconds
+        """
+        self.path = path
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._lock_file = None
+        for subdir in ("tmp", "queue", "dead"):
+            os.makedirs(os.path.join(path, subdir), exist_ok=True)
+
+    def _path(self, subdir: str, message_id: str, extension: str = "eml") -> str:
+        return os.path.join(self.path, subdir, f"{message_id}.{extension}")
+
+    def new_id(self) -> str:
+        """Return an ID unique to a new message. IDs sort in the order messages were added."""
+        with self._lock:
+            self._counter += 1
+            counter = self._counter
+        return f"{time.time_ns():020d}-{os.getpid()}-{counter}"
+
+    def add(self, email_message: EmailMessage) -> str:
+        """Commit an email to the queue, returning its message ID once it is on disk"""
+        message_id = self.new_id()
+        tmp_path = self._path("tmp", message_id)
+        with open(tmp_path, 'xb') as f:
+            BytesGenerator(f, mangle_from_=False, policy=FILE_POLICY).flatten(email_message)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._path("queue", message_id))
+        sync_directory(os.path.join(self.path, "queue"))
+        metrics.increment('outbox_queued_total')
+        logger.debug("Queued message %s to %s", message_id, email_message['To'])
+        return message_id
+
+    def load(self, message_id: str) -> EmailMessage:
+        with open(self._path("queue", message_id), 'rb') as f:
+            return email.message_from_binary_file(f, policy=email.policy.default)
+
+    def state(self, message_id: str, subdir: str = "queue") -> dict:
+        """Return the delivery state of a message: its number of failed 'attempts', the time of
+        the 'next_attempt' and the 'last_error'"""
+        try:
+            with open(self._path(subdir, message_id, "json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'attempts': 0, 'next_attempt': 0, 'last_error': None}
+
+    def _write_state(self, message_id: str, state: dict, subdir: str = "queue"):
+        path = self._path(subdir, message_id, "json")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    def queued(self) -> list:
+        """Return the IDs of every queued message, oldest first"""
+        return sorted(name[:-len(".eml")] for name in os.listdir(os.path.join(self.path, "queue"))
+                      if name.endswith(".eml"))
+
+    def due(self, now: float = None) -> list:
+        """Return the IDs of queued messages due to be sent, oldest first"""
+        now = time.time() if now is None else now
+        return [message_id for message_id in self.queued()
+                if self.state(message_id)['next_attempt'] <= now]
+
+    def dead_letters(self) -> list:
+        """Return the IDs of dead-lettered messages, oldest first"""
+        return sorted(name[:-len(".eml")] for name in os.listdir(os.path.join(self.path, "dead"))
+                      if name.endswith(".eml"))
+
+    def remove(self, message_id: str):
+        """Remove a message from the queue once it has been sent"""
+        os.remove(self._path("queue", message_id))
+        try:
+            os.remove(self._path("queue", message_id, "json"))
+        except FileNotFoundError:
+            pass
+
+    def retry_delay(self, attempts: int) -> float:
+        """Return the number of seconds to wait before the next attempt after a number of failed
+        attempts"""
+        return min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+
+    def record_failure(self, message_id: str, error: str = None, permanent: bool = False) -> bool:
+        """
+        Record a failed attempt to send a message, and either schedule its next attempt or move it
+        to dead/ if the failure was permanent or it has reached max_attempts.
+
+        :return: True if the message was dead-lettered
+        """
+        state = self.state(message_id)
+        state['attempts'] += 1
+        state['last_error'] = error
+        if permanent or state['attempts'] >= self.max_attempts:
+            state['next_attempt'] = None
+            self._write_state(message_id, state, "dead")
+            os.replace(self._path("queue", message_id), self._path("dead", message_id))
+            try:
+                os.remove(self._path("queue", message_id, "json"))
+            except FileNotFoundError:
+                pass
+            metrics.increment('outbox_dead_letters_total')
+            logger.critical(f"Giving up on message {message_id} after {state['attempts']} "
+                            f"attempts: {error}. It has been moved to "
+                            f"{os.path.join(self.path, 'dead')}")
+            return True
+        delay = self.retry_delay(state['attempts'])
+        state['next_attempt'] = time.time() + delay
+        self._write_state(message_id, state)
+        metrics.increment('outbox_retries_total')
+        logger.warning(f"Could not send message {message_id} (attempt {state['attempts']} of "
+                       f"{self.max_attempts}), retrying in {delay:.0f} seconds: {error}")
+        return False
+
+    def lock(self) -> bool:
+        """Try to become the only process delivering from this spool, returning True on success.
+        Always succeeds where file locking is not supported."""
+        if self._lock_file is not None:
+            return True
+        self._lock_file = open(os.path.join(self.path, "lock"), 'a')
+        try:
+            import fcntl
+        except ImportError:
+            return True
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            return False
+        return True
+
+    def unlock(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+class DeliveryPool:
+    """
+    Pool of threads delivering messages from an Outbox, each with its own sender. Has the same
+    send, send_many and close methods as emailclient.SMTPSender, so it can be used anywhere an
+    SMTP sender is; send only commits the message to the outbox and returns, and delivery happens
+    in the background.
+    """
+    def __init__(self, outbox: Outbox, sender_factory, workers: int = DEFAULT_WORKERS,
+                 scan_interval: float = None):
+        """
+        :param outbox: Outbox to add messages to and deliver them from
+        :param sender_factory: Callable returning a new emailclient.SMTPSender, called once by
+        each delivery thread
+        :param workers: Number of delivery threads
+        :param scan_interval: Seconds between checks of the outbox for retries that have come due,
+        for long running processes. By default the outbox is only checked when the pool starts, and
+        retries are left for the next run.
+        """
+        self.outbox = outbox
+        self.sender_factory = sender_factory
+        self.workers = max(1, workers)
+        self.scan_interval = scan_interval
+        self.delivering = False
+        self._queue = queue.Queue()
+        self._claimed = set()
+        self._claimed_lock = threading.Lock()
+        self._threads = []
+        self._scanner = None
+        self._stopped = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """Start the delivery threads and queue every message that is due"""
+        if self._threads or self.delivering:
+            return
+        self.delivering = self.outbox.lock()
+        if not self.delivering:
+            logger.info(f"Another process is delivering from {self.outbox.path}, messages will "
+                        f"be queued for it")
+            return
+        self._stopped.clear()
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"outbox-delivery-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self.scan()
+        if self.scan_interval:
+            self._scanner = threading.Thread(target=self._scan_periodically, name="outbox-scan",
+                                             daemon=True)
+            self._scanner.start()
+
+    def scan(self) -> int:
+        """Queue every message that is due and not already being delivered, returning how many
+        were queued"""
+        count = 0
+        for message_id in self.outbox.due():
+            if self._claim(message_id):
+                self._queue.put(message_id)
+                count += 1
+        if count:
+            logger.info(f"Delivering {count} queued messages from {self.outbox.path}")
+        return count
+
+    def _scan_periodically(self):
+        while not self._stopped.wait(self.scan_interval):
+            try:
+                self.scan()
+            except OSError:
+                logger.warning(f"Could not check {self.outbox.path} for messages to retry",
+                               exc_info=True)
+
+    def _claim(self, message_id: str) -> bool:
+        with self._claimed_lock:
+            if message_id in self._claimed:
+                return False
+            self._claimed.add(message_id)
+            return True
+
+    def _release(self, message_id: str):
+        with self._claimed_lock:
+            self._claimed.discard(message_id)
+
+    def send(self, email_message: EmailMessage) -> bool:
+        """Commit an email to the outbox for delivery, returning True once it is on disk"""
+        try:
+            message_id = self.outbox.add(email_message)
+        except OSError:
+            logger.critical(f"Could not add email to {email_message['To']} to the outbox",
+                            exc_info=True)
+            return False
+        if self.delivering and self._claim(message_id):
+            self._queue.put(message_id)
+        return True
+
+    def send_many(self, emails) -> list:
+        """Commit several emails to the outbox, returning a list with True for each one added"""
+        return [self.send(email_message) for email_message in emails]
+
+    def _work(self):
+        sender = self.sender_factory()
+        try:
+            while True:
+                message_id = self._queue.get()
+                try:
+                    if message_id is None:
+                        return
+                    self._deliver(sender, message_id)
+                except Exception:
+                    logger.critical(f"Could not deliver message {message_id}", exc_info=True)
+                finally:
+                    if message_id is not None:
+                        self._release(message_id)
+                    self._queue.task_done()
+        finally:
+            sender.close()
+
+    def _deliver(self, sender, message_id: str):
+        try:
+            email_message = self.outbox.load(message_id)
+        except FileNotFoundError:
+            # already delivered by a process that held the lock before this one
+            return
+        try:
+            sent = sender.send(email_message)
+            error = getattr(sender, 'last_error', None)
+            permanent = getattr(sender, 'last_error_permanent', False)
+        except OSError as e:
+            # e.g. a timeout partway through sending; the connection cannot be reused
+            sender.close()
+            sent, error, permanent = False, f"{type(e).__name__}: {e}", False
+        if sent:
+            self.outbox.remove(message_id)
+            logger.debug("Delivered message %s", message_id)
+            return
+        self.outbox.record_failure(message_id, error, permanent)
+
+    def close(self):
+        """Wait for every queued message to be attempted, then stop the delivery threads and
+        close their connections. Messages waiting for a retry stay in the outbox."""
+        if not self.delivering:
+            return
+        self._stopped.set()
+        if self._scanner is not None:
+            self._scanner.join()
+            self._scanner = None
+        self._queue.join()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.outbox.unlock()
+        self.delivering = False
+        waiting = len(self.outbox.queued())
+        if waiting:
+            logger.info(f"{waiting} messages are waiting in {self.outbox.path} to be retried")
@@ -0,0 +1,231 @@
+"""
+Per-stage profiling for --profile. While a Profiler is started, every stage timed with
+metrics.timer is also profiled with cProfile and tracemalloc, grouped into the fetch, parse,
+render and send stages of a run. When the run finishes, a .pstats file and a list of the top
+allocations are written for each stage, and a summary table is printed.
+
+Stages can be nested: an AFD is only parsed when a template first reads its sections, so parsing
+happens inside rendering. Time, calls and allocations inside a nested stage count towards that
+stage only, not the stage around it. Profiled stages run one at a time, even when they are called
+from several threads, so each is measured without the others running alongside it.
+"""
+
+import cProfile
+import linecache
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# profile stage for each stage timed with metrics.timer; other timed stages are not profiled
+STAGE_GROUPS = {
+    'validate_region': "fetch",
+    'fetch_product_list': "fetch",
+    'fetch_product': "fetch",
+    'parse': "parse",
+    'render': "render",
+    'smtp_connect': "send",
+    'smtp_send': "send",
+}
+STAGES = ("fetch", "parse", "render", "send")
+TOP_ALLOCATIONS = 10
+
+# allocations made by tracemalloc itself or while importing modules are not reported. They are
+#  left out of the differences between snapshots, which is much quicker than filtering snapshots.
+IGNORED_FILES = (tracemalloc.__file__, "<frozen importlib._bootstrap>",
+                 "<frozen importlib._bootstrap_external>", "<unknown>")
+
+
+class Profiler:
+    """Collect a cProfile profile and the allocations of each stage of a run"""
+    def __init__(self, output_dir: str, top_allocations: int = TOP_ALLOCATIONS):
+        """
+        :param output_dir: Directory to write reports to, created if needed
+        :param top_allocations: Number of allocation sites listed for each stage
+        """
+        self.output_dir = output_dir
+        self.allocation_limit = top_allocations
+        self._profiles = {stage: cProfile.Profile() for stage in STAGES}
+        # stage -> [runs, seconds]
+        self._timings = {stage: [0, 0.0] for stage in STAGES}
+        # stage -> {(filename, lineno): [bytes, blocks]} of memory allocated and not yet freed
+        self._allocations = {stage: {} for stage in STAGES}
+        self._lock = threading.RLock()
+        # stack of the stages entered by the thread holding the lock, innermost last
+        self._stack = []
+        self._started_tracemalloc = False
+
+    def start(self):
+        """Start tracing allocations and profiling every timed stage"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        metrics.stage_hook = self.stage
+        logger.info(f"Profiling enabled, writing reports to {self.output_dir}")
+
+    def stop(self):
+        """Stop profiling. Reports can still be written afterwards."""
+        metrics.stage_hook = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    @staticmethod
+    def snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot()
+
+    @contextmanager
+    def stage(self, name: str, **labels):
+        """Context manager profiling the block as a run of the profile stage for a timed stage"""
+        stage = STAGE_GROUPS.get(name)
+        if stage is None or not tracemalloc.is_tracing():
+            yield
+            return
+        with self._lock:
+            if self._stack and self._stack[-1]['stage'] == stage:
+                # e.g. connecting to the SMTP server while sending; already being profiled
+                yield
+                return
+            entered = time.perf_counter()
+            outer = self._stack[-1] if self._stack else None
+            if outer is not None:
+                self._profiles[outer['stage']].disable()
+            frame = {'stage': stage, 'child_seconds': 0.0, 'child_allocations': {},
+                     'before': self.snapshot()}
+            self._stack.append(frame)
+            profile = self._profiles[stage]
+            start = time.perf_counter()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                elapsed = time.perf_counter() - start
+                allocations = self.allocation_diff(frame['before'], self.snapshot())
+                self._stack.pop()
+                self._record(stage, elapsed - frame['child_seconds'],
+                             allocations, frame['child_allocations'])
+                if outer is not None:
+                    # the time taken by snapshots is left out of both stages
+                    outer['child_seconds'] += time.perf_counter() - entered
+                    for site, (size, count) in allocations.items():
+                        totals = outer['child_allocations'].setdefault(site, [0, 0])
+                        totals[0] += size
+                        totals[1] += count
+                    self._profiles[outer['stage']].enable()
+
+    @staticmethod
+    def allocation_diff(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot) -> dict:
+        """Return {(filename, lineno): [bytes, blocks]} for lines that allocated more memory than
+        they freed between two snapshots"""
+        allocations = {}
+        for diff in after.compare_to(before, 'lineno'):
+            frame = diff.traceback[0]
+            if diff.size_diff > 0 and frame.filename not in IGNORED_FILES:
+                allocations[(frame.filename, frame.lineno)] = [diff.size_diff, diff.count_diff]
+        return allocations
+
+    def _record(self, stage: str, seconds: float, allocations: dict, child_allocations: dict):
+        self._timings[stage][0] += 1
+        self._timings[stage][1] += seconds
+        totals = self._allocations[stage]
+        for site, (size, count) in allocations.items():
+            child_size, child_count = child_allocations.get(site, (0, 0))
+            if size - child_size <= 0:
+                continue
+            site_totals = totals.setdefault(site, [0, 0])
+            site_totals[0] += size - child_size
+            site_totals[1] += count - child_count
+
+    def top_allocations(self, stage: str) -> list:
+        """Return the top allocation sites of a stage, as (filename, lineno, bytes, blocks),
+        largest first"""
+        sites = sorted(self._allocations[stage].items(), key=lambda item: item[1][0], reverse=True)
+        return [(filename, lineno, size, count)
+                for (filename, lineno), (size, count) in sites[:self.allocation_limit]]
+
+    def top_function(self, stage: str):
+        """Return the function with the most time spent in its own code during a stage, as
+        "file:line(function)", or None if the stage never ran"""
+        if not self._timings[stage][0]:
+            return None
+        stats = pstats.Stats(self._profiles[stage]).stats
+        if not stats:
+            return None
+        (filename, lineno, function), _ = max(stats.items(), key=lambda item: item[1][2])
+        return f"{os.path.basename(filename)}:{lineno}({function})"
+
+    def summary(self) -> list:
+        """Return a dict for each stage that ran, with its 'stage', 'runs', 'seconds', net
+        'allocated_bytes', 'top_function' and 'top_allocation'"""
+        rows = []
+        for stage in STAGES:
+            runs, seconds = self._timings[stage]
+            if not runs:
+                continue
+            top = self.top_allocations(stage)
+            rows.append({
+                'stage': stage,
+                'runs': runs,
+                'seconds': seconds,
+                'allocated_bytes': sum(size for size, _ in self._allocations[stage].values()),
+                'top_function': self.top_function(stage),
+                'top_allocation': f"{os.path.basename(top[0][0])}:{top[0][1]}" if top else None,
+            })
+        return rows
+
+    def write_reports(self) -> list:
+        """
+        Write {stage}.pstats, which can be read with the pstats module or tools such as snakeviz,
+        {stage}_allocations.txt and summary.txt for each stage that ran to the output directory.
+
+        :return: Paths of the files written
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        paths = []
+        for row in self.summary():
+            stage = row['stage']
+            path = os.path.join(self.output_dir, f"{stage}.pstats")
+            self._profiles[stage].dump_stats(path)
+            paths.append(path)
+            path = os.path.join(self.output_dir, f"{stage}_allocations.txt")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(format_allocations(stage, self.top_allocations(stage)))
+            paths.append(path)
+        path = os.path.join(self.output_dir, "summary.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(format_summary(self.summary()))
+        paths.append(path)
+        logger.debug("Wrote profiling reports: %s", paths)
+        return paths
+
+
+def format_allocations(stage: str, allocations: list) -> str:
+    """Return the top allocation sites of a stage as text, with the source line of each"""
+    lines = [f"Top {len(allocations)} allocation sites in {stage}, by memory allocated and not "
+             f"freed by the end of the stage", ""]
+    for n, (filename, lineno, size, count) in enumerate(allocations, start=1):
+        lines.append(f"#{n}: {filename}:{lineno}: {size / 1024:.1f} KiB in {count} blocks")
+        source = linecache.getline(filename, lineno).strip()
+        if source:
+            lines.append(f"    {source}")
+    return "\n".join(lines) + "\n"
+
+
+def format_summary(rows: list) -> str:
+    """Return the rows from Profiler.summary as a text table"""
+    table = [("Stage", "Runs", "Seconds", "Allocated", "Top function", "Top allocation")]
+    for row in rows:
+        table.append((row['stage'], str(row['runs']), f"{row['seconds']:.4f}",
+                      f"{row['allocated_bytes'] / 1024:.1f} KiB", row['top_function'] or "-",
+                      row['top_allocation'] or "-"))
+    widths = [max(len(line[column]) for line in table) for column in range(len(table[0]))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip()
+                     for line in table) + "\n"
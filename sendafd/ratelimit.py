@@ -0,0 +1,150 @@
+"""
+Request budgeting for the NWS API, shared by every apiclient call. A token bucket keeps requests
+under a configured rate, and can be paused when the API answers with Retry-After. A circuit
+breaker stops sending requests to an endpoint that keeps failing, so one broken office does not
+use up retries and request budget on every poll.
+"""
+
+import email.utils
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of sending a request to an endpoint whose circuit breaker is open"""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` requests per second on average, with bursts of up
+    to `burst` requests. Callers reserve the next free slot in the order they arrive, so however
+    many threads are waiting, requests go out at the full rate and no faster.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        :param rate: Requests allowed per second, or 0 for no limit
+        :param burst: Number of requests that may be sent at once after a quiet period
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Wait until a request may be sent, and return the number of seconds waited"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            # during a pause _updated is in the future, and no tokens are added until it ends
+            self._tokens = min(self.burst, self._tokens + max(0.0, now - self._updated) * self.rate)
+            self._updated = max(now, self._updated)
+            # going into debt reserves a slot; the debt is paid off by waiting
+            self._tokens -= 1
+            delay = (self._updated - now) + max(0.0, -self._tokens / self.rate)
+        waited = delay
+        if delay:
+            time.sleep(delay)
+        # a pause may have started while this caller slept
+        while True:
+            with self._lock:
+                remaining = self._paused_until - time.monotonic()
+            if remaining <= 0:
+                return waited
+            time.sleep(remaining)
+            waited += remaining
+
+    def pause(self, seconds: float):
+        """Hold every request for the supplied number of seconds, then resume at the base rate
+        rather than with a burst"""
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._paused_until:
+                self._paused_until = until
+                self._tokens = min(self._tokens, 0.0)
+                self._updated = until
+
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker. After failure_threshold consecutive failures of an endpoint
+    its circuit opens, and requests to it are refused for reset_timeout seconds. A single trial
+    request is then let through; success closes the circuit, and failure opens it again.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 300):
+        """
+        :param failure_threshold: Consecutive failures that open an endpoint's circuit, or 0 to
+        never open it
+        :param reset_timeout: Seconds an open circuit refuses requests before a trial request
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # endpoint -> [consecutive failures, time the circuit opened or None]
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def allow(self, endpoint: str) -> bool:
+        """Return True if a request to the endpoint may be sent"""
+        with self._lock:
+            state = self._endpoints.get(endpoint)
+            if state is None or state[1] is None:
+                return True
+            now = time.monotonic()
+            if now - state[1] < self.reset_timeout:
+                return False
+            # let one trial request through, and keep refusing others until it finishes
+            state[1] = now
+            logger.info(f"Sending a trial request to {endpoint} after "
+                        f"{self.reset_timeout:.0f} seconds")
+            return True
+
+    def record_success(self, endpoint: str):
+        with self._lock:
+            if self._endpoints.pop(endpoint, None) is not None:
+                logger.debug("Circuit for %s closed", endpoint)
+
+    def record_failure(self, endpoint: str):
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            state = self._endpoints.setdefault(endpoint, [0, None])
+            state[0] += 1
+            if state[0] >= self.failure_threshold:
+                if state[1] is None:
+                    logger.warning(f"{endpoint} failed {state[0]} times in a row, not requesting "
+                                   f"it for {self.reset_timeout:.0f} seconds")
+                state[1] = time.monotonic()
+
+    def is_open(self, endpoint: str) -> bool:
+        with self._lock:
+            state = self._endpoints.get(endpoint)
+            return state is not None and state[1] is not None
+
+
+def retry_after_delay(response: requests.Response):
+    """
+    Return the delay in seconds requested by a response's Retry-After header, given either as
+    a number of seconds or an HTTP date, or None if it has no valid Retry-After header.
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
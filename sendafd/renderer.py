@@ -3,48 +3,327 @@ Renders email templates. Takes forecast text from apiclient.py as input and outp
 or plaintext.
 """
 
+import copy
+from collections import OrderedDict
 from email.message import EmailMessage
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import (Environment, FileSystemBytecodeCache, FileSystemLoader, TemplateError,
+                    meta, select_autoescape)
+import hashlib
 import logging
 import json
-from . import apiclient
+import os
+import threading
+from . import apiclient, fileutil, metrics
 
 logger = logging.getLogger(__name__)
 
+# templates bundled with sendAFD, found relative to this file rather than the working directory,
+#  so a run from cron finds them wherever it starts
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
 # create Jinja Environment
-# TODO: handle absolute filesystem paths to templates but default to searching in templates subdirectory
+# TODO: handle absolute filesystem paths to templates
 env = Environment(
-    loader=FileSystemLoader('templates/'),
+    loader=FileSystemLoader(TEMPLATE_DIR),
     autoescape=select_autoescape()
 )
 
+
+def configure_templates(template_dirs: list = None, bytecode_cache_dir: str = None):
+    """
+    Set where the Jinja environment finds templates, and whether compiled templates are kept on
+    disk. With a bytecode cache, a template is only lexed and compiled the first time any process
+    loads it; later processes load the compiled code from the cache. A cache entry is ignored once
+    the template's source has changed.
+
+    :param template_dirs: Directories to search for templates, in order, before the bundled
+    templates directory. Relative paths are resolved against the current working directory now,
+    so later changes to it make no difference.
+    :param bytecode_cache_dir: Directory to keep compiled templates in, created if needed, or None
+    to compile templates in every process
+    """
+    search_path = [os.path.abspath(path) for path in template_dirs or []]
+    if TEMPLATE_DIR not in search_path:
+        search_path.append(TEMPLATE_DIR)
+    env.loader = FileSystemLoader(search_path)
+    if bytecode_cache_dir:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        env.bytecode_cache = FileSystemBytecodeCache(os.path.abspath(bytecode_cache_dir))
+    else:
+        env.bytecode_cache = None
+    logger.debug("Searching for templates in %s, bytecode cache: %s", search_path,
+                 bytecode_cache_dir)
+
+def precompile_templates() -> int:
+    """
+    Compile every template on the search path into the bytecode cache ahead of time, so that no
+    run has to compile one. Templates that fail to compile are logged and skipped.
+
+    :return: Number of templates compiled
+    :raises ValueError: if no bytecode cache is configured
+    """
+    if env.bytecode_cache is None:
+        raise ValueError("A bytecode cache directory is required to precompile templates")
+    count = 0
+    for name in env.list_templates():
+        try:
+            env.get_template(name)
+        except TemplateError:
+            logger.warning(f"Could not compile template {name}", exc_info=True)
+            continue
+        count += 1
+    return count
+
+
+class RenderCache:
+    """
+    Size-bounded LRU cache of rendered template output, keyed by render kind, product id, template
+    name and template fingerprint, so re-rendering the same product with an unchanged template
+    does not enter Jinja again. Entries can optionally also be stored as files in cache_dir, so
+    they survive between runs. The files are pruned to the max_entries most recently used.
+    """
+    def __init__(self, max_entries: int = 64, cache_dir: str = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_digest(key: tuple) -> str:
+        return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+    def get(self, key: tuple):
+        """Return the cached output for key, or None"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        if self.cache_dir:
+            try:
+                with open(os.path.join(self.cache_dir, f"{self.key_digest(key)}.html"), 'r',
+                          encoding='utf-8') as f:
+                    output = f.read()
+            except OSError:
+                pass
+            else:
+                self._store(key, output)
+                self._touch(key)
+                with self._lock:
+                    self.hits += 1
+                return output
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: tuple, output: str):
+        """Store rendered output for key, evicting the least recently used entries if full"""
+        self._store(key, output)
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, f"{self.key_digest(key)}.html")
+            try:
+                fileutil.write_text_atomic(output, path)
+            except OSError:
+                logger.warning(f"Could not write render cache entry at {path}", exc_info=True)
+            else:
+                self.prune()
+
+    def _touch(self, key: tuple):
+        """Mark an entry on disk as recently used, so prune keeps it"""
+        try:
+            os.utime(os.path.join(self.cache_dir, f"{self.key_digest(key)}.html"))
+        except OSError:
+            pass
+
+    def prune(self):
+        """Remove the least recently used entries on disk beyond max_entries"""
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".html"):
+                        try:
+                            entries.append((entry.stat().st_mtime_ns, entry.path))
+                        except OSError:
+                            continue
+        except OSError:
+            return
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        logger.debug("Pruned %s render cache entries from %s", len(entries) - self.max_entries,
+                     self.cache_dir)
+
+    def _store(self, key: tuple, output: str):
+        with self._lock:
+            self._entries[key] = output
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Discard all in-memory entries"""
+        with self._lock:
+            self._entries.clear()
+
+
+render_cache = RenderCache()
+
+def configure_render_cache(max_entries: int = 64, cache_dir: str = None):
+    """Replace the module render cache with a new one using the given settings"""
+    global render_cache
+    render_cache = RenderCache(max_entries=max_entries, cache_dir=cache_dir)
+
+# (template name, file fingerprint) -> names of the templates it extends, includes or imports
+_template_references = {}
+_template_references_lock = threading.Lock()
+
+def file_fingerprint(template_path: str):
+    """Return the modification time and size of a template's source file as a string, or None if
+    the template file can not be found"""
+    for search_path in getattr(env.loader, 'searchpath', []):
+        try:
+            stat = os.stat(os.path.join(search_path, template_path))
+        except OSError:
+            continue
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+    return None
+
+def template_references(template_path: str, fingerprint: str) -> tuple:
+    """Return the names of the templates a template extends, includes or imports. Templates are
+    only parsed again when their fingerprint changes. Names chosen at render time, such as
+    {% include some_variable %}, can not be found."""
+    key = (template_path, fingerprint)
+    with _template_references_lock:
+        if key in _template_references:
+            return _template_references[key]
+    try:
+        source, _, _ = env.loader.get_source(env, template_path)
+        references = tuple(name for name in meta.find_referenced_templates(env.parse(source))
+                           if name is not None)
+    except TemplateError:
+        # a template that fails to load or parse fails again when it is rendered
+        references = ()
+    with _template_references_lock:
+        _template_references[key] = references
+    return references
+
+def template_fingerprint(template_path: str):
+    """
+    Return a string identifying the current version of a template, from the modification time
+    and size of its source file and of every template it extends, includes or imports, directly
+    or indirectly, or None if the template file can not be found.
+    """
+    fingerprint = file_fingerprint(template_path)
+    if fingerprint is None:
+        return None
+    fingerprints = [fingerprint]
+    seen = {template_path}
+    pending = list(template_references(template_path, fingerprint))
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        dependency_fingerprint = file_fingerprint(name)
+        fingerprints.append(f"{name}:{dependency_fingerprint}")
+        if dependency_fingerprint is not None:
+            pending.extend(template_references(name, dependency_fingerprint))
+    return "/".join(fingerprints)
+
+def template_hash(template_path: str):
+    """
+    Return a hash of a template's source, or None if the template file can not be found. Unlike
+    template_fingerprint, this does not change when a template is touched without being edited.
+    """
+    for search_path in getattr(env.loader, 'searchpath', []):
+        try:
+            with open(os.path.join(search_path, template_path), 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            continue
+    return None
+
+def render_cached(kind: str, parsed_afd: apiclient.AreaForecastDiscussion, template_path: str,
+                  **context) -> str:
+    """Render a template with the afd object and any extra context, returning cached output
+    when the same product was already rendered with the same version of the template and the
+    same summary of changes"""
+    fingerprint = template_fingerprint(template_path)
+    changes = context.get('changes')
+    key = (kind, parsed_afd.product_id, template_path, fingerprint,
+           RenderCache.key_digest(changes) if changes is not None else None)
+    if fingerprint is not None:
+        output = render_cache.get(key)
+        if output is not None:
+            logger.debug("Using cached render of %s with %s", parsed_afd.product_id, template_path)
+            metrics.increment('cache_hits_total', cache="render")
+            return output
+        metrics.increment('cache_misses_total', cache="render")
+    with metrics.timer('render', kind=kind):
+        template = env.get_template(template_path)
+        logger.debug("Rendering %s body from template at: %s", kind, template_path)
+        output = template.render(afd=parsed_afd, **context)
+    if fingerprint is not None:
+        render_cache.put(key, output)
+    return output
+
 def build_email(afd: apiclient.AreaForecastDiscussion,
                 sender_email: str,
                 recipient_email: str,
-                template_path: str = None) -> EmailMessage:
+                template_path: str = None,
+                changes: dict = None) -> EmailMessage:
     """Construct an EmailMessage object from AreaForecastDiscussion, template and metadata"""
+    msg = build_email_body(afd, template_path, changes)
+    msg['From'] = sender_email
+    msg['To'] = recipient_email
+    return msg
+
+def build_email_body(afd: apiclient.AreaForecastDiscussion,
+                     template_path: str = None,
+                     changes: dict = None) -> EmailMessage:
+    """Construct an EmailMessage object with content and subject, but no sender or recipient.
+    Use address_email to create copies of it for each recipient. changes is the summary from
+    changes.detect_changes, passed to the template as `changes`."""
     msg = EmailMessage()
     plaintext_body = afd.raw_text
     msg.set_content(plaintext_body)
     if template_path:
         # create a multipart message, including plaintext and html
-        html_body = render_email_body(afd, template_path)
+        html_body = render_email_body(afd, template_path, changes)
         msg.add_alternative(html_body, subtype='html')
     else:
         logger.debug("No template path provided, generating plaintext email")
     msg['Subject'] = f"{afd.issuing_office} Forecast for {afd.issuance_time.strftime('%D %H:%M')}"
+    return msg
+
+def address_email(body: EmailMessage, sender_email: str, recipient_email: str) -> EmailMessage:
+    """Return a copy of an email built by build_email_body, addressed from sender_email to
+    recipient_email. The rendered content is reused, so only the headers differ per recipient."""
+    msg = copy.deepcopy(body)
     msg['From'] = sender_email
     msg['To'] = recipient_email
     return msg
 
-def render_email_body(parsed_afd: apiclient.AreaForecastDiscussion, template_path: str) -> str:
+def render_email_body(parsed_afd: apiclient.AreaForecastDiscussion, template_path: str,
+                      changes: dict = None) -> str:
     """Render email body as plaintext or html using specified jinja template"""
-    template = env.get_template(template_path)
-    logger.debug(f"Rendering email body from template at: {template_path}")
-    return template.render(afd=parsed_afd)
+    return render_cached("email", parsed_afd, template_path, changes=changes)
 
-def render_web(parsed_afd: apiclient.AreaForecastDiscussion, afd_json: dict, template_path: str) -> str:
+def render_web(parsed_afd: apiclient.AreaForecastDiscussion, afd_json: dict, template_path: str,
+               changes: dict = None) -> str:
     """Render html using specified jinja template"""
-    template = env.get_template(template_path)
-    logger.debug(f"Rendering email body from template at: {template_path}")
-    return template.render(afd=parsed_afd, afd_json=afd_json)
\ No newline at end of file
+    return render_cached("web", parsed_afd, template_path, afd_json=afd_json, changes=changes)
+
+def render_index(pages: list, template_path: str) -> str:
+    """Render an index of several AFD pages using specified jinja template"""
+    with metrics.timer('render', kind="index"):
+        return env.get_template(template_path).render(pages=pages)
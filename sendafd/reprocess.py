@@ -0,0 +1,189 @@
+"""
+Bulk reprocessing of archived AFD products, for when a change to the parser or a template means
+every stored product has to be parsed and rendered again. Products are read from an
+archive.Archive one at a time and sent in chunks to a pool of worker processes, which parse and
+render them. Only a bounded number of chunks is in flight at once, so memory use does not
+depend on the size of the archive.
+
+Results go to one of two sinks: a JSON lines file with one record per product, written by the
+main process in archive order, or a directory of rendered HTML files, written by the workers
+themselves so that only a count of results travels back to the main process.
+"""
+
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from . import apiclient, metrics, renderer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 64
+# seconds between progress log messages
+PROGRESS_INTERVAL = 5
+
+
+def init_worker(search_path: list, bytecode_cache_dir: str = None):
+    """
+    Set up a worker process: look templates up in the same directories and bytecode cache as the
+    main process, and skip the render cache, since each product is only rendered once.
+    """
+    renderer.configure_templates(search_path, bytecode_cache_dir)
+    renderer.configure_render_cache(max_entries=0)
+
+
+def product_record(region: str, afd: apiclient.AreaForecastDiscussion) -> dict:
+    """Return the JSON lines record for a parsed product, without any rendered output"""
+    return {
+        'id': afd.product_id,
+        'region': region,
+        'issuing_office': afd.issuing_office,
+        'issuance_time': afd.issuance_time.isoformat(),
+        'sections': [{'name': section.name,
+                      'body': section.body,
+                      'subsections': [{'name': subsection.name, 'body': subsection.body}
+                                      for subsection in section.subsections]}
+                     for section in afd.sections],
+    }
+
+
+def process_chunk(region: str, products: list, template: str = None, web: bool = False,
+                  output_dir: str = None) -> tuple:
+    """
+    Parse, and render if a template is given, a chunk of products from one region. Runs in a
+    worker process.
+
+    :param region: Region code of the products
+    :param products: List of AFD products, as stored in the archive
+    :param template: Template to render each product with, or None to only parse them
+    :param web: Render with renderer.render_web instead of renderer.render_email_body
+    :param output_dir: Write each rendered product to output_dir/{region}/{product id}.html
+    instead of returning JSON lines
+    :return: Tuple of (JSON lines text, number of products processed, list of (product id,
+    error message) for products that failed)
+    """
+    lines = []
+    failures = []
+    if output_dir:
+        region_dir = os.path.join(output_dir, region.lower())
+        os.makedirs(region_dir, exist_ok=True)
+    for product in products:
+        try:
+            afd = apiclient.AreaForecastDiscussion(product)
+            html = None
+            if template:
+                if web:
+                    html = renderer.render_web(afd, product, template)
+                else:
+                    html = renderer.render_email_body(afd, template)
+            if output_dir:
+                apiclient.write_text_atomic(html,
+                                            os.path.join(region_dir, f"{afd.product_id}.html"))
+            else:
+                record = product_record(region, afd)
+                if html is not None:
+                    record['html'] = html
+                lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            failures.append((product.get('id'), f"{type(e).__name__}: {e}"))
+    return "".join(lines), len(products) - len(failures), failures
+
+
+def chunked(archive, regions: list, chunk_size: int, start=None, end=None):
+    """Yield (region, list of products) chunks of at most chunk_size products from the archive"""
+    for region in regions:
+        chunk = []
+        for product in archive.query(region, start, end):
+            chunk.append(product)
+            if len(chunk) >= chunk_size:
+                yield region, chunk
+                chunk = []
+        if chunk:
+            yield region, chunk
+
+
+def reprocess(archive, regions: list = None, template: str = None, web: bool = False,
+              jsonl_path: str = None, output_dir: str = None, start=None, end=None,
+              processes: int = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """
+    Parse, and optionally render, every archived product for the supplied regions using a pool
+    of worker processes, writing the results to a JSON lines file or a directory of HTML files.
+
+    :param archive: archive.Archive to read products from
+    :param regions: Region codes to reprocess, defaults to every region in the archive
+    :param template: Template to render each product with, or None to only parse them
+    :param web: Render with renderer.render_web instead of renderer.render_email_body
+    :param jsonl_path: Write one JSON record per product to this file, with its sections and any
+    rendered output under 'html'. The file is replaced atomically once every product is written.
+    :param output_dir: Write each rendered product to output_dir/{region}/{product id}.html
+    instead. Requires template.
+    :param start: Earliest issuance time to include, see archive.Archive.query
+    :param end: Issuance time to stop before, see archive.Archive.query
+    :param processes: Number of worker processes, defaults to the number of CPUs
+    :param chunk_size: Number of products sent to a worker at a time
+    :return: Dict with counts of 'processed' and 'failed' products
+    """
+    if (jsonl_path is None) == (output_dir is None):
+        raise ValueError("Exactly one of jsonl_path and output_dir is required")
+    if output_dir and not template:
+        raise ValueError("A template is required to write HTML files")
+    regions = [r.upper() for r in regions] if regions else archive.regions()
+    processes = processes or os.cpu_count() or 1
+    # enough chunks in flight to keep every worker busy while finished chunks are written
+    max_in_flight = processes * 2
+    search_path = [os.path.abspath(path) for path in getattr(renderer.env.loader, 'searchpath', [])]
+    bytecode_cache_dir = getattr(renderer.env.bytecode_cache, 'directory', None)
+    counts = {'processed': 0, 'failed': 0}
+    out = None
+    tmp_path = None
+    if jsonl_path:
+        tmp_path = f"{jsonl_path}.{os.getpid()}.tmp"
+        out = open(tmp_path, 'w', encoding='utf-8')
+    started = time.perf_counter()
+    last_progress = started
+
+    def collect(future):
+        nonlocal last_progress
+        text, processed, failures = future.result()
+        if out is not None:
+            out.write(text)
+        counts['processed'] += processed
+        counts['failed'] += len(failures)
+        for product_id, error in failures:
+            logger.warning(f"Could not reprocess product {product_id}: {error}")
+        now = time.perf_counter()
+        if now - last_progress >= PROGRESS_INTERVAL:
+            last_progress = now
+            logger.info(f"Reprocessed {counts['processed']} products "
+                        f"({counts['processed'] / (now - started):.0f}/s), "
+                        f"{counts['failed']} failed")
+
+    try:
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                 initargs=(search_path, bytecode_cache_dir)) as pool:
+            # results are collected oldest first, so JSON lines are written in archive order
+            in_flight = deque()
+            for region, products in chunked(archive, regions, chunk_size, start, end):
+                if len(in_flight) >= max_in_flight:
+                    collect(in_flight.popleft())
+                in_flight.append(pool.submit(process_chunk, region, products, template, web,
+                                             output_dir))
+            while in_flight:
+                collect(in_flight.popleft())
+        if out is not None:
+            out.close()
+            os.replace(tmp_path, jsonl_path)
+    except BaseException:
+        if out is not None:
+            out.close()
+            os.remove(tmp_path)
+        raise
+    elapsed = time.perf_counter() - started
+    metrics.registry.observe('reprocess', elapsed)
+    metrics.increment('products_reprocessed_total', counts['processed'])
+    logger.info(f"Reprocessed {counts['processed']} products in {elapsed:.1f}s, "
+                f"{counts['failed']} failed")
+    return counts
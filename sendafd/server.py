@@ -0,0 +1,221 @@
+"""
+HTTP server for rendered AFD pages. Serves render_web output for any region at /afd/{region},
+rendering a page only when a new product arrives and answering every other request from memory.
+"""
+
+import email.utils
+import hashlib
+import http.server
+import logging
+import os
+import re
+import threading
+import time
+from datetime import timezone
+from urllib.parse import urlsplit
+
+from . import apiclient, metrics, renderer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATE = "sample_web_template.html"
+DEFAULT_POLL_INTERVAL = 300
+# kept apart from the monitor mode cache in the working directory, so serving pages never stops an
+#  AFD from being emailed
+DEFAULT_CACHE_DIR = "server_cache"
+# every NWS region code is three letters or digits. Other strings are rejected before they reach
+#  the page cache, even with region validation off, so requests can not add entries without limit.
+REGION_CODE_REGEX = re.compile(r"[A-Z0-9]{3}")
+
+
+class Page:
+    """A rendered AFD page with its HTTP validators"""
+    __slots__ = ('product_id', 'body', 'etag', 'last_modified', 'last_modified_time')
+
+    def __init__(self, product_id: str, body: bytes, issuance_time):
+        self.product_id = product_id
+        self.body = body
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.last_modified_time = issuance_time
+        self.last_modified = email.utils.format_datetime(issuance_time, usegmt=True)
+
+
+class PageCache:
+    """
+    Rendered pages for each region. A region's product is fetched from the NWS API at most once
+    per poll_interval, however many requests arrive for it, and only requests arriving after the
+    interval wait for the fetch. Fetches use the monitor cache and conditional requests, so an
+    unchanged AFD costs one small request and no rendering.
+    """
+    def __init__(self, template: str = DEFAULT_TEMPLATE, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 cache=None, ignore_region_validation: bool = False,
+                 cache_dir: str = DEFAULT_CACHE_DIR):
+        """
+        :param template: Template used to render each page with renderer.render_web
+        :param poll_interval: Seconds a region's page is served before checking for a new product
+        :param cache: Monitor cache backend, see apiclient.fetch_afd. Defaults to an in-memory
+        MonitorCache written through to JSON files in cache_dir.
+        :param ignore_region_validation: Do not validate region codes against the NWS API
+        :param cache_dir: Directory for the default cache, created if needed
+        """
+        self.template = template
+        self.poll_interval = poll_interval
+        if cache is None:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache = apiclient.MonitorCache(cache_dir=cache_dir, in_memory=True)
+        self.cache = cache
+        self.ignore_region_validation = ignore_region_validation
+        self._pages = {}
+        self._checked = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def region_lock(self, region: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(region, threading.Lock())
+
+    def get(self, region: str) -> dict:
+        """
+        Return the current page for a region, fetching and rendering it if the poll interval has
+        passed.
+
+        :param region: Region code
+        :return: {'response': Page or None, 'error': ...}
+        """
+        region = region.upper()
+        if not REGION_CODE_REGEX.fullmatch(region):
+            return {'response': None, 'error': "Invalid region code"}
+        if not self.ignore_region_validation:
+            try:
+                valid_codes = apiclient.load_region_index()
+            except (OSError, ValueError):
+                logger.exception("Could not load list of region codes")
+                return {'response': None, 'error': "Could not validate region code"}
+            if region not in valid_codes:
+                return {'response': None, 'error': "Invalid region code"}
+        page = self._pages.get(region)
+        if page is not None and time.monotonic() - self._checked.get(region, 0) < self.poll_interval:
+            metrics.increment('cache_hits_total', cache="page")
+            return {'response': page, 'error': None}
+        # only one request per region fetches; the others wait here and then use its result
+        with self.region_lock(region):
+            page = self._pages.get(region)
+            if page is not None and time.monotonic() - self._checked.get(region, 0) < self.poll_interval:
+                metrics.increment('cache_hits_total', cache="page")
+                return {'response': page, 'error': None}
+            metrics.increment('cache_misses_total', cache="page")
+            return self.refresh(region)
+
+    def refresh(self, region: str) -> dict:
+        """Fetch the newest product for a region and render it if it is not the page already held"""
+        result = apiclient.fetch_afd(region, monitor=True, ignore_region_validation=True,
+                                     cache=self.cache)
+        page = self._pages.get(region)
+        self._checked[region] = time.monotonic()
+        if result['error'] is not None:
+            if page is not None:
+                logger.warning(f"Could not fetch AFD for {region}, serving the last page: "
+                               f"{result['error']}")
+                return {'response': page, 'error': None}
+            return {'response': None, 'error': result['error']}
+        product = result['response']
+        if product is None:
+            if page is not None:
+                return {'response': page, 'error': None}
+            # unchanged since a previous process cached it, but not yet rendered by this one
+            product = self.cache.get_product(region.lower())
+            if not product:
+                return {'response': None, 'error': "No cached product"}
+        if page is None or page.product_id != product['id']:
+            page = self.render(product)
+            self._pages[region] = page
+        return {'response': page, 'error': None}
+
+    def render(self, product: dict) -> Page:
+        parsed_afd = apiclient.AreaForecastDiscussion(product)
+        logger.info(f"Rendering new product {parsed_afd.product_id} for {parsed_afd.issuing_office}")
+        html = renderer.render_web(parsed_afd=parsed_afd, afd_json=product,
+                                   template_path=self.template)
+        return Page(parsed_afd.product_id, html.encode('utf-8'), parsed_afd.issuance_time)
+
+
+def not_modified(headers, page: Page) -> bool:
+    """Return True if a request's conditional headers show the client already has the page"""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # weak comparison, as used for GET requests
+        return "*" in tags or page.etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return page.last_modified_time.replace(microsecond=0) <= since
+    return False
+
+
+class AFDRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve /afd/{region} from the server's PageCache"""
+    server_version = "sendafd"
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def respond(self, send_body: bool):
+        parts = urlsplit(self.path).path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "afd" or not parts[1]:
+            self.send_error(404)
+            return
+        result = self.server.pages.get(parts[1])
+        if result['error'] == "Invalid region code":
+            self.send_error(404, "Unknown region code")
+            return
+        if result['error'] is not None:
+            self.send_error(502, result['error'])
+            return
+        page = result['response']
+        if not_modified(self.headers, page):
+            self.send_response(304)
+            self.send_validators(page)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_validators(page)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page.body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(page.body)
+
+    def send_validators(self, page: Page):
+        self.send_header("ETag", page.etag)
+        self.send_header("Last-Modified", page.last_modified)
+        self.send_header("Cache-Control", "no-cache")
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class AFDServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, pages: PageCache):
+        super().__init__(address, AFDRequestHandler)
+        self.pages = pages
+
+
+def serve(host: str = "127.0.0.1", port: int = 8080, pages: PageCache = None):
+    """Serve AFD pages until interrupted"""
+    server = AFDServer((host, port), pages or PageCache())
+    logger.info(f"Serving AFD pages at http://{host}:{server.server_address[1]}/afd/{{region}}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
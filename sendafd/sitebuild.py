@@ -0,0 +1,113 @@
+"""
+Incremental static site builder. Writes one rendered page per region and an index page into an
+output directory, alongside a manifest recording the product id and template hash each page was
+built from, so a rebuild only renders and writes the pages whose inputs changed.
+"""
+
+import logging
+import os
+
+from . import apiclient, renderer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATE = "sample_web_template.html"
+DEFAULT_INDEX_TEMPLATE = "sample_index_template.html"
+MANIFEST_FILENAME = "manifest.json"
+INDEX_FILENAME = "index.html"
+# default directory for the cache of fetched AFDs, inside the output directory
+CACHE_DIRNAME = ".cache"
+
+
+def page_filename(region: str) -> str:
+    return f"{region.lower()}.html"
+
+
+def read_manifest(output_dir: str) -> dict:
+    """Return the manifest of a previous build, or an empty manifest"""
+    manifest = apiclient.read_afd_cache(os.path.join(output_dir, MANIFEST_FILENAME))
+    manifest.setdefault('pages', {})
+    manifest.setdefault('index', {})
+    return manifest
+
+
+def build_site(output_dir: str, products: dict, template: str = DEFAULT_TEMPLATE,
+               index_template: str = DEFAULT_INDEX_TEMPLATE) -> dict:
+    """
+    Render a page for each region's product and an index page linking to them, skipping any
+    page whose product id and template are unchanged since the last build and whose file still
+    exists.
+
+    :param output_dir: Directory to write the site to, created if needed
+    :param products: Dict mapping region code to raw AFD product, as returned by the NWS API
+    :param template: Template used to render each region's page
+    :param index_template: Template used to render the index page, or None for no index
+    :return: {'written': list of files written, 'unchanged': list of files left as they were}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = read_manifest(output_dir)
+    template_hash = renderer.template_hash(template)
+    written = []
+    unchanged = []
+    index_entries = []
+    for region, product in sorted(products.items()):
+        region = region.upper()
+        filename = page_filename(region)
+        inputs = {'product_id': product['id'], 'template': template,
+                  'template_hash': template_hash}
+        page_path = os.path.join(output_dir, filename)
+        parsed_afd = apiclient.AreaForecastDiscussion(product)
+        index_entries.append({'region': region, 'filename': filename,
+                              'product_id': parsed_afd.product_id,
+                              'issuing_office': parsed_afd.issuing_office,
+                              'issuance_time': parsed_afd.issuance_time})
+        if manifest['pages'].get(region) == inputs and os.path.exists(page_path):
+            unchanged.append(filename)
+            continue
+        logger.debug("Rendering page for %s from product %s", region, product['id'])
+        html = renderer.render_web(parsed_afd=parsed_afd, afd_json=product, template_path=template)
+        apiclient.write_text_atomic(html, page_path)
+        manifest['pages'][region] = inputs
+        written.append(filename)
+    if index_template:
+        inputs = {'pages': [[entry['region'], entry['product_id']] for entry in index_entries],
+                  'template': index_template,
+                  'template_hash': renderer.template_hash(index_template)}
+        index_path = os.path.join(output_dir, INDEX_FILENAME)
+        if manifest['index'] == inputs and os.path.exists(index_path):
+            unchanged.append(INDEX_FILENAME)
+        else:
+            apiclient.write_text_atomic(renderer.render_index(index_entries, index_template),
+                                        index_path)
+            manifest['index'] = inputs
+            written.append(INDEX_FILENAME)
+    if written:
+        apiclient.write_json_atomic(manifest, os.path.join(output_dir, MANIFEST_FILENAME))
+    return {'written': written, 'unchanged': unchanged}
+
+
+def fetch_products(regions: list, cache, fetch: bool = True, max_workers: int = 8,
+                   ignore_region_validation: bool = True) -> dict:
+    """
+    Return the newest product for each region. Products are fetched in monitor mode, so an
+    unchanged product costs a conditional request and is read from the cache. With fetch False,
+    only cached products are used.
+
+    :return: Dict mapping region code to raw AFD product, for each region with a product
+    """
+    products = {}
+    if fetch:
+        results = apiclient.fetch_afds(regions, monitor=True,
+                                       ignore_region_validation=ignore_region_validation,
+                                       max_workers=max_workers, cache=cache)
+    else:
+        results = {region.upper(): {'response': None, 'error': None} for region in regions}
+    for region, result in results.items():
+        if result['error'] is not None:
+            logger.error(f"Error fetching AFD for {region}: {result['error']}")
+        product = result['response'] or cache.get_product(region.lower())
+        if product:
+            products[region] = product
+        elif result['error'] is None:
+            logger.warning(f"No cached AFD for {region}, skipping its page")
+    return products
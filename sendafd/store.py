@@ -0,0 +1,129 @@
+"""
+SQLite-backed store for fetched AFD products, used as a monitor mode cache backend in place of
+the per-region cache_{region}.json files. A single database file can be shared by many regions
+and processes.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    product_id TEXT PRIMARY KEY,
+    region TEXT NOT NULL,
+    issuance_time TEXT,
+    product TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_region_time ON products (region, issuance_time);
+CREATE TABLE IF NOT EXISTS last_seen (
+    region TEXT PRIMARY KEY,
+    product_id TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS validators (
+    region TEXT PRIMARY KEY,
+    validators TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS section_fingerprints (
+    region TEXT PRIMARY KEY,
+    product_id TEXT NOT NULL,
+    sections TEXT NOT NULL
+);
+"""
+
+
+class SQLiteCache:
+    """
+    Monitor mode cache backend storing products, the last seen product id, HTTP validators and
+    section fingerprints for each region in a single SQLite database. Products are indexed by
+    region, product id and issuance time. Every update is a single transaction, and the database
+    uses write-ahead logging so several processes can read while another writes.
+    """
+    def __init__(self, db_path: str = "sendafd.db", timeout: float = 30):
+        """
+        :param db_path: Path to the SQLite database file, created if it does not exist
+        :param timeout: Seconds to wait for a lock held by another process before failing
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        # sqlite3 connections can not be shared between threads, so keep one per thread
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        """Return this thread's connection to the database, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            logger.debug("Opening cache database at %s", self.db_path)
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close this thread's connection to the database"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def last_seen_id(self, region: str):
+        """Return the product id of the last AFD stored for the region, or None"""
+        row = self.connection().execute("SELECT product_id FROM last_seen WHERE region = ?",
+                                        (region.lower(),)).fetchone()
+        return row[0] if row else None
+
+    def get_product(self, region: str) -> dict:
+        """Return the last AFD product stored for the region, or an empty dict"""
+        row = self.connection().execute(
+            "SELECT p.product FROM last_seen l JOIN products p ON p.product_id = l.product_id "
+            "WHERE l.region = ?", (region.lower(),)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def get_product_by_id(self, product_id: str) -> dict:
+        """Return a stored AFD product by its product id, or an empty dict"""
+        row = self.connection().execute("SELECT product FROM products WHERE product_id = ?",
+                                        (product_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def set_product(self, region: str, product: dict):
+        """Store an AFD product and record it as the last seen product for the region"""
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO products (product_id, region, issuance_time, "
+                         "product) VALUES (?, ?, ?, ?)",
+                         (product['id'], region.lower(), product.get('issuanceTime'),
+                          json.dumps(product, ensure_ascii=False)))
+            conn.execute("INSERT OR REPLACE INTO last_seen (region, product_id, updated) "
+                         "VALUES (?, ?, ?)", (region.lower(), product['id'], time.time()))
+
+    def get_validators(self, region: str) -> dict:
+        """Return the HTTP validators stored for the region, keyed by endpoint URL"""
+        row = self.connection().execute("SELECT validators FROM validators WHERE region = ?",
+                                        (region.lower(),)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def set_validators(self, region: str, validators: dict):
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO validators (region, validators) VALUES (?, ?)",
+                         (region.lower(), json.dumps(validators)))
+
+    def get_fingerprints(self, region: str) -> dict:
+        """Return the section fingerprints stored for the region, as {'product_id', 'sections'},
+        or an empty dict"""
+        row = self.connection().execute(
+            "SELECT product_id, sections FROM section_fingerprints WHERE region = ?",
+            (region.lower(),)).fetchone()
+        return {'product_id': row[0], 'sections': json.loads(row[1])} if row else {}
+
+    def set_fingerprints(self, region: str, product_id: str, sections: dict):
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO section_fingerprints (region, product_id, "
+                         "sections) VALUES (?, ?, ?)",
+                         (region.lower(), product_id, json.dumps(sections)))
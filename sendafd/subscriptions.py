@@ -0,0 +1,132 @@
+"""
+Deliver AFDs to many subscribers. Each region is fetched and parsed once and each distinct
+(product, template) pair is rendered once, then copies of the rendered email are addressed to
+every subscriber of that region.
+"""
+
+import json
+import logging
+
+from . import apiclient, changes, renderer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATE = 'default_email_template.html'
+
+
+def load_subscriptions(subscriptions_path: str) -> dict:
+    """
+    Read a subscription file mapping each recipient to the regions they receive. The file is
+    JSON, for example:
+
+        {
+            "foo@bar.com": {"regions": ["PSR", "TOP"]},
+            "baz@bar.com": {"regions": ["PSR"], "plaintext": true},
+            "qux@bar.com": {"regions": ["OKX"], "template": "my_template.html"}
+        }
+
+    :param subscriptions_path: Path to subscription file
+    :return: Dict mapping recipient to {'regions': [...], 'template': ..., 'plaintext': ...}
+    :raises ValueError: if the file is not a valid subscription file
+    """
+    with open(subscriptions_path, 'r', encoding='utf-8') as f:
+        raw_subscriptions = json.load(f)
+    return parse_subscriptions(raw_subscriptions)
+
+def parse_subscriptions(raw_subscriptions: dict) -> dict:
+    """Validate subscriptions loaded from JSON and fill in defaults, see load_subscriptions"""
+    if not isinstance(raw_subscriptions, dict) or not raw_subscriptions:
+        raise ValueError("Subscriptions must map at least one recipient to its settings")
+    subscriptions = {}
+    for recipient, settings in raw_subscriptions.items():
+        if not isinstance(settings, dict):
+            raise ValueError(f"Subscription for {recipient} must be an object with a regions list")
+        regions = settings.get('regions')
+        if not isinstance(regions, list) or not regions:
+            raise ValueError(f"Subscription for {recipient} must have a non-empty list of regions")
+        if not all(isinstance(region, str) for region in regions):
+            raise ValueError(f"Subscription for {recipient} has a region that is not a string")
+        if not isinstance(settings.get('template', DEFAULT_TEMPLATE), str):
+            raise ValueError(f"Subscription for {recipient} has a template that is not a string")
+        if not isinstance(settings.get('plaintext', False), bool):
+            raise ValueError(f"Subscription for {recipient} has a plaintext setting that is not "
+                             f"true or false")
+        subscriptions[recipient] = {
+            'regions': list(dict.fromkeys(r.upper() for r in settings['regions'])),
+            'template': settings.get('template', DEFAULT_TEMPLATE),
+            'plaintext': settings.get('plaintext', False),
+        }
+    return subscriptions
+
+def subscribed_regions(subscriptions: dict) -> list:
+    """Return each distinct region code in the subscriptions, in the order first subscribed"""
+    return list(dict.fromkeys(region for s in subscriptions.values() for region in s['regions']))
+
+def build_messages(results: dict, subscriptions: dict, sender_email: str):
+    """
+    Generate an addressed email for every subscriber of each region with a new AFD. Each region
+    is parsed at most once and each (product, template) pair is rendered at most once. A region
+    whose AFD fails to parse or render is logged and skipped, and every other region is still sent.
+
+    :param results: Dict mapping region code to fetch result, as returned by apiclient.fetch_afds
+    :param subscriptions: Subscriptions returned by load_subscriptions
+    :param sender_email: Sender's email address
+    :return: Generator of (recipient, region, EmailMessage) tuples
+    """
+    parsed_afds = {}
+    bodies = {}
+    # regions whose AFD could not be parsed or rendered; their subscribers are skipped
+    failed_regions = set()
+    for recipient, subscription in subscriptions.items():
+        template = None if subscription['plaintext'] else subscription['template']
+        for region in subscription['regions']:
+            result = results.get(region)
+            if result is None or result['response'] is None or region in failed_regions:
+                continue
+            try:
+                if region not in parsed_afds:
+                    # reuse the product parsed by changes.detect_changes, if any
+                    parsed_afds[region] = result.get('afd') or \
+                        apiclient.AreaForecastDiscussion(result['response'])
+                afd = parsed_afds[region]
+                body_key = (afd.product_id, template)
+                if body_key not in bodies:
+                    logger.debug("Rendering %s with template %s", afd.product_id, template)
+                    bodies[body_key] = renderer.build_email_body(afd, template,
+                                                                 result.get('changes'))
+            except Exception:
+                logger.exception(f"Unexpected error processing AFD for {region}, no emails will "
+                                 f"be sent for it")
+                failed_regions.add(region)
+                continue
+            yield recipient, region, renderer.address_email(bodies[body_key], sender_email, recipient)
+    logger.debug("Rendered %s distinct emails for %s products", len(bodies), len(parsed_afds))
+
+def deliver(results: dict, subscriptions: dict, sender_email: str, sender, cache=None) -> dict:
+    """
+    Email each new AFD in results to its subscribers using a persistent SMTP sender.
+
+    :param results: Dict mapping region code to fetch result, as returned by apiclient.fetch_afds
+    :param subscriptions: Subscriptions returned by load_subscriptions
+    :param sender_email: Sender's email address
+    :param sender: emailclient.SMTPSender, or any object with a send(EmailMessage) -> bool method
+    :param cache: Monitor cache to record each region's section fingerprints in, see
+    changes.record_sent, once an email for it has been sent, or None
+    :return: Dict with counts of 'sent' and 'failed' emails
+    """
+    for region, result in results.items():
+        if result['error'] is not None:
+            logger.error(f"Error fetching data from NWS API for {region}: {result['error']}")
+    counts = {'sent': 0, 'failed': 0}
+    recorded_regions = set()
+    for recipient, region, email in build_messages(results, subscriptions, sender_email):
+        if sender.send(email):
+            counts['sent'] += 1
+            if cache is not None and region not in recorded_regions:
+                changes.record_sent(cache, region, results[region])
+                recorded_regions.add(region)
+        else:
+            counts['failed'] += 1
+            logger.critical(f"Failed to send {region} AFD to {recipient}")
+    logger.info(f"Sent {counts['sent']} emails, {counts['failed']} failed")
+    return counts
@@ -1,18 +1,41 @@
 """Test sendafd.apiclient module"""
 import json
+import os
 
 import pytest
-import apiclient
+from sendafd import apiclient, store
 from unittest.mock import Mock
 
 import requests
 
+# directory containing the json API response fixtures
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(autouse=True)
+def fresh_session(monkeypatch, tmp_path):
+    """Give each test a new shared session and region index, skip retry backoff delays and keep
+    cache files out of the source tree"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(apiclient.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(apiclient, 'session_settings', dict(apiclient.session_settings))
+    monkeypatch.setattr(apiclient, 'region_cache_settings', dict(apiclient.region_cache_settings))
+    monkeypatch.setattr(apiclient, 'rate_limit_settings', dict(apiclient.rate_limit_settings))
+    apiclient.configure_rate_limit()
+    apiclient.close_session()
+    apiclient.clear_region_index()
+    yield
+    apiclient.close_session()
+    apiclient.clear_region_index()
+
 
 def mocked_requests_get(*args, **kwargs):
     class MockResponse:
         def __init__(self, json_data, status_code):
             self.json_data = json_data
             self.status_code = status_code
+            self.headers = {}
+            self.content = json.dumps(json_data).encode('utf-8')
 
         def json(self):
             return self.json_data
@@ -167,46 +190,53 @@ def mocked_requests_get(*args, **kwargs):
         }, 200)
     # response for AFD list for region PSR
     elif args[0] == "https://api.weather.gov/products/types/afd/locations/psr":
-        with open("psr_afd_list_response.json", 'r', encoding='utf-8') as f:
+        with open(os.path.join(FIXTURE_DIR, "psr_afd_list_response.json"), 'r', encoding='utf-8') as f:
             json_response = json.load(f)
         return MockResponse(json_response, 200)
     # response for AFD list for region TOP
     elif args[0] == "https://api.weather.gov/products/types/afd/locations/top":
-        with open("top_afd_list_response.json", 'r', encoding='utf-8') as f:
+        with open(os.path.join(FIXTURE_DIR, "top_afd_list_response.json"), 'r', encoding='utf-8') as f:
             json_response = json.load(f)
         return MockResponse(json_response, 200)
     # response for AFD list for region LOX
     elif args[0] == "https://api.weather.gov/products/types/afd/locations/lox":
-        with open("lox_afd_list_response.json", 'r', encoding='utf-8') as f:
+        with open(os.path.join(FIXTURE_DIR, "lox_afd_list_response.json"), 'r', encoding='utf-8') as f:
             json_response = json.load(f)
         return MockResponse(json_response, 200)
     # response for AFD list for region OKX
     elif args[0] == "https://api.weather.gov/products/types/afd/locations/okx":
-        with open("okx_afd_list_response.json", 'r', encoding='utf-8') as f:
+        with open(os.path.join(FIXTURE_DIR, "okx_afd_list_response.json"), 'r', encoding='utf-8') as f:
             json_response = json.load(f)
         return MockResponse(json_response, 200)
     # response for single AFD product for region PSR
     elif args[0] == "https://api.weather.gov/products/1d6cd33d-4017-4dd1-8dce-41d4541de35a":
-        with open("psr_afd_response.json", 'r', encoding='utf-8') as f:
+        with open(os.path.join(FIXTURE_DIR, "psr_afd_response.json"), 'r', encoding='utf-8') as f:
             json_response = json.load(f)
         return MockResponse(json_response, 200)
     # response for single AFD product for region TOP
     elif args[0] == "https://api.weather.gov/products/1f29f93c-583b-4144-ae22-8624a5e56504":
-        with open("top_afd_response.json", 'r', encoding='utf-8') as f:
+        with open(os.path.join(FIXTURE_DIR, "top_afd_response.json"), 'r', encoding='utf-8') as f:
             json_response = json.load(f)
         return MockResponse(json_response, 200)
     # response for single AFD product for region LOX
     elif args[0] == "https://api.weather.gov/products/a922a688-acb5-4bb8-8a22-55c6a107b61d":
-        with open("lox_afd_response.json", 'r', encoding='utf-8') as f:
+        with open(os.path.join(FIXTURE_DIR, "lox_afd_response.json"), 'r', encoding='utf-8') as f:
             json_response = json.load(f)
         return MockResponse(json_response, 200)
     # response for single AFD product for region OKX
     elif args[0] == "https://api.weather.gov/products/6893e2af-17ef-471a-b7bc-4a74a8af0374":
-        with open("okx_afd_response.json", 'r', encoding='utf-8') as f:
+        with open(os.path.join(FIXTURE_DIR, "okx_afd_response.json"), 'r', encoding='utf-8') as f:
             json_response = json.load(f)
         return MockResponse(json_response, 200)
     return MockResponse(None, 404)
 
+def mocked_region_codes_get(*args, **kwargs):
+    """Mock for requests.get that also answers the list of region codes at the URL apiclient
+    requests it from"""
+    if args[0] == "https://api.weather.gov/products/types/AFD/locations":
+        return mocked_requests_get("https://api.weather.gov/products/types/afd/locations", **kwargs)
+    return mocked_requests_get(*args, **kwargs)
+
 
 def mocked_requests_get_500(*args, **kwargs):
     """Mock for requests.get that always returns a 500 error code and associated API response"""
@@ -222,6 +252,8 @@ def mocked_requests_get_500(*args, **kwargs):
                 "additionalProp1": {}
             }
             self.status_code = 500
+            self.headers = {}
+            self.content = json.dumps(self.json_data).encode('utf-8')
 
         def json(self):
             return self.json_data
@@ -239,7 +271,7 @@ def test_print_region_codes(capsys):
 def test_500_afd_response(monkeypatch, caplog):
     """Test API returning 500 when fetching list of AFD products"""
     requests_mock = Mock(side_effect=mocked_requests_get)
-    monkeypatch.setattr('requests.get', requests_mock)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
     response = apiclient.fetch_afd("ERR")
     assert response == {'response': None, 'error': "HTTP error fetching list of AFD products"}
     assert "HTTP error fetching list of AFD products" in caplog.text
@@ -247,15 +279,15 @@ def test_500_afd_response(monkeypatch, caplog):
 def test_500_response(monkeypatch, caplog):
     """Test API returning 500 on any request"""
     requests_mock = Mock(side_effect=mocked_requests_get_500)
-    monkeypatch.setattr('requests.get', requests_mock)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
     response = apiclient.fetch_afd("PSR")
-    assert response == {'response': None, 'error': "HTTP error fetching list of region codes"}
-    assert "HTTP error fetching list of region codes" in caplog.text
+    assert response == {'response': None, 'error': "HTTP error fetching list of AFD products"}
+    assert "HTTP error fetching list of AFD products" in caplog.text
 
 def test_psr_afd_response(monkeypatch):
     """Test fetching an example AFD for PSR region, without monitoring cache"""
     requests_mock = Mock(side_effect=mocked_requests_get)
-    monkeypatch.setattr('requests.get', requests_mock)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
     api_response = apiclient.fetch_afd("PSR")
     assert api_response['error'] is None
     assert api_response['response'] is not None
@@ -269,7 +301,7 @@ def test_psr_afd_response(monkeypatch):
 def test_top_afd_response(monkeypatch):
     """Test fetching an example AFD for TOP region, without monitoring cache"""
     requests_mock = Mock(side_effect=mocked_requests_get)
-    monkeypatch.setattr('requests.get', requests_mock)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
     api_response = apiclient.fetch_afd("TOP")
     assert api_response['error'] is None
     assert api_response['response'] is not None
@@ -283,7 +315,7 @@ def test_top_afd_response(monkeypatch):
 def test_lox_afd_response(monkeypatch):
     """Test fetching an example AFD for LOX region, without monitoring cache"""
     requests_mock = Mock(side_effect=mocked_requests_get)
-    monkeypatch.setattr('requests.get', requests_mock)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
     api_response = apiclient.fetch_afd("LOX")
     assert api_response['error'] is None
     assert api_response['response'] is not None
@@ -297,7 +329,7 @@ def test_lox_afd_response(monkeypatch):
 def test_okx_afd_response(monkeypatch):
     """Test fetching an example AFD for OKX region, without monitoring cache"""
     requests_mock = Mock(side_effect=mocked_requests_get)
-    monkeypatch.setattr('requests.get', requests_mock)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
     api_response = apiclient.fetch_afd("OKX")
     assert api_response['error'] is None
     assert api_response['response'] is not None
@@ -310,7 +342,7 @@ def test_okx_afd_response(monkeypatch):
 
 def test_psr_afd_parsing(monkeypatch):
     requests_mock = Mock(side_effect=mocked_requests_get)
-    monkeypatch.setattr('requests.get', requests_mock)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
     api_response = apiclient.fetch_afd("PSR")
     parsed_afd = apiclient.AreaForecastDiscussion(raw_afd=api_response['response'])
     # test time parsing
@@ -351,7 +383,7 @@ def test_psr_afd_parsing(monkeypatch):
 
 def test_top_afd_parsing(monkeypatch):
     requests_mock = Mock(side_effect=mocked_requests_get)
-    monkeypatch.setattr('requests.get', requests_mock)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
     api_response = apiclient.fetch_afd("TOP")
     parsed_afd = apiclient.AreaForecastDiscussion(raw_afd=api_response['response'])
     # test time parsing
@@ -383,7 +415,7 @@ def test_top_afd_parsing(monkeypatch):
 
 def test_lox_afd_parsing(monkeypatch):
     requests_mock = Mock(side_effect=mocked_requests_get)
-    monkeypatch.setattr('requests.get', requests_mock)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
     api_response = apiclient.fetch_afd("LOX")
     parsed_afd = apiclient.AreaForecastDiscussion(raw_afd=api_response['response'])
     # test time parsing
@@ -406,3 +438,243 @@ def test_lox_afd_parsing(monkeypatch):
     assert parsed_afd.sections[1].name == 'Short Term (Tdy-Wed)'
     assert parsed_afd.sections[1].body == parsed_afd.short_term_tdy_wed
     assert parsed_afd.short_term_tdy_wed == "Overall, 12Z models in good synoptic agreement through the short\nterm period. At upper levels, low will move inland across northern\nBaja tonight with weak ridge developing over the area on Monday.\nFor Tuesday and Wednesday, cold inside slider drops into the Great\nBasin. Near the surface, west to northwest flow will prevail\nthrough Monday with moderate to strong northerly flow developing \non Tuesday and Wednesday. \n\nFor tonight/Monday, mid/high level clouds will clear out as the\nupper low moves over northern Baja. However, with a return of\nonshore flow, some stratus/fog is expected to develop tonight and\nMonday morning across the Central Coast, LAX coastal plain and\neven the Salinas River Valley. With a good onshore push through\nthe day on Monday, this low level moisture will likely keep skies\npartly cloudy west of the mountains Monday afternoon. As for\nwinds, there looks to be a brief pulse of northerly winds across\nthe Santa Ynez Range this evening. There is about a 20-30% chance\nof widespread advisory-level winds across the Santa Ynez Range.\nSo, will not issue an advisory at this time, but will make sure\nthe next shift monitors the potential closely. Otherwise, still\nlooks like some gusty southwesterly winds across the Antelope\nValley Monday afternoon and night, so will keep current WIND\nADVISORY in effect for this area. \n\nFor Monday night through Wednesday, attention turns to the impacts\nof the potent inside slider. Main concern with this system will be\nthe potential for strong and damaging northerly winds beginning\nlate Monday night and continuing through Tuesday evening. Looking\nat latest NBM numbers and ECMWF ensembles/EFI, the northerly winds\nlook to be a slight bit weaker than yesterday. However, the NBM \nstill indicates about a 70-90% chance of northerly gusts in excess\nof 65 MPH across the mountains Tuesday through Tuesday evening. \nSo, given the consistency of this scenario the last few days, will\nissue HIGH WIND WATCHES for the LA/Ventura/Santa Barbara county \nmountains (including the Santa Ynez Range) as well as the coastal \nzones south of the Santa Ynez Range and the Santa Clarita Valley. \nAt the very least, there will be widespread advisory level \nnortherly winds across many areas on Tuesday. Late Tuesday night \nand Wednesday, the winds will shift to the northeast and weaken \nbelow advisory levels. \n\nThe other concern with the inside slider will be the potential for\nsome shower activity. At this time, it looks like most of any\nmeasurable precipitation chances will be confined to the mountains\nTuesday and Tuesday night. Amounts, if any, will generally be\nunder 0.10 inches. However, snow levels drop down to around 2000\nfeet Tuesday afternoon/night. So, if any showers develop, there\ncould be some flurries or a dusting of snow across the interior\nvalleys and the Antelope Valley. Also, there could be some travel\nissues through the Grapevine Tuesday night.\n\n.LONG TERM (THU-SUN)...12/149 PM.\n\nFor the extended, 12Z models remain on the same broad synoptic\npager, but differ in the details. It's these differences that may\nimpact the forecast noticeably. \n\nFor Thursday, benign weather is expected as an upper level ridge\ndevelops over the area. Skies will start out clear, but high\nclouds (ahead of upcoming system) will be on the increase through\nthe day. Weak offshore flow will prevent any stratus development\nand will allow for some slight warming across the area.\n\nFor Friday and Saturday, both the GFS and ECMWF drop an upper low\nsouthward, off the CA coast. However, the GFS is further west with\nthe low's track than the ECMWF. So, the ECWMF solution would\nindicate a greater chance of appreciable rainfall for the area\nthan the GFS. This is also shown in the ensemble solutions with\nmany ECMWF members indicating precipitation while much fewer GFS\nensemble members indicate appreciable precipitation. Current NBM\nnumbers toe a nice middle ground for the various solutions,\nindicating chance POPs for the area Friday/Saturday. Very\npreliminary totals look to be generally around 0.25 inches or\nless. Snow levels looks to remain on the low side, generally in\nthe 2500-3500 foot range, so a few inches of snowfall will be\npossible across the mountains. \n\nFor Sunday, dry conditions are anticipated in the wake of the\nupper low. Weak offshore flow will allow for some slight warming\nfor most areas."
+
+def test_fetch_afds_multiple_regions(monkeypatch):
+    """Test fetching AFDs for several regions concurrently, including one failing region"""
+    requests_mock = Mock(side_effect=mocked_requests_get)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    results = apiclient.fetch_afds(["PSR", "top", "ERR", "PSR"], max_workers=2)
+    assert list(results.keys()) == ["PSR", "TOP", "ERR"]
+    assert results["PSR"]['response']['id'] == "1d6cd33d-4017-4dd1-8dce-41d4541de35a"
+    assert results["TOP"]['response']['id'] == "1f29f93c-583b-4144-ae22-8624a5e56504"
+    assert results["ERR"] == {'response': None, 'error': "HTTP error fetching list of AFD products"}
+
+def test_fetch_afds_invalid_region(monkeypatch):
+    """Test invalid region codes are reported without fetching, while valid ones are fetched"""
+    requests_mock = Mock(side_effect=mocked_region_codes_get)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    results = apiclient.fetch_afds(["OKX", "XYZ"], ignore_region_validation=False)
+    assert results["XYZ"] == {'response': None, 'error': "Invalid region code"}
+    assert results["OKX"]['response']['id'] == "6893e2af-17ef-471a-b7bc-4a74a8af0374"
+
+def test_read_regions_file(tmp_path):
+    regions_file = tmp_path / "regions.txt"
+    regions_file.write_text("PSR\n# comment line\n\nTOP  # Topeka\nlox\n", encoding='utf-8')
+    assert apiclient.read_regions_file(str(regions_file)) == ["PSR", "TOP", "lox"]
+
+def test_api_get_retries_server_error(monkeypatch):
+    """Test a transient 5xx response is retried and the successful response returned"""
+    responses = [mocked_requests_get_500(), mocked_requests_get("https://api.weather.gov/products/types/afd/locations/psr")]
+    requests_mock = Mock(side_effect=lambda *args, **kwargs: responses.pop(0))
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    api_response = apiclient.api_get("https://api.weather.gov/products/types/afd/locations/psr")
+    assert api_response.status_code == 200
+    assert requests_mock.call_count == 2
+
+def test_connection_error_retries_exhausted(monkeypatch, caplog):
+    """Test repeated connection errors are retried, then reported as an HTTP error"""
+    requests_mock = Mock(side_effect=requests.ConnectionError)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    apiclient.configure_session(max_retries=2)
+    response = apiclient.fetch_afd("PSR")
+    assert response == {'response': None, 'error': "HTTP error fetching list of AFD products"}
+    assert requests_mock.call_count == 3
+
+def test_api_get_honors_retry_after(monkeypatch):
+    """Test a 429 response with Retry-After pauses the rate limiter, then is retried"""
+    throttled = mocked_requests_get_500()
+    throttled.status_code = 429
+    throttled.headers = {'Retry-After': "7"}
+    responses = [throttled, mocked_requests_get("https://api.weather.gov/products/types/afd/locations/psr")]
+    requests_mock = Mock(side_effect=lambda *args, **kwargs: responses.pop(0))
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    pause_mock = Mock()
+    monkeypatch.setattr(apiclient._rate_limiter, 'pause', pause_mock)
+    api_response = apiclient.api_get("https://api.weather.gov/products/types/afd/locations/psr")
+    assert api_response.status_code == 200
+    pause_mock.assert_called_once_with(7)
+
+def test_circuit_breaker_opens(monkeypatch, caplog):
+    """Test a region that keeps failing is not requested again until its circuit resets"""
+    requests_mock = Mock(side_effect=requests.ConnectionError)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    apiclient.configure_session(max_retries=0)
+    apiclient.configure_rate_limit(failure_threshold=2)
+    for _ in range(2):
+        assert apiclient.fetch_afd("PSR")['error'] == "HTTP error fetching list of AFD products"
+    assert apiclient.fetch_afd("PSR") == {'response': None,
+                                          'error': "Too many recent errors fetching AFDs for region"}
+    assert requests_mock.call_count == 2
+    # other regions are still requested
+    apiclient.fetch_afd("TOP")
+    assert requests_mock.call_count == 3
+
+def test_unexpected_error_opens_circuit(monkeypatch):
+    """Test a request failing with an error that is not retried still counts as a failure"""
+    list_url = "https://api.weather.gov/products/types/afd/locations/psr"
+    def get(*args, **kwargs):
+        if args[0] == list_url:
+            return mocked_requests_get(*args, **kwargs)
+        raise requests.TooManyRedirects
+    monkeypatch.setattr('requests.Session.get', Mock(side_effect=get))
+    apiclient.configure_rate_limit(failure_threshold=1)
+    assert apiclient.fetch_afd("PSR")['error'] == "HTTP error fetching AFD product"
+    assert apiclient._circuit_breaker.is_open(list_url)
+
+def test_circuit_opens_before_product_request(monkeypatch, caplog):
+    """Test a product request refused by the circuit breaker is reported like a list request"""
+    monkeypatch.setattr('requests.Session.get', Mock(side_effect=mocked_requests_get))
+    monkeypatch.setattr(apiclient._circuit_breaker, 'allow', Mock(side_effect=[True, False]))
+    assert apiclient.fetch_afd("PSR") == {'response': None,
+                                          'error': "Too many recent errors fetching AFDs for region"}
+    assert "HTTP error fetching AFD product" not in caplog.text
+
+def test_session_is_reused(monkeypatch):
+    requests_mock = Mock(side_effect=mocked_requests_get)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    apiclient.fetch_afd("PSR")
+    session = apiclient.get_session()
+    apiclient.fetch_afd("TOP")
+    assert apiclient.get_session() is session
+
+def mocked_conditional_get(*args, **kwargs):
+    """Mock for requests.Session.get that supports ETag validators, answering 304 when the
+    request carries the current ETag"""
+    etag = f'"{args[0].rsplit("/", 1)[-1]}"'
+    if (kwargs.get('headers') or {}).get('If-None-Match') == etag:
+        response = mocked_requests_get_500()
+        response.status_code = 304
+        response.raise_for_status = lambda: None
+        response.json = Mock(side_effect=AssertionError("304 response body should not be parsed"))
+        return response
+    response = mocked_requests_get(*args, **kwargs)
+    response.headers = {'ETag': etag, 'Last-Modified': "Thu, 09 Feb 2023 12:29:00 GMT"}
+    return response
+
+def test_monitor_conditional_get(monkeypatch):
+    """Test monitor mode stores validators and short-circuits on a 304 list response"""
+    requests_mock = Mock(side_effect=mocked_conditional_get)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    first_response = apiclient.fetch_afd("PSR", monitor=True)
+    assert first_response['response']['id'] == "1d6cd33d-4017-4dd1-8dce-41d4541de35a"
+    validators = apiclient.read_validators("cache_psr_validators.json")
+    list_url = "https://api.weather.gov/products/types/afd/locations/psr"
+    assert validators[list_url]['etag'] == '"psr"'
+    second_response = apiclient.fetch_afd("PSR", monitor=True)
+    assert second_response == {'response': None, 'error': None}
+    assert requests_mock.call_args.kwargs['headers']['If-None-Match'] == '"psr"'
+    assert requests_mock.call_args.kwargs['headers']['If-Modified-Since'] == "Thu, 09 Feb 2023 12:29:00 GMT"
+
+def test_monitor_keeps_only_list_validators(monkeypatch):
+    """Test validators of older products are dropped and products are not fetched conditionally"""
+    requests_mock = Mock(side_effect=mocked_conditional_get)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    list_url = "https://api.weather.gov/products/types/afd/locations/psr"
+    old_product_url = "https://api.weather.gov/products/older-product"
+    cache = apiclient.MonitorCache()
+    cache.set_product("psr", {'id': "older-product"})
+    cache.set_validators("psr", {list_url: {'etag': '"stale"'}, old_product_url: {'etag': '"old"'}})
+    response = apiclient.fetch_afd("PSR", monitor=True, cache=cache)
+    assert response['response']['id'] == "1d6cd33d-4017-4dd1-8dce-41d4541de35a"
+    assert not requests_mock.call_args.kwargs.get('headers')
+    assert apiclient.read_validators("cache_psr_validators.json") == {
+        list_url: {'etag': '"psr"', 'last_modified': "Thu, 09 Feb 2023 12:29:00 GMT"}}
+
+def test_region_index_cached(monkeypatch):
+    """Test region codes are fetched once, then validated from the in-memory and on-disk cache"""
+    requests_mock = Mock(side_effect=mocked_region_codes_get)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    index = apiclient.load_region_index()
+    assert index.source == "api"
+    assert "psr" in index and "PSR" in index and "XYZ" not in index
+    assert index.canonical("okx") == "OKX"
+    assert apiclient.load_region_index() is index
+    # a new process starts with an empty in-memory index but finds the disk cache
+    apiclient.clear_region_index()
+    assert apiclient.load_region_index().source == "cache"
+    assert requests_mock.call_count == 1
+
+def test_region_index_expired(monkeypatch):
+    requests_mock = Mock(side_effect=mocked_region_codes_get)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    apiclient.region_cache_settings['ttl'] = 0
+    apiclient.load_region_index()
+    apiclient.load_region_index()
+    assert requests_mock.call_count == 2
+
+def test_region_index_bundled_fallback(monkeypatch):
+    """Test the bundled region code list is used when the API can not be reached"""
+    requests_mock = Mock(side_effect=mocked_requests_get_500)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    index = apiclient.load_region_index()
+    assert index.source == "bundled"
+    assert "PSR" in index
+
+def test_okx_afd_parsing():
+    """Test parsing an AFD with subsection headers and '...' inside section text"""
+    with open(os.path.join(FIXTURE_DIR, "okx_afd_response.json"), 'r', encoding='utf-8') as f:
+        parsed_afd = apiclient.AreaForecastDiscussion(raw_afd=json.load(f))
+    assert [s.name for s in parsed_afd.sections] == [
+        'header', 'Near Term /Until 6 Am Monday Morning/',
+        'Short Term /6 Am Monday Morning Through Monday Night/', 'Long Term /Tuesday Through Sunday/',
+        'Aviation /03Z Monday Through Friday/', 'Marine', 'Hydrology', 'Okx Watches/Warnings/Advisories',
+        'footer']
+    assert parsed_afd.sections[0].subsections[0].name == 'Synopsis'
+    assert parsed_afd.sections[4].subsections[0].name == 'Ny Metro (Kewr/Klga/Kjfk/Kteb) Taf Uncertainty'
+
+def test_repeated_subsection_headers():
+    """Test subsections with identical headers are each split at their own position"""
+    text = ("000\nFXUS65 KPSR 091229\n\n&&\n\n.DISCUSSION...\nFirst part.\n\n.UPDATE...\nOne.\n\n"
+            ".UPDATE...\nTwo.\n\n&&\n\n$$\n")
+    parsed_afd = apiclient.AreaForecastDiscussion({'id': "1", 'issuingOffice': "KPSR",
+                                                   'issuanceTime': "2023-02-09T12:29:00+00:00",
+                                                   'productText': text})
+    discussion = parsed_afd.sections[1]
+    assert discussion.name == 'Discussion'
+    assert discussion.body == 'First part.'
+    assert [(s.name, s.body) for s in discussion.subsections] == [('Update', 'One.'), ('Update', 'Two.')]
+    assert parsed_afd.footer == '$$'
+
+def test_clean_newlines():
+    assert apiclient.AreaForecastDiscussion.clean_newlines(
+        "Line one\nline two  \n\n\nNext  paragraph\n") == "Line one line two\nNext paragraph"
+
+def test_lazy_sections():
+    """Test sections are only parsed on first access and use slotted objects"""
+    with open(os.path.join(FIXTURE_DIR, "psr_afd_response.json"), 'r', encoding='utf-8') as f:
+        parsed_afd = apiclient.AreaForecastDiscussion(raw_afd=json.load(f))
+    assert parsed_afd._sections is None and parsed_afd._cleaned_text is None
+    assert not hasattr(parsed_afd, '__dict__')
+    section = parsed_afd.sections[1]
+    assert not hasattr(section, '__dict__')
+    assert section.raw_section.startswith(".SYNOPSIS...")
+    assert section.body == section.raw_section.removeprefix(".SYNOPSIS...").strip()
+    assert parsed_afd.header == parsed_afd.sections[0].body
+
+def test_monitor_sqlite_cache(monkeypatch, tmp_path):
+    """Test monitor mode with the SQLite store as the cache backend"""
+    requests_mock = Mock(side_effect=mocked_conditional_get)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    cache = store.SQLiteCache(str(tmp_path / "sendafd.db"))
+    first_response = apiclient.fetch_afd("PSR", monitor=True, cache=cache)
+    assert cache.last_seen_id("psr") == first_response['response']['id']
+    assert not os.path.exists("cache_psr.json")
+    assert apiclient.fetch_afd("PSR", monitor=True, cache=cache) == {'response': None, 'error': None}
+    cache.close()
+
+def test_decode_latest_listing():
+    """Test only the first product list entry is decoded"""
+    with open(os.path.join(FIXTURE_DIR, "psr_afd_list_response.json"), 'rb') as f:
+        body = f.read()
+    latest = apiclient.decode_latest_listing(body)
+    assert latest.product_id == "1d6cd33d-4017-4dd1-8dce-41d4541de35a"
+    assert latest.issuance_time == "2023-02-09T12:29:00+00:00"
+    # the rest of the list is never parsed, so a truncated body still works
+    truncated = '{"@graph":[{"id":"abc","issuanceTime":"2023-02-09T12:29:00+00:00"},{"id":'
+    assert apiclient.decode_latest_listing(truncated).product_id == "abc"
+    with pytest.raises(KeyError):
+        apiclient.decode_latest_listing('{"@context": {"@graph": 1}, "@graph": []}')
+    with pytest.raises(KeyError):
+        apiclient.decode_latest_listing('{"@context": {}}')
+    with pytest.raises(ValueError):
+        apiclient.decode_latest_listing('[]')
@@ -0,0 +1,81 @@
+"""Test sendafd.archive module"""
+import gzip
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from unittest.mock import Mock
+
+import pytest
+
+from sendafd import archive
+
+LIST_URL = "https://api.weather.gov/products/types/afd/locations/psr"
+LISTED = [
+    {'id': "third", 'issuanceTime': "2023-02-09T12:29:00+00:00"},
+    {'id': "second", 'issuanceTime': "2023-02-01T00:00:00+00:00"},
+    {'id': "first", 'issuanceTime': "2023-01-31T23:00:00+00:00"},
+]
+
+
+def mocked_requests_get(*args, **kwargs):
+    if args[0] == LIST_URL:
+        body = {'@graph': LISTED}
+    else:
+        product_id = args[0].rsplit("/", 1)[-1]
+        entry = next(e for e in LISTED if e['id'] == product_id)
+        body = dict(entry, productText=f"text of {product_id}")
+    return Mock(status_code=200, headers={}, content=json.dumps(body).encode('utf-8'))
+
+@pytest.fixture
+def requests_mock(monkeypatch):
+    requests_mock = Mock(side_effect=mocked_requests_get)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    return requests_mock
+
+def test_backfill(tmp_path, requests_mock):
+    afd_archive = archive.Archive(str(tmp_path))
+    assert archive.backfill(afd_archive, ["psr"]) == {"PSR": {'response': 3, 'error': None}}
+    # products are partitioned by month of issuance
+    assert sorted(os.listdir(tmp_path / "psr")) == ["2023-01.jsonl.gz", "2023-02.jsonl.gz",
+                                                    "index.tsv", "lock"]
+    assert afd_archive.stored_ids("PSR") == {"first", "second", "third"}
+    assert afd_archive.regions() == ["PSR"]
+
+def test_backfill_skips_stored(tmp_path, requests_mock):
+    afd_archive = archive.Archive(str(tmp_path))
+    afd_archive.append("psr", [dict(LISTED[0], productText="")])
+    archive.backfill(afd_archive, ["PSR"])
+    product_urls = [c.args[0] for c in requests_mock.call_args_list if c.args[0] != LIST_URL]
+    assert sorted(product_urls) == ["https://api.weather.gov/products/first",
+                                    "https://api.weather.gov/products/second"]
+    # a second backfill only fetches the list
+    requests_mock.reset_mock()
+    assert archive.backfill(afd_archive, ["PSR"]) == {"PSR": {'response': 0, 'error': None}}
+    assert requests_mock.call_count == 1
+
+def test_append_is_gzip_members(tmp_path):
+    afd_archive = archive.Archive(str(tmp_path))
+    afd_archive.append("psr", [dict(LISTED[0])])
+    afd_archive.append("psr", [dict(LISTED[1])])
+    with gzip.open(tmp_path / "psr" / "2023-02.jsonl.gz", 'rt', encoding='utf-8') as f:
+        assert len(f.readlines()) == 2
+
+def test_concurrent_appends(tmp_path):
+    """Test appends from several processes at once neither lose nor duplicate products"""
+    afd_archive = archive.Archive(str(tmp_path))
+    products = [{'id': f"p{n}", 'issuanceTime': "2023-02-01T00:00:00+00:00"} for n in range(20)]
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(afd_archive.append, ["PSR"] * 4, [products] * 4))
+    with gzip.open(tmp_path / "psr" / "2023-02.jsonl.gz", 'rt', encoding='utf-8') as f:
+        assert sorted(json.loads(line)['id'] for line in f) == sorted(p['id'] for p in products)
+
+def test_query(tmp_path):
+    afd_archive = archive.Archive(str(tmp_path))
+    afd_archive.append("psr", [dict(entry) for entry in LISTED])
+    assert [p['id'] for p in afd_archive.query("psr")] == ["first", "third", "second"]
+    assert [p['id'] for p in afd_archive.query("PSR", start="2023-02-01T00:00:00+00:00")] == \
+        ["third", "second"]
+    end = datetime(2023, 2, 9, tzinfo=timezone.utc)
+    assert [p['id'] for p in afd_archive.query("psr", end=end)] == ["first", "second"]
+    assert list(afd_archive.query("top")) == []
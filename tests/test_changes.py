@@ -0,0 +1,115 @@
+"""Test sendafd.changes module"""
+import json
+import os
+from unittest.mock import Mock
+
+import pytest
+from jinja2 import FileSystemLoader
+
+from sendafd import apiclient, changes, renderer, subscriptions
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(os.path.dirname(FIXTURE_DIR), "templates")
+
+
+def load_product(name):
+    with open(os.path.join(FIXTURE_DIR, name), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def reissue(product, product_id, old, new):
+    """Return a copy of product with a new id and old replaced by new in its text"""
+    assert old in product['productText']
+    return dict(product, id=product_id, productText=product['productText'].replace(old, new))
+
+@pytest.fixture
+def cache(tmp_path):
+    return apiclient.MonitorCache(cache_dir=str(tmp_path))
+
+def test_section_fingerprints():
+    product = load_product("lox_afd_response.json")
+    fingerprints = changes.section_fingerprints(apiclient.AreaForecastDiscussion(product))
+    # subsections, such as the synopsis in the header section, are fingerprinted separately
+    assert list(fingerprints)[:4] == ["header", "Synopsis", "Short Term (Tdy-Wed)",
+                                      "Long Term (Thu-Sun)"]
+    updated = reissue(product, "updated", "no marine inversion", "a marine inversion")
+    updated_fingerprints = changes.section_fingerprints(apiclient.AreaForecastDiscussion(updated))
+    summary = changes.summarize({'product_id': product['id'], 'sections': fingerprints},
+                                updated_fingerprints)
+    assert summary['changed'] == ["Aviation"]
+    assert summary['added'] == [] and summary['removed'] == []
+
+def test_selected_changed():
+    summary = {'changed': ["header", "Aviation /03Z Monday Through Friday/"], 'added': [],
+               'removed': []}
+    assert changes.selected_changed(summary, ["aviation"])
+    assert not changes.selected_changed(summary, ["Short Term", "Synopsis"])
+    assert changes.selected_changed(summary, ["any"])
+    assert not changes.selected_changed(dict(summary, changed=["header"]), ["any"])
+
+def test_detect_changes_skips_unselected_sections(cache):
+    product = load_product("lox_afd_response.json")
+    first = changes.detect_changes({"LOX": {'response': product, 'error': None}}, cache,
+                                   ["Short Term"])
+    # with nothing stored for the region, the product is always kept
+    assert first["LOX"]['response'] is product
+    assert first["LOX"]['changes']['previous_product_id'] is None
+    # fingerprints are only stored once the product has been sent
+    assert cache.get_fingerprints("lox") == {}
+    changes.record_sent(cache, "LOX", first["LOX"])
+    aviation_only = reissue(product, "aviation", "no marine inversion", "a marine inversion")
+    skipped = changes.detect_changes({"LOX": {'response': aviation_only, 'error': None}}, cache,
+                                     ["Short Term"])
+    assert skipped["LOX"] == {'response': None, 'error': None}
+    # skipped products are not recorded, so changes are relative to the last product sent
+    assert cache.get_fingerprints("lox")['product_id'] == product['id']
+    kept = changes.detect_changes({"LOX": {'response': aviation_only, 'error': None}}, cache,
+                                  ["aviation"])
+    assert kept["LOX"]['changes']['changed'] == ["Aviation"]
+    changes.record_sent(cache, "LOX", kept["LOX"])
+    assert cache.get_fingerprints("lox")['product_id'] == "aviation"
+
+def test_fingerprints_recorded_only_when_sent(cache):
+    """Test a product that fails to send does not replace the fingerprints of the last one sent"""
+    product = load_product("lox_afd_response.json")
+    subs = subscriptions.parse_subscriptions({"foo@bar.com": {"regions": ["LOX"],
+                                                              "plaintext": True}})
+    sender = Mock()
+    sender.send.return_value = False
+    results = changes.detect_changes({"LOX": {'response': product, 'error': None}}, cache)
+    subscriptions.deliver(results, subs, "someuser@emailserver.com", sender, cache=cache)
+    assert cache.get_fingerprints("lox") == {}
+    sender.send.return_value = True
+    subscriptions.deliver(results, subs, "someuser@emailserver.com", sender, cache=cache)
+    assert cache.get_fingerprints("lox")['product_id'] == product['id']
+
+def test_detect_changes_unparseable_product(cache):
+    """Test a product that fails to parse is kept without changes and other regions still are"""
+    broken = dict(load_product("psr_afd_response.json"), issuanceTime="not a time")
+    product = load_product("lox_afd_response.json")
+    checked = changes.detect_changes({"PSR": {'response': broken, 'error': None},
+                                      "LOX": {'response': product, 'error': None}}, cache)
+    assert checked["PSR"] == {'response': broken, 'error': None}
+    assert checked["LOX"]['changes']['previous_product_id'] is None
+    assert cache.get_fingerprints("psr") == {}
+
+def test_detect_changes_parsed_product_reused(cache, monkeypatch):
+    """Test the product parsed to detect changes is rendered without being parsed again"""
+    product = load_product("lox_afd_response.json")
+    checked = changes.detect_changes({"LOX": {'response': product, 'error': None}}, cache)
+    assert checked["LOX"]['afd'].product_id == product['id']
+    monkeypatch.setattr(apiclient, 'AreaForecastDiscussion',
+                        Mock(side_effect=AssertionError("product parsed twice")))
+    monkeypatch.setattr(renderer, 'render_email_body', Mock(return_value="<p>AFD</p>"))
+    subs = subscriptions.parse_subscriptions({"foo@bar.com": {"regions": ["LOX"]}})
+    assert len(list(subscriptions.build_messages(checked, subs, "someuser@emailserver.com"))) == 1
+
+def test_changes_passed_to_template(monkeypatch):
+    monkeypatch.setattr(renderer.env, 'loader', FileSystemLoader(TEMPLATE_DIR))
+    monkeypatch.setattr(renderer, 'render_cache', renderer.RenderCache())
+    afd = apiclient.AreaForecastDiscussion(load_product("lox_afd_response.json"))
+    summary = {'previous_product_id': "previous", 'changed': ["header", "Aviation"],
+               'added': [], 'removed': [], 'unchanged': []}
+    body = renderer.render_email_body(afd, 'default_email_template.html', summary)
+    assert "Updated sections: Aviation</i>" in body
+    # the same product rendered without a summary is a separate render cache entry
+    assert "Updated sections" not in renderer.render_email_body(afd, 'default_email_template.html')
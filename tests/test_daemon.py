@@ -0,0 +1,63 @@
+"""Test sendafd.daemon module"""
+import json
+
+import pytest
+from unittest.mock import Mock
+
+from sendafd import daemon
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    config_path = tmp_path / "daemon.json"
+    config_path.write_text(json.dumps({
+        "smtp": {"server": "localhost", "username": "someuser@emailserver.com",
+                 "password": "somepassword"},
+        "recipient": "foo@bar.com",
+        "interval": 60,
+        "jitter": 0,
+        "regions": {"PSR": {}, "TOP": {"interval": 120}},
+        "cache_dir": str(tmp_path),
+    }), encoding='utf-8')
+    return str(config_path)
+
+def test_load_config_defaults(config_file):
+    config = daemon.load_config(config_file)
+    assert config['sender'] == "someuser@emailserver.com"
+    assert config['template'] == 'default_email_template.html'
+    assert config['plaintext'] is False
+    assert config['subscriptions']["foo@bar.com"]['regions'] == ["PSR", "TOP"]
+
+def test_load_config_missing_key(tmp_path):
+    config_path = tmp_path / "daemon.json"
+    config_path.write_text(json.dumps({"recipient": "foo@bar.com", "regions": ["PSR"]}))
+    with pytest.raises(ValueError):
+        daemon.load_config(str(config_path))
+
+def test_region_intervals(config_file):
+    d = daemon.Daemon(daemon.load_config(config_file))
+    assert d.next_poll_time("PSR", now=0) == 60
+    assert d.next_poll_time("TOP", now=0) == 120
+
+def test_poll_due_regions(config_file, monkeypatch):
+    """Test due regions are fetched with the shared in-memory cache and rescheduled"""
+    d = daemon.Daemon(daemon.load_config(config_file))
+    fetch_mock = Mock(return_value={"PSR": {'response': None, 'error': None},
+                                    "TOP": {'response': None, 'error': "HTTP error fetching AFD product"}})
+    monkeypatch.setattr(daemon.apiclient, 'fetch_afds', fetch_mock)
+    d.sender.send = Mock()
+    d._schedule = [(0, "PSR"), (0, "TOP")]
+    d.poll_due_regions()
+    assert fetch_mock.call_args.kwargs['cache'] is d.cache
+    assert fetch_mock.call_args.kwargs['regions'] == ["PSR", "TOP"]
+    d.sender.send.assert_not_called()
+    assert sorted(region for _, region in d._schedule) == ["PSR", "TOP"]
+
+def test_outbox_config(config_file, tmp_path):
+    """Test the daemon queues emails in an outbox when one is configured"""
+    config = daemon.load_config(config_file)
+    config['outbox'] = str(tmp_path / "outbox")
+    d = daemon.Daemon(config)
+    assert isinstance(d.sender, daemon.outbox.DeliveryPool)
+    assert d.sender.workers == daemon.outbox.DEFAULT_WORKERS
+    assert d.sender.scan_interval == daemon.OUTBOX_SCAN_INTERVAL
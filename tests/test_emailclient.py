@@ -0,0 +1,82 @@
+"""Test sendafd.emailclient module"""
+from email.message import EmailMessage
+import smtplib
+from unittest.mock import Mock
+
+import pytest
+
+from sendafd import emailclient
+
+
+def make_email(recipient: str = "foo@bar.com") -> EmailMessage:
+    msg = EmailMessage()
+    msg.set_content("Area Forecast Discussion")
+    msg['Subject'] = "KPSR Forecast"
+    msg['From'] = "someuser@emailserver.com"
+    msg['To'] = recipient
+    return msg
+
+@pytest.fixture
+def smtp_mock(monkeypatch):
+    """Replace smtplib.SMTP with a mock, returning the mock class"""
+    smtp_class = Mock()
+    smtp_class.return_value.send_message.return_value = {}
+    monkeypatch.setattr(emailclient.smtplib, 'SMTP', smtp_class)
+    return smtp_class
+
+def test_send_email_quits(smtp_mock):
+    assert emailclient.send_email("localhost", "someuser", "somepassword", make_email())
+    smtp_mock.return_value.login.assert_called_once_with(user="someuser", password="somepassword")
+    smtp_mock.return_value.quit.assert_called_once()
+
+def test_send_many_single_connection(smtp_mock):
+    """Test a batch of emails is sent over one authenticated connection"""
+    with emailclient.SMTPSender("localhost", "someuser", "somepassword") as sender:
+        results = sender.send_many(make_email(f"user{n}@bar.com") for n in range(5))
+    assert results == [True] * 5
+    assert smtp_mock.call_count == 1
+    assert smtp_mock.return_value.login.call_count == 1
+    assert smtp_mock.return_value.send_message.call_count == 5
+    smtp_mock.return_value.quit.assert_called_once()
+
+def test_reconnect_after_disconnect(smtp_mock):
+    """Test the sender reconnects transparently when the server drops the connection"""
+    smtp_mock.return_value.send_message.side_effect = [{}, smtplib.SMTPServerDisconnected, {}]
+    with emailclient.SMTPSender("localhost", "someuser", "somepassword") as sender:
+        assert sender.send_many([make_email(), make_email()]) == [True, True]
+    assert smtp_mock.call_count == 2
+
+def test_reconnect_after_connection_reset(smtp_mock):
+    """Test a socket error while sending closes the connection and retries on a new one"""
+    reset = ConnectionResetError
+    smtp_mock.return_value.send_message.side_effect = [reset, {}, reset, reset]
+    with emailclient.SMTPSender("localhost", "someuser", "somepassword") as sender:
+        assert sender.send(make_email())
+        assert smtp_mock.return_value.close.call_count == 1
+        # a second failure in a row is reported rather than raised
+        assert not sender.send(make_email())
+        assert sender.last_error.startswith("ConnectionResetError")
+        assert sender.connection is None
+    assert smtp_mock.call_count == 3
+
+def test_max_messages_per_connection(smtp_mock):
+    with emailclient.SMTPSender("localhost", "someuser", "somepassword",
+                                max_messages_per_connection=2) as sender:
+        sender.send_many(make_email() for _ in range(5))
+    assert smtp_mock.call_count == 3
+
+def test_login_failure(smtp_mock):
+    smtp_mock.return_value.login.side_effect = smtplib.SMTPAuthenticationError(535, b"bad login")
+    assert not emailclient.send_email("localhost", "someuser", "somepassword", make_email())
+
+def test_permanent_failure_recorded(smtp_mock):
+    """Test a 5xx rejection is marked permanent and a 4xx one is not"""
+    smtp_mock.return_value.send_message.side_effect = smtplib.SMTPRecipientsRefused(
+        {"foo@bar.com": (550, b"No such user")})
+    sender = emailclient.SMTPSender("localhost", "someuser", "somepassword")
+    assert not sender.send(make_email())
+    assert sender.last_error_permanent
+    smtp_mock.return_value.send_message.side_effect = smtplib.SMTPDataError(451, b"Try again later")
+    assert not sender.send(make_email())
+    assert "451" in sender.last_error
+    assert not sender.last_error_permanent
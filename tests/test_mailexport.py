@@ -0,0 +1,58 @@
+"""Test sendafd.mailexport module"""
+import mailbox
+import os
+from email.message import EmailMessage
+
+import pytest
+
+from sendafd import mailexport
+
+
+def make_email(n: int) -> EmailMessage:
+    msg = EmailMessage()
+    # a line starting with "From " must be escaped in an mbox
+    msg.set_content(f"Discussion {n}\nFrom the forecast office\n")
+    msg['Subject'] = f"Forecast {n}"
+    msg['From'] = "sender@example.com"
+    msg['To'] = "recipient@example.com"
+    return msg
+
+@pytest.fixture
+def fsync_calls(monkeypatch):
+    calls = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(mailexport.os, 'fsync', lambda fd: calls.append(fd) or real_fsync(fd))
+    return calls
+
+def test_mbox_writer(tmp_path, fsync_calls):
+    path = str(tmp_path / "afd.mbox")
+    with mailexport.MboxWriter(path, batch_size=2) as writer:
+        assert writer.send_many([make_email(n) for n in range(3)]) == [True, True, True]
+    # one fsync for the full batch and one for the rest when closed
+    assert len(fsync_calls) == 2
+    messages = list(mailbox.mbox(path))
+    assert [m['Subject'] for m in messages] == ["Forecast 0", "Forecast 1", "Forecast 2"]
+    assert "\n>From the forecast office" in messages[2].get_payload()
+    # later writers append to the same mbox
+    with mailexport.MboxWriter(path) as writer:
+        writer.send(make_email(3))
+    assert len(mailbox.mbox(path)) == 4
+
+def test_maildir_writer(tmp_path, fsync_calls):
+    path = str(tmp_path / "Maildir")
+    writer = mailexport.MaildirWriter(path, batch_size=2)
+    for n in range(3):
+        writer.send(make_email(n))
+    # the first batch is moved into new/ together, the rest waits in tmp/ until closed
+    assert len(os.listdir(os.path.join(path, "new"))) == 2
+    assert len(os.listdir(os.path.join(path, "tmp"))) == 1
+    writer.close()
+    assert os.listdir(os.path.join(path, "tmp")) == []
+    subjects = sorted(m['Subject'] for m in mailbox.Maildir(path, create=False))
+    assert subjects == ["Forecast 0", "Forecast 1", "Forecast 2"]
+
+def test_open_writer(tmp_path):
+    assert isinstance(mailexport.open_writer(str(tmp_path / "m"), "maildir"),
+                      mailexport.MaildirWriter)
+    with pytest.raises(ValueError):
+        mailexport.open_writer(str(tmp_path / "m"), "eml")
@@ -0,0 +1,18 @@
+"""Test sendafd command line entry point"""
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def imported_modules(*args) -> str:
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-m", "sendafd", *args],
+                               cwd=ROOT_DIR, capture_output=True, text=True, check=True)
+    return completed.stderr
+
+def test_version_imports_nothing_heavy():
+    """Test --version does not load the HTTP, template or email modules"""
+    imports = imported_modules("--version")
+    for module in ("requests", "jinja2", "smtplib", "sendafd.apiclient"):
+        assert f" {module}\n" not in imports
@@ -0,0 +1,105 @@
+"""Test sendafd.metrics module"""
+import json
+import os
+from unittest.mock import Mock
+
+import pytest
+
+from sendafd import apiclient, metrics, renderer
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry():
+    metrics.registry.reset()
+    yield
+    metrics.registry.reset()
+
+def test_timer_and_counters():
+    with metrics.timer('render', kind="email"):
+        pass
+    with metrics.timer('render', kind="email"):
+        pass
+    metrics.increment('http_bytes_total', 100)
+    metrics.increment('http_bytes_total', 50)
+    assert metrics.registry.stage('render', kind="email")['count'] == 2
+    assert metrics.registry.stage('render', kind="web")['count'] == 0
+    assert metrics.registry.counter('http_bytes_total') == 150
+
+def test_prometheus_format():
+    metrics.registry.observe('fetch_product', 0.5)
+    metrics.increment('cache_hits_total', cache="monitor")
+    text = metrics.to_prometheus(timestamp=1)
+    assert "# TYPE sendafd_stage_duration_seconds summary" in text
+    assert 'sendafd_stage_duration_seconds_sum{stage="fetch_product"} 0.5' in text
+    assert 'sendafd_stage_duration_seconds_count{stage="fetch_product"} 1' in text
+    assert 'sendafd_cache_hits_total{cache="monitor"} 1' in text
+    assert text.endswith("sendafd_last_export_timestamp_seconds 1\n")
+
+def test_prometheus_families_contiguous():
+    """Test each family's HELP and TYPE lines and samples are together, as the format requires"""
+    for stage in ("fetch_product", "parse", "render"):
+        metrics.registry.observe(stage, 0.5)
+    metrics.increment('cache_hits_total', cache="monitor")
+    metrics.increment('cache_hits_total', cache="render")
+    families = []
+    for line in metrics.to_prometheus(timestamp=1).splitlines():
+        if line.startswith("# HELP "):
+            family = line.split()[2]
+            assert family not in families
+            families.append(family)
+        elif not line.startswith("#"):
+            name = line.split("{")[0].split()[0]
+            assert name == families[-1] or name.rsplit("_", 1)[0] == families[-1]
+    assert families == ["sendafd_stage_duration_seconds", "sendafd_stage_max_duration_seconds",
+                        "sendafd_cache_hits_total", "sendafd_last_export_timestamp_seconds"]
+
+def test_export_json_lines(tmp_path, monkeypatch):
+    path = str(tmp_path / "metrics.jsonl")
+    monkeypatch.setitem(metrics.export_settings, 'path', path)
+    monkeypatch.setitem(metrics.export_settings, 'format', "jsonl")
+    metrics.increment('emails_sent_total')
+    metrics.export()
+    metrics.export()
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2
+    assert lines[0]['name'] == "sendafd_emails_sent_total" and lines[0]['value'] == 1
+
+def test_write_prometheus_failure_leaves_no_temp_file(tmp_path, monkeypatch):
+    """Test a failed textfile write leaves neither the metrics file nor a temporary file behind"""
+    path = str(tmp_path / "sendafd.prom")
+    monkeypatch.setattr(os, 'replace', Mock(side_effect=OSError("disk full")))
+    metrics.increment('emails_sent_total')
+    with pytest.raises(OSError):
+        metrics.write_prometheus(path)
+    assert os.listdir(tmp_path) == []
+
+def test_fetch_and_render_instrumented(tmp_path, monkeypatch):
+    """Test fetching and rendering an AFD records stage timings, bytes and cache lookups"""
+    monkeypatch.chdir(tmp_path)
+    with open(os.path.join(FIXTURE_DIR, "psr_afd_response.json"), 'rb') as f:
+        product_body = f.read()
+    with open(os.path.join(FIXTURE_DIR, "psr_afd_list_response.json"), 'rb') as f:
+        list_body = f.read()
+
+    def mocked_get(url, **kwargs):
+        body = list_body if "locations" in url else product_body
+        return Mock(status_code=200, headers={}, content=body,
+                    json=Mock(return_value=json.loads(body)))
+    monkeypatch.setattr('requests.Session.get', Mock(side_effect=mocked_get))
+    apiclient.close_session()
+    response = apiclient.fetch_afd("PSR", monitor=True)
+    apiclient.close_session()
+    assert metrics.registry.stage('fetch_product_list')['count'] == 1
+    assert metrics.registry.stage('fetch_product')['count'] == 1
+    assert metrics.registry.counter('http_bytes_total') == len(list_body) + len(product_body)
+    assert metrics.registry.counter('cache_misses_total', cache="monitor") == 1
+    monkeypatch.chdir(os.path.dirname(FIXTURE_DIR))
+    monkeypatch.setattr(renderer, 'render_cache', renderer.RenderCache())
+    afd = apiclient.AreaForecastDiscussion(response['response'])
+    renderer.render_email_body(afd, "default_email_template.html")
+    assert metrics.registry.stage('parse')['count'] == 1
+    assert metrics.registry.stage('render', kind="email")['count'] == 1
+    assert metrics.registry.counter('cache_misses_total', cache="render") == 1
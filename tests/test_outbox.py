@@ -0,0 +1,105 @@
+"""Test sendafd.outbox module"""
+import os
+import threading
+import time
+from email.message import EmailMessage
+
+import pytest
+
+from sendafd import outbox
+
+
+def make_email(n: int) -> EmailMessage:
+    msg = EmailMessage()
+    msg.set_content(f"Discussion {n}\n")
+    msg['Subject'] = f"Forecast {n}"
+    msg['From'] = "sender@example.com"
+    msg['To'] = f"user{n}@example.com"
+    return msg
+
+class FakeSender:
+    """Sender failing for recipients listed in `failures` with the matching (error, permanent)"""
+    def __init__(self, sent: list, failures: dict = None, delay: float = 0):
+        self.sent = sent
+        self.failures = failures or {}
+        self.delay = delay
+        self.last_error = None
+        self.last_error_permanent = False
+        self.closed = False
+
+    def send(self, email) -> bool:
+        time.sleep(self.delay)
+        if email['To'] in self.failures:
+            self.last_error, self.last_error_permanent = self.failures[email['To']]
+            return False
+        self.sent.append((threading.current_thread().name, email['Subject']))
+        return True
+
+    def close(self):
+        self.closed = True
+
+def test_add_and_load(tmp_path):
+    box = outbox.Outbox(str(tmp_path / "outbox"))
+    ids = [box.add(make_email(n)) for n in range(3)]
+    assert box.queued() == ids == sorted(ids)
+    assert box.due() == ids
+    assert box.load(ids[1])['Subject'] == "Forecast 1"
+    assert os.listdir(tmp_path / "outbox" / "tmp") == []
+    box.remove(ids[1])
+    assert box.queued() == [ids[0], ids[2]]
+
+def test_record_failure_backoff_and_dead_letter(tmp_path):
+    box = outbox.Outbox(str(tmp_path), max_attempts=3, backoff_base=10, backoff_max=15)
+    message_id = box.add(make_email(0))
+    assert not box.record_failure(message_id, "421 busy")
+    state = box.state(message_id)
+    assert state['attempts'] == 1
+    assert box.due() == []
+    assert box.due(now=state['next_attempt']) == [message_id]
+    assert box.retry_delay(1) == 10
+    assert box.retry_delay(5) == 15
+    assert not box.record_failure(message_id, "421 busy")
+    # the third failure reaches max_attempts
+    assert box.record_failure(message_id, "421 busy")
+    assert box.queued() == []
+    assert box.dead_letters() == [message_id]
+    assert box.state(message_id, "dead")['attempts'] == 3
+
+def test_delivery_pool(tmp_path):
+    """Test queued emails are delivered concurrently, failures retried later or dead-lettered"""
+    box = outbox.Outbox(str(tmp_path))
+    # queued by an earlier run
+    earlier_id = box.add(make_email(0))
+    sent = []
+    failures = {"user1@example.com": ("451 try again", False),
+                "user2@example.com": ("550 no such user", True)}
+    senders = []
+
+    def sender_factory():
+        senders.append(FakeSender(sent, failures, delay=0.01))
+        return senders[-1]
+
+    with outbox.DeliveryPool(box, sender_factory, workers=3) as pool:
+        assert pool.send_many([make_email(n) for n in range(1, 6)]) == [True] * 5
+    assert len(senders) == 3
+    assert all(sender.closed for sender in senders)
+    assert sorted(subject for _, subject in sent) == ["Forecast 0", "Forecast 3", "Forecast 4",
+                                                       "Forecast 5"]
+    assert len({thread for thread, _ in sent}) > 1
+    assert earlier_id not in box.queued()
+    # the temporary failure waits for a retry, the permanent one is dead-lettered
+    assert [box.load(message_id)['To'] for message_id in box.queued()] == ["user1@example.com"]
+    assert len(box.dead_letters()) == 1
+
+def test_delivery_pool_lock(tmp_path):
+    """Test only one pool delivers from an outbox, and others just queue"""
+    pytest.importorskip("fcntl")
+    sent = []
+    with outbox.DeliveryPool(outbox.Outbox(str(tmp_path)), lambda: FakeSender(sent)):
+        other = outbox.DeliveryPool(outbox.Outbox(str(tmp_path)), lambda: FakeSender(sent))
+        with other:
+            assert not other.delivering
+            other.send(make_email(0))
+    # the message was picked up by neither pool, and is left for the next run
+    assert sent == []
+    assert len(outbox.Outbox(str(tmp_path)).due()) == 1
@@ -0,0 +1,73 @@
+"""Test sendafd.profiling module"""
+import os
+import pstats
+import time
+
+import pytest
+
+from sendafd import metrics, profiling
+
+
+def parse_text():
+    return [line.split() for line in ["Short Term Forecast"] * 2000]
+
+def render_text(text):
+    with metrics.timer('parse'):
+        parsed = parse_text()
+    time.sleep(0.05)
+    return text * len(parsed)
+
+@pytest.fixture
+def profiler(tmp_path):
+    profiler = profiling.Profiler(str(tmp_path / "profile"), top_allocations=3)
+    profiler.start()
+    yield profiler
+    profiler.stop()
+
+def test_stages_profiled(profiler):
+    """Test each timed stage is profiled, with nested stages counted only once"""
+    kept = []
+    for _ in range(2):
+        with metrics.timer('render', kind="email"):
+            kept.append(render_text("x"))
+    with metrics.timer('smtp_send'):
+        with metrics.timer('smtp_connect'):
+            pass
+    # stages with no profile stage are not profiled
+    with metrics.timer('poll'):
+        pass
+    profiler.stop()
+    assert metrics.stage_hook is None
+    rows = {row['stage']: row for row in profiler.summary()}
+    assert sorted(rows) == ["parse", "render", "send"]
+    assert rows['parse']['runs'] == 2
+    assert rows['send']['runs'] == 1
+    assert rows['render']['seconds'] >= 0.1
+    assert rows['parse']['seconds'] < rows['render']['seconds']
+    parse_stats = pstats.Stats(profiler._profiles['parse']).stats
+    render_stats = pstats.Stats(profiler._profiles['render']).stats
+    assert any(function == "parse_text" for _, _, function in parse_stats)
+    assert not any(function == "parse_text" for _, _, function in render_stats)
+    # the parsed lines are allocated by parse_text, the output string by render_text
+    assert any(filename == __file__ for filename, _, _, _ in profiler.top_allocations('parse'))
+    assert rows['render']['top_function'] is not None
+
+def test_write_reports(profiler):
+    with metrics.timer('fetch_product'):
+        parse_text()
+    profiler.stop()
+    paths = profiler.write_reports()
+    assert sorted(os.path.basename(path) for path in paths) == \
+        ["fetch.pstats", "fetch_allocations.txt", "summary.txt"]
+    pstats.Stats(os.path.join(profiler.output_dir, "fetch.pstats"))
+    with open(os.path.join(profiler.output_dir, "summary.txt"), 'r', encoding='utf-8') as f:
+        summary = f.read().splitlines()
+    assert summary[0].split()[:4] == ["Stage", "Runs", "Seconds", "Allocated"]
+    assert summary[1].startswith("fetch")
+
+def test_format_summary():
+    table = profiling.format_summary([{'stage': "render", 'runs': 3, 'seconds': 0.5,
+                                       'allocated_bytes': 2048, 'top_function': None,
+                                       'top_allocation': "renderer.py:10"}])
+    assert table.splitlines()[1].split() == ["render", "3", "0.5000", "2.0", "KiB", "-",
+                                             "renderer.py:10"]
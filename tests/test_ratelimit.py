@@ -0,0 +1,73 @@
+"""Test sendafd.ratelimit module"""
+import email.utils
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+
+import pytest
+
+from sendafd import ratelimit
+
+
+class FakeClock:
+    """Stands in for the time module, advancing instantly when asked to sleep"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(ratelimit, 'time', fake_clock)
+    return fake_clock
+
+def test_token_bucket_burst_then_rate(clock):
+    bucket = ratelimit.TokenBucket(rate=10, burst=3)
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+    # once the burst is used up, requests are spaced at the rate
+    assert bucket.acquire() == pytest.approx(0.1)
+    assert bucket.acquire() == pytest.approx(0.1)
+    clock.sleep(10)
+    # tokens refill up to the burst size only
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.acquire() == pytest.approx(0.1)
+
+def test_token_bucket_pause(clock):
+    bucket = ratelimit.TokenBucket(rate=10, burst=5)
+    bucket.pause(2)
+    # requests wait out the pause, then resume at the rate rather than in a burst
+    assert bucket.acquire() == pytest.approx(2.1)
+    assert bucket.acquire() == pytest.approx(0.1)
+
+def test_token_bucket_unlimited(clock):
+    bucket = ratelimit.TokenBucket(rate=0)
+    assert [bucket.acquire() for _ in range(100)] == [0] * 100
+
+def test_circuit_breaker(clock):
+    breaker = ratelimit.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure("psr")
+    assert breaker.allow("psr")
+    breaker.record_failure("psr")
+    assert not breaker.allow("psr")
+    # other endpoints are unaffected
+    assert breaker.allow("top")
+    clock.sleep(60)
+    # a single trial request is allowed after the reset timeout
+    assert breaker.allow("psr")
+    assert not breaker.allow("psr")
+    breaker.record_success("psr")
+    assert breaker.allow("psr")
+    assert not breaker.is_open("psr")
+
+def test_retry_after_delay():
+    assert ratelimit.retry_after_delay(Mock(headers={'Retry-After': "5"})) == 5
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    header = email.utils.format_datetime(retry_at, usegmt=True)
+    assert ratelimit.retry_after_delay(Mock(headers={'Retry-After': header})) == \
+        pytest.approx(30, abs=2)
+    assert ratelimit.retry_after_delay(Mock(headers={'Retry-After': "soon"})) is None
+    assert ratelimit.retry_after_delay(Mock(headers={})) is None
@@ -0,0 +1,152 @@
+"""Test sendafd.renderer module"""
+import json
+import os
+from unittest.mock import Mock
+
+import pytest
+from jinja2 import FileSystemLoader
+
+from sendafd import apiclient, renderer
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(os.path.dirname(FIXTURE_DIR), "templates")
+
+
+@pytest.fixture
+def parsed_afd():
+    with open(os.path.join(FIXTURE_DIR, "psr_afd_response.json"), 'r', encoding='utf-8') as f:
+        return apiclient.AreaForecastDiscussion(json.load(f))
+
+@pytest.fixture
+def template_dir(monkeypatch, tmp_path):
+    """Copy the bundled templates to a temporary directory and render from there"""
+    for name in os.listdir(TEMPLATE_DIR):
+        with open(os.path.join(TEMPLATE_DIR, name), 'r', encoding='utf-8') as f:
+            (tmp_path / name).write_text(f.read(), encoding='utf-8')
+    monkeypatch.setattr(renderer.env, 'loader', FileSystemLoader(str(tmp_path)))
+    monkeypatch.setattr(renderer, 'render_cache', renderer.RenderCache())
+    return tmp_path
+
+def test_render_cache_hit(template_dir, parsed_afd):
+    first = renderer.render_email_body(parsed_afd, 'default_email_template.html')
+    second = renderer.render_email_body(parsed_afd, 'default_email_template.html')
+    assert first == second
+    assert "Area Forecast Discussion for KPSR" in first
+    assert renderer.render_cache.hits == 1
+    assert renderer.render_cache.misses == 1
+
+def test_render_cache_separates_kinds(template_dir, parsed_afd):
+    renderer.render_email_body(parsed_afd, 'default_email_template.html')
+    web_body = renderer.render_web(parsed_afd, {'id': parsed_afd.product_id}, 'sample_web_template.html')
+    renderer.render_web(parsed_afd, {'id': parsed_afd.product_id}, 'default_email_template.html')
+    assert renderer.render_cache.hits == 0
+    assert parsed_afd.product_id in web_body
+
+def test_render_cache_template_changed(template_dir, parsed_afd):
+    """Test editing a template invalidates cached output"""
+    renderer.render_email_body(parsed_afd, 'default_email_template.html')
+    (template_dir / 'default_email_template.html').write_text("changed {{ afd.product_id }}",
+                                                              encoding='utf-8')
+    assert renderer.render_email_body(parsed_afd, 'default_email_template.html') == \
+           f"changed {parsed_afd.product_id}"
+
+def test_render_cache_included_template_changed(template_dir, parsed_afd):
+    """Test editing a template that is extended or included invalidates cached output"""
+    (template_dir / 'base.html').write_text("base {% block body %}{% endblock %}", encoding='utf-8')
+    (template_dir / 'footer.html').write_text("footer", encoding='utf-8')
+    (template_dir / 'child.html').write_text(
+        '{% extends "base.html" %}{% block body %}{{ afd.product_id }} '
+        '{% include "footer.html" %}{% endblock %}', encoding='utf-8')
+    assert renderer.render_email_body(parsed_afd, 'child.html') == \
+        f"base {parsed_afd.product_id} footer"
+    (template_dir / 'footer.html').write_text("new footer", encoding='utf-8')
+    assert renderer.render_email_body(parsed_afd, 'child.html') == \
+        f"base {parsed_afd.product_id} new footer"
+    (template_dir / 'base.html').write_text("new base {% block body %}{% endblock %}",
+                                            encoding='utf-8')
+    assert renderer.render_email_body(parsed_afd, 'child.html') == \
+        f"new base {parsed_afd.product_id} new footer"
+    assert renderer.render_cache.hits == 0
+
+def test_render_cache_lru_eviction():
+    cache = renderer.RenderCache(max_entries=2)
+    cache.put(("email", "a", "t", "1"), "a")
+    cache.put(("email", "b", "t", "1"), "b")
+    cache.get(("email", "a", "t", "1"))
+    cache.put(("email", "c", "t", "1"), "c")
+    assert cache.get(("email", "b", "t", "1")) is None
+    assert cache.get(("email", "a", "t", "1")) == "a"
+
+def test_render_cache_on_disk(tmp_path):
+    key = ("web", "a", "t", "1")
+    renderer.RenderCache(cache_dir=str(tmp_path)).put(key, "<html></html>")
+    assert renderer.RenderCache(cache_dir=str(tmp_path)).get(key) == "<html></html>"
+
+def test_render_cache_write_failure(tmp_path, monkeypatch):
+    """Test a failed write is only logged, keeps the entry in memory and leaves no temporary file"""
+    key = ("web", "a", "t", "1")
+    cache = renderer.RenderCache(cache_dir=str(tmp_path))
+    monkeypatch.setattr(os, 'replace', Mock(side_effect=OSError("disk full")))
+    cache.put(key, "<html></html>")
+    assert cache.get(key) == "<html></html>"
+    assert os.listdir(tmp_path) == []
+
+def test_render_cache_on_disk_pruned(tmp_path):
+    """Test entries on disk are pruned to the most recently used max_entries"""
+    cache = renderer.RenderCache(max_entries=2, cache_dir=str(tmp_path))
+    for n, product_id in enumerate("abc"):
+        cache.put(("web", product_id, "t", "1"), product_id)
+        # entries are used in order of modification time, so give each a distinct one
+        path = tmp_path / f"{cache.key_digest(('web', product_id, 't', '1'))}.html"
+        os.utime(path, ns=(n * 10 ** 9, n * 10 ** 9))
+    assert len(os.listdir(tmp_path)) == 2
+    assert renderer.RenderCache(cache_dir=str(tmp_path)).get(("web", "a", "t", "1")) is None
+    assert renderer.RenderCache(cache_dir=str(tmp_path)).get(("web", "c", "t", "1")) == "c"
+
+@pytest.fixture
+def restore_templates():
+    """Put the module template settings back after a test changes them"""
+    loader, bytecode_cache = renderer.env.loader, renderer.env.bytecode_cache
+    yield
+    renderer.env.loader, renderer.env.bytecode_cache = loader, bytecode_cache
+    renderer.env.cache.clear()
+
+def test_templates_found_from_any_directory(restore_templates, monkeypatch, tmp_path, parsed_afd):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(renderer, 'render_cache', renderer.RenderCache(max_entries=0))
+    renderer.configure_templates()
+    assert renderer.env.loader.searchpath == [TEMPLATE_DIR]
+    assert "KPSR" in renderer.render_email_body(parsed_afd, 'default_email_template.html')
+    # extra directories are searched first, resolved against the working directory of the time
+    (tmp_path / "custom").mkdir()
+    (tmp_path / "custom" / "default_email_template.html").write_text("custom {{ afd.product_id }}")
+    renderer.configure_templates(["custom"])
+    monkeypatch.chdir(FIXTURE_DIR)
+    assert renderer.render_email_body(parsed_afd, 'default_email_template.html') == \
+        f"custom {parsed_afd.product_id}"
+
+def test_bytecode_cache(restore_templates, tmp_path, parsed_afd, monkeypatch):
+    """Test compiled templates are stored on disk, reused, and recompiled after an edit"""
+    monkeypatch.setattr(renderer, 'render_cache', renderer.RenderCache(max_entries=0))
+    (tmp_path / "templates").mkdir()
+    template = tmp_path / "templates" / "t.html"
+    template.write_text("first {{ afd.product_id }}")
+    renderer.configure_templates([str(tmp_path / "templates")])
+    with pytest.raises(ValueError):
+        renderer.precompile_templates()
+    cache_dir = tmp_path / "bytecode"
+    renderer.configure_templates([str(tmp_path / "templates")], str(cache_dir))
+    assert renderer.precompile_templates() >= 4
+    assert len(os.listdir(cache_dir)) >= 4
+    # a new process would load the template from the cache without compiling it
+    renderer.env.cache.clear()
+    compile_calls = []
+    real_compile = renderer.env.compile
+    monkeypatch.setattr(renderer.env, 'compile',
+                        lambda *a, **kw: compile_calls.append(a) or real_compile(*a, **kw))
+    assert renderer.render_email_body(parsed_afd, "t.html") == f"first {parsed_afd.product_id}"
+    assert compile_calls == []
+    template.write_text("second {{ afd.product_id }}")
+    renderer.env.cache.clear()
+    assert renderer.render_email_body(parsed_afd, "t.html") == f"second {parsed_afd.product_id}"
+    assert len(compile_calls) == 1
@@ -0,0 +1,70 @@
+"""Test sendafd.reprocess module"""
+import json
+import os
+import sys
+
+import pytest
+
+from sendafd import __main__ as cli, archive, reprocess
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(FIXTURE_DIR)
+
+
+def load_product(name):
+    with open(os.path.join(FIXTURE_DIR, name), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+@pytest.fixture
+def afd_archive(tmp_path, monkeypatch):
+    """Archive holding five PSR products and one LOX product"""
+    # templates are looked up relative to the working directory
+    monkeypatch.chdir(ROOT_DIR)
+    afd_archive = archive.Archive(str(tmp_path / "archive"))
+    psr = load_product("psr_afd_response.json")
+    afd_archive.append("PSR", [dict(psr, id=f"psr-{n}", issuanceTime=f"2023-02-0{n}T00:00:00+00:00")
+                               for n in range(1, 6)])
+    afd_archive.append("LOX", [load_product("lox_afd_response.json")])
+    return afd_archive
+
+def test_reprocess_jsonl(afd_archive, tmp_path):
+    output = tmp_path / "out.jsonl"
+    counts = reprocess.reprocess(afd_archive, template='default_email_template.html',
+                                 jsonl_path=str(output), processes=2, chunk_size=2)
+    assert counts == {'processed': 6, 'failed': 0}
+    records = [json.loads(line) for line in output.read_text(encoding='utf-8').splitlines()]
+    # records are written in archive order, whichever worker finishes first
+    assert [r['id'] for r in records][1:] == [f"psr-{n}" for n in range(1, 6)]
+    assert records[0]['region'] == "LOX"
+    assert records[1]['sections'][1]['name'] == "Synopsis"
+    assert "Area Forecast Discussion for KPSR" in records[1]['html']
+
+def test_reprocess_html_dir(afd_archive, tmp_path):
+    output_dir = tmp_path / "html"
+    counts = reprocess.reprocess(afd_archive, ["psr"], template='sample_web_template.html',
+                                 web=True, output_dir=str(output_dir), processes=1,
+                                 start="2023-02-02", end="2023-02-04")
+    assert counts == {'processed': 2, 'failed': 0}
+    assert sorted(os.listdir(output_dir / "psr")) == ["psr-2.html", "psr-3.html"]
+
+def test_reprocess_failures(afd_archive, tmp_path):
+    afd_archive.append("TOP", [{'id': "broken", 'issuanceTime': "2023-02-01T00:00:00+00:00"}])
+    output = tmp_path / "out.jsonl"
+    counts = reprocess.reprocess(afd_archive, ["top", "lox"], jsonl_path=str(output), processes=1)
+    assert counts == {'processed': 1, 'failed': 1}
+    assert 'html' not in json.loads(output.read_text(encoding='utf-8'))
+
+def test_reprocess_requires_one_sink(afd_archive, tmp_path):
+    with pytest.raises(ValueError):
+        reprocess.reprocess(afd_archive, template='default_email_template.html')
+    with pytest.raises(ValueError):
+        reprocess.reprocess(afd_archive, output_dir=str(tmp_path))
+
+def test_invalid_time_rejected(tmp_path, monkeypatch, capsys):
+    """Test an invalid --start is reported as a usage error rather than a traceback"""
+    monkeypatch.setattr(sys, 'argv', ["sendafd", "--reprocess", str(tmp_path),
+                                      "--jsonl", str(tmp_path / "out.jsonl"), "--start", "garbage"])
+    with pytest.raises(SystemExit) as exit_info:
+        cli.main()
+    assert exit_info.value.code == 2
+    assert "invalid ISO 8601 time: 'garbage'" in capsys.readouterr().err
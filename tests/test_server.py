@@ -0,0 +1,99 @@
+"""Test sendafd.server module"""
+import http.client
+import os
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from sendafd import apiclient, renderer, server
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+LIST_URL = "https://api.weather.gov/products/types/afd/locations/psr"
+
+
+def mocked_requests_get(*args, **kwargs):
+    name = "psr_afd_list_response.json" if args[0] == LIST_URL else "psr_afd_response.json"
+    with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+        return Mock(status_code=200, headers={}, content=f.read())
+
+@pytest.fixture
+def requests_mock(monkeypatch):
+    requests_mock = Mock(side_effect=mocked_requests_get)
+    monkeypatch.setattr('requests.Session.get', requests_mock)
+    # templates are found relative to the working directory
+    monkeypatch.chdir(os.path.dirname(FIXTURE_DIR))
+    monkeypatch.setattr(renderer, 'render_cache', renderer.RenderCache())
+    apiclient.close_session()
+    yield requests_mock
+    apiclient.close_session()
+
+@pytest.fixture
+def address(tmp_path, requests_mock):
+    pages = server.PageCache(cache=apiclient.MonitorCache(cache_dir=str(tmp_path), in_memory=True),
+                             ignore_region_validation=True)
+    afd_server = server.AFDServer(("127.0.0.1", 0), pages)
+    thread = threading.Thread(target=afd_server.serve_forever, daemon=True)
+    thread.start()
+    yield afd_server.server_address
+    afd_server.shutdown()
+    afd_server.server_close()
+
+def get(address, path, headers=None):
+    connection = http.client.HTTPConnection(*address, timeout=10)
+    connection.request("GET", path, headers=headers or {})
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+def test_serve_page(address, requests_mock):
+    response, body = get(address, "/afd/psr")
+    assert response.status == 200
+    assert b"Area Forecast Discussion for KPSR" in body
+    assert response.getheader("Last-Modified") == "Thu, 09 Feb 2023 12:29:00 GMT"
+    etag = response.getheader("ETag")
+    response, body = get(address, "/afd/PSR", {'If-None-Match': etag})
+    assert response.status == 304 and body == b""
+    response, _ = get(address, "/afd/psr", {'If-Modified-Since': "Thu, 09 Feb 2023 12:29:00 GMT"})
+    assert response.status == 304
+    # the second and third requests were answered from memory
+    assert requests_mock.call_count == 2
+
+def test_concurrent_requests_fetch_once(address, requests_mock):
+    statuses = []
+    threads = [threading.Thread(target=lambda: statuses.append(get(address, "/afd/psr")[0].status))
+               for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200] * 10
+    assert requests_mock.call_count == 2
+
+def test_unknown_path(address):
+    assert get(address, "/afd")[0].status == 404
+    assert get(address, "/other/psr")[0].status == 404
+
+def test_malformed_region_rejected(address, requests_mock):
+    """Test strings that can not be region codes are rejected without a fetch, even with -i"""
+    assert get(address, "/afd/" + "x" * 40)[0].status == 404
+    assert get(address, "/afd/p%2Fr")[0].status == 404
+    assert requests_mock.call_count == 0
+
+def test_default_cache_dir(tmp_path, monkeypatch):
+    """Test the default cache is not the monitor mode cache in the working directory"""
+    monkeypatch.chdir(tmp_path)
+    pages = server.PageCache()
+    assert pages.cache.cache_dir == server.DEFAULT_CACHE_DIR
+    assert os.path.isdir(tmp_path / server.DEFAULT_CACHE_DIR)
+
+def test_render_only_new_products(tmp_path, requests_mock, monkeypatch):
+    pages = server.PageCache(cache=apiclient.MonitorCache(cache_dir=str(tmp_path), in_memory=True),
+                             poll_interval=0, ignore_region_validation=True)
+    render = Mock(wraps=pages.render)
+    monkeypatch.setattr(pages, 'render', render)
+    first = pages.get("psr")['response']
+    assert pages.get("psr")['response'] is first
+    assert render.call_count == 1
+    assert requests_mock.call_count == 3
@@ -0,0 +1,78 @@
+"""Test sendafd.sitebuild module"""
+import json
+import os
+import sys
+import time
+
+import pytest
+
+from sendafd import __main__ as cli, apiclient, renderer, sitebuild
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_product(region):
+    with open(os.path.join(FIXTURE_DIR, f"{region}_afd_response.json"), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+@pytest.fixture(autouse=True)
+def templates_dir(monkeypatch):
+    # templates are found relative to the working directory
+    monkeypatch.chdir(os.path.dirname(FIXTURE_DIR))
+    monkeypatch.setattr(renderer, 'render_cache', renderer.RenderCache())
+
+@pytest.fixture
+def products():
+    return {"PSR": load_product("psr"), "TOP": load_product("top")}
+
+def test_build_site(tmp_path, products):
+    result = sitebuild.build_site(str(tmp_path), products)
+    assert sorted(result['written']) == ["index.html", "psr.html", "top.html"]
+    index = (tmp_path / "index.html").read_text(encoding='utf-8')
+    assert 'href="psr.html"' in index and 'href="top.html"' in index
+    manifest = json.loads((tmp_path / "manifest.json").read_text(encoding='utf-8'))
+    assert manifest['pages']['PSR']['product_id'] == products["PSR"]['id']
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+def test_rebuild_unchanged(tmp_path, products):
+    sitebuild.build_site(str(tmp_path), products)
+    mtime = os.stat(tmp_path / "psr.html").st_mtime_ns
+    start = time.perf_counter()
+    result = sitebuild.build_site(str(tmp_path), products)
+    assert time.perf_counter() - start < 0.1
+    assert result['written'] == []
+    assert os.stat(tmp_path / "psr.html").st_mtime_ns == mtime
+
+def test_rebuild_changed_product(tmp_path, products):
+    sitebuild.build_site(str(tmp_path), products)
+    products["TOP"] = dict(products["TOP"], id="newer-product")
+    assert sorted(sitebuild.build_site(str(tmp_path), products)['written']) == ["index.html",
+                                                                               "top.html"]
+    # a deleted page is written again even though its inputs are unchanged
+    os.remove(tmp_path / "psr.html")
+    assert sitebuild.build_site(str(tmp_path), products)['written'] == ["psr.html"]
+
+def test_fetch_products_from_cache(tmp_path):
+    cache = apiclient.MonitorCache(cache_dir=str(tmp_path))
+    cache.set_product("psr", load_product("psr"))
+    products = sitebuild.fetch_products(["PSR", "TOP"], cache, fetch=False)
+    assert list(products) == ["PSR"]
+
+def test_rebuild_changed_template(tmp_path, products, monkeypatch):
+    sitebuild.build_site(str(tmp_path), products)
+    monkeypatch.setattr(renderer, 'template_hash', lambda template_path: "edited")
+    assert len(sitebuild.build_site(str(tmp_path), products)['written']) == 3
+
+def test_site_build_cache_separate_from_monitor_cache(tmp_path, monkeypatch):
+    """Test the site build does not use the cache_{region}.json files of monitor mode"""
+    caches = []
+    def fetch_products(regions, cache, **kwargs):
+        caches.append(cache)
+        return {}
+    monkeypatch.setattr(sitebuild, 'fetch_products', fetch_products)
+    output_dir = str(tmp_path / "site")
+    monkeypatch.setattr(sys, 'argv', ["sendafd", "--site-build", output_dir, "PSR"])
+    with pytest.raises(SystemExit):
+        cli.main()
+    assert caches[0].cache_dir == os.path.join(output_dir, sitebuild.CACHE_DIRNAME)
+    assert os.path.isdir(caches[0].cache_dir)
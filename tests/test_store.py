@@ -0,0 +1,65 @@
+"""Test sendafd.store module"""
+import json
+import os
+import threading
+
+import pytest
+
+from sendafd import store
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_product(name):
+    with open(os.path.join(FIXTURE_DIR, name), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+@pytest.fixture
+def cache(tmp_path):
+    sqlite_cache = store.SQLiteCache(str(tmp_path / "sendafd.db"))
+    yield sqlite_cache
+    sqlite_cache.close()
+
+def test_empty_cache(cache):
+    assert cache.last_seen_id("psr") is None
+    assert cache.get_product("psr") == {}
+    assert cache.get_validators("psr") == {}
+
+def test_set_product(cache):
+    product = load_product("psr_afd_response.json")
+    cache.set_product("PSR", product)
+    assert cache.last_seen_id("psr") == product['id']
+    assert cache.get_product("psr") == product
+    assert cache.get_product_by_id(product['id']) == product
+
+def test_set_validators(cache):
+    validators = {"https://api.weather.gov/products/types/afd/locations/psr": {'etag': '"psr"'}}
+    cache.set_validators("psr", validators)
+    assert cache.get_validators("PSR") == validators
+
+def test_products_kept(cache):
+    """Test every product set is kept, not only the last one"""
+    product = load_product("psr_afd_response.json")
+    older = dict(product, id="older", issuanceTime="2000-01-01T00:00:00+00:00")
+    cache.set_product("psr", older)
+    cache.set_product("psr", product)
+    rows = cache.connection().execute("SELECT product_id FROM products WHERE region = 'psr' "
+                                      "ORDER BY issuance_time DESC").fetchall()
+    assert [row[0] for row in rows] == [product['id'], "older"]
+    assert cache.last_seen_id("psr") == product['id']
+
+def test_shared_between_connections(cache):
+    """Test a product written by one connection is seen by another, as from a second process"""
+    product = load_product("top_afd_response.json")
+    thread = threading.Thread(target=cache.set_product, args=("top", product))
+    thread.start()
+    thread.join()
+    other = store.SQLiteCache(cache.db_path)
+    assert other.last_seen_id("top") == product['id']
+    other.close()
+
+def test_set_fingerprints(cache):
+    assert cache.get_fingerprints("psr") == {}
+    cache.set_fingerprints("PSR", "abc", {"header": "1", "Aviation": "2"})
+    assert cache.get_fingerprints("psr") == {'product_id': "abc",
+                                             'sections': {"header": "1", "Aviation": "2"}}
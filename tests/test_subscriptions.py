@@ -0,0 +1,89 @@
+"""Test sendafd.subscriptions module"""
+import json
+import os
+from unittest.mock import Mock
+
+import pytest
+
+from sendafd import renderer, subscriptions
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_fixture(file_name: str) -> dict:
+    with open(os.path.join(FIXTURE_DIR, file_name), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+@pytest.fixture
+def results():
+    return {"PSR": {'response': load_fixture("psr_afd_response.json"), 'error': None},
+            "TOP": {'response': load_fixture("top_afd_response.json"), 'error': None},
+            "OKX": {'response': None, 'error': None}}
+
+@pytest.fixture
+def render_mock(monkeypatch):
+    render_mock = Mock(return_value="<p>Area Forecast Discussion</p>")
+    monkeypatch.setattr(renderer, 'render_email_body', render_mock)
+    return render_mock
+
+def test_parse_subscriptions_defaults():
+    subs = subscriptions.parse_subscriptions({"foo@bar.com": {"regions": ["psr", "PSR", "top"]}})
+    assert subs == {"foo@bar.com": {'regions': ["PSR", "TOP"],
+                                    'template': 'default_email_template.html',
+                                    'plaintext': False}}
+
+def test_parse_subscriptions_no_regions():
+    with pytest.raises(ValueError):
+        subscriptions.parse_subscriptions({"foo@bar.com": {"regions": []}})
+
+@pytest.mark.parametrize("settings", [["PSR"], {"regions": "PSR"}, {"regions": [1]},
+                                      {"regions": ["PSR"], "template": 1},
+                                      {"regions": ["PSR"], "plaintext": "yes"}])
+def test_parse_subscriptions_malformed(settings):
+    with pytest.raises(ValueError, match="foo@bar.com"):
+        subscriptions.parse_subscriptions({"foo@bar.com": settings})
+
+def test_subscribed_regions():
+    subs = subscriptions.parse_subscriptions({"foo@bar.com": {"regions": ["PSR", "TOP"]},
+                                              "baz@bar.com": {"regions": ["OKX", "PSR"]}})
+    assert subscriptions.subscribed_regions(subs) == ["PSR", "TOP", "OKX"]
+
+def test_render_once_per_product(results, render_mock):
+    """Test each (product, template) pair is rendered once however many subscribers it has"""
+    subs = subscriptions.parse_subscriptions({
+        f"user{n}@bar.com": {"regions": ["PSR", "TOP", "OKX"]} for n in range(10)
+    })
+    messages = list(subscriptions.build_messages(results, subs, "someuser@emailserver.com"))
+    assert len(messages) == 20
+    assert render_mock.call_count == 2
+    recipients = {email['To'] for _, region, email in messages if region == "PSR"}
+    assert recipients == {f"user{n}@bar.com" for n in range(10)}
+    assert all(email['From'] == "someuser@emailserver.com" for _, _, email in messages)
+
+def test_plaintext_subscribers(results, render_mock):
+    subs = subscriptions.parse_subscriptions({"foo@bar.com": {"regions": ["PSR"]},
+                                              "baz@bar.com": {"regions": ["PSR"], "plaintext": True}})
+    messages = {recipient: email for recipient, _, email in
+                subscriptions.build_messages(results, subs, "someuser@emailserver.com")}
+    assert messages["foo@bar.com"].is_multipart()
+    assert not messages["baz@bar.com"].is_multipart()
+    assert render_mock.call_count == 1
+
+def test_deliver_counts(results, render_mock):
+    subs = subscriptions.parse_subscriptions({"foo@bar.com": {"regions": ["PSR", "TOP"]}})
+    sender = Mock()
+    sender.send.side_effect = [True, False]
+    assert subscriptions.deliver(results, subs, "someuser@emailserver.com", sender) == {'sent': 1, 'failed': 1}
+
+def test_unparseable_region_skipped(results, render_mock):
+    """Test a region whose AFD fails to parse is skipped without stopping later regions"""
+    results["PSR"]['response'] = dict(results["PSR"]['response'], issuanceTime="not a time")
+    subs = subscriptions.parse_subscriptions({"foo@bar.com": {"regions": ["PSR", "TOP"]},
+                                              "baz@bar.com": {"regions": ["PSR"]},
+                                              "qux@bar.com": {"regions": ["TOP"]}})
+    sender = Mock()
+    sender.send.return_value = True
+    counts = subscriptions.deliver(results, subs, "someuser@emailserver.com", sender)
+    assert counts == {'sent': 2, 'failed': 0}
+    sent_to = [call.args[0]['To'] for call in sender.send.call_args_list]
+    assert sent_to == ["foo@bar.com", "qux@bar.com"]